@@ -0,0 +1,15 @@
+-- Pesquisa textual (RAG) sobre a tabela documents
+-- Substitui a procura por regex/ILIKE (sem índice) por full-text search em português e trigramas
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Coluna tsvector gerada automaticamente a partir do conteúdo (configuração portuguesa)
+ALTER TABLE documents
+    ADD COLUMN IF NOT EXISTS content_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('portuguese', coalesce(content, ''))) STORED;
+
+-- Índices para melhorar performance (pesquisa por palavras-chave)
+CREATE INDEX IF NOT EXISTS idx_documents_content_tsv ON documents USING GIN (content_tsv);
+
+-- Índice de trigramas para nomes científicos (tolerante a erros de escrita)
+CREATE INDEX IF NOT EXISTS idx_documents_nome_cientifico_trgm ON documents USING GIN (nome_cientifico gin_trgm_ops);
@@ -0,0 +1,21 @@
+"""Reconhecimento facial: comparação com galerias sintéticas de 100/10k/100k encodings e deteção"""
+import base64
+
+import numpy as np
+import pytest
+
+from fakes import synthetic_face_gallery, synthetic_image_b64
+
+
+@pytest.mark.parametrize("gallery_size", [100, 10_000, 100_000])
+def bench_match_face(benchmark, service, gallery_size):
+    encodings, _ = synthetic_face_gallery(gallery_size)
+    query = encodings[gallery_size // 2] + np.random.default_rng(0).normal(0, 0.01, 128)
+    index, _ = benchmark(service.match_face, encodings, query)
+    assert index == gallery_size // 2
+
+
+def bench_face_detect(benchmark, service):
+    """Deteção HOG (dlib) numa imagem 640x480, como no /register_faces_batch"""
+    image_data = base64.b64decode(synthetic_image_b64())
+    benchmark.pedantic(service.face_worker.count_faces, args=(image_data,), rounds=5, warmup_rounds=1)
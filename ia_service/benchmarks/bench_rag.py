@@ -0,0 +1,20 @@
+"""Recuperação RAG: análise do prompt, pesquisa híbrida (vetorial + palavras-chave) e fusão"""
+QUERY = "Onde vive o lince ibérico e o que come?"
+
+
+def bench_analyse_prompt_uncached(benchmark, service):
+    """Classificação do prompt sem a lru_cache (custo do matcher compilado)"""
+    benchmark(service.analyse_prompt.__wrapped__, QUERY)
+
+
+def bench_hybrid_retrieve(benchmark, service, run_async):
+    docs = benchmark.pedantic(run_async, args=(lambda: service.hybrid_retrieve(QUERY, top_k=3),),
+                              rounds=20, warmup_rounds=2)
+    assert isinstance(docs, list)
+
+
+def bench_reciprocal_rank_fusion(benchmark, service):
+    vector = [{"id": i, "content": str(i)} for i in range(50)]
+    keyword = [{"id": i, "content": str(i)} for i in range(25, 75)]
+    fused = benchmark(service.reciprocal_rank_fusion, [vector, keyword], 10)
+    assert len(fused) == 10
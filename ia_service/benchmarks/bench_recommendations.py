@@ -0,0 +1,26 @@
+"""Algoritmos de recomendação sobre user_species_history sintético (tamanho em BENCH_HISTORY_ROWS)"""
+import pytest
+
+
+@pytest.mark.parametrize("algorithm", ["knn", "content", "collaborative", "hybrid"])
+def bench_advanced_recommendations(benchmark, service, candidates, run_async, algorithm):
+    request = service.AdvancedRecommendationRequest(
+        user_id="1",
+        user_groups=["Aves"],
+        user_families=["Familia1"],
+        seen_taxon_ids=["1", "2", "3"],
+        candidates=candidates,
+        algorithm=algorithm,
+        limit=10,
+    )
+    result = benchmark.pedantic(run_async, args=(lambda: service.advanced_recommend(request),),
+                                rounds=5, warmup_rounds=1)
+    assert "results" in result
+
+
+def bench_simple_recommendations(benchmark, service, candidates):
+    request = service.RecommendationRequest(
+        user_groups=["Aves"], user_families=["Familia1"], seen_taxon_ids=["1"], candidates=candidates
+    )
+    result = benchmark(service._recommend, request)
+    assert "results" in result
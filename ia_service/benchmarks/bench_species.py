@@ -0,0 +1,49 @@
+"""Inferência de espécies: imagem única, batch e pedidos concorrentes (modelo ResNet18 sintético)"""
+import asyncio
+
+import pytest
+
+from fakes import synthetic_image_b64
+
+BATCH_SIZE = 8
+CONCURRENT_REQUESTS = 16
+
+
+@pytest.fixture(scope="module")
+def images():
+    return [synthetic_image_b64(seed=i) for i in range(max(BATCH_SIZE, CONCURRENT_REQUESTS))]
+
+
+def bench_identify_single(benchmark, service, images):
+    service.get_species_model()  # Carregamento fora da medição
+    result = benchmark(service._identify_species, images[0], None)
+    assert "label" in result
+
+
+def bench_identify_batch(benchmark, service, images):
+    result = benchmark(service._identify_species, None, images[:BATCH_SIZE])
+    assert "votes" in result
+
+
+def bench_identify_concurrent(benchmark, service, images, run_async):
+    """CONCURRENT_REQUESTS pedidos em simultâneo através do executor de inferência"""
+    async def burst():
+        return await asyncio.gather(*(
+            service.identify_species(image=image, images=None) for image in images[:CONCURRENT_REQUESTS]
+        ))
+    results = benchmark.pedantic(run_async, args=(burst,), rounds=10, warmup_rounds=1)
+    assert len(results) == CONCURRENT_REQUESTS
+
+
+def bench_species_forward_only(benchmark, service):
+    """Só o forward (tensor já pré-processado): separa o custo do modelo do decode/preprocess"""
+    import torch
+    from dataset.embedding_index import resnet_forward
+
+    model, _ = service.get_species_model()
+    batch = torch.randn(1, 3, 224, 224)
+
+    def forward():
+        with torch.no_grad():
+            return resnet_forward(model, batch)
+    benchmark(forward)
@@ -0,0 +1,43 @@
+"""Arranque a frio: tempo de import do main.py (perfil -X importtime) e carregamento do modelo de espécies"""
+import os
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importados só na primeira utilização ou no aquecimento em segundo plano, nunca no import do main.py
+HEAVY_MODULES = ("torch", "torchvision", "sklearn", "face_recognition", "dlib")
+
+
+def _import_profile() -> list:
+    """(módulo, self µs, cumulativo µs) de cada import do main.py num interpretador novo"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=SERVICE_DIR, env=os.environ.copy(), capture_output=True, text=True, check=True,
+    )
+    profile = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        profile.append((name[1:].rstrip(), int(self_us), int(cumulative_us)))  # name: "  " por nível
+    return profile
+
+
+def bench_import_main(benchmark):
+    profile = benchmark.pedantic(_import_profile, rounds=3, iterations=1)
+    # Imports diretos do main.py (nível 1 na árvore do importtime), do mais lento para o mais rápido
+    direct = sorted(
+        ((name.strip(), cumulative) for name, _, cumulative in profile if name.startswith("  ") and not name.startswith("   ")),
+        key=lambda item: item[1], reverse=True,
+    )
+    benchmark.extra_info["top_imports_ms"] = {name: round(us / 1000, 1) for name, us in direct[:15]}
+    heavy = sorted({name.strip().split(".")[0] for name, _, _ in profile} & set(HEAVY_MODULES))
+    benchmark.extra_info["heavy_modules_imported"] = heavy
+    assert not heavy, f"Módulos pesados importados no arranque: {heavy}"
+
+
+def bench_species_model_load(benchmark, service):
+    """Carregamento dos pesos e do mapa de espécies (o que o aquecimento faz antes do primeiro pedido)"""
+    model, idx_to_info = benchmark.pedantic(service.load_species_model, rounds=3, iterations=1, warmup_rounds=1)
+    assert model is not None and idx_to_info
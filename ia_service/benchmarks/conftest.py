@@ -0,0 +1,87 @@
+"""
+Ambiente dos benchmarks: o main.py é importado com um modelo de espécies sintético (pesos aleatórios),
+Postgres em memória (FakePool) e Ollama/OpenRouter falsos (httpx encaminhado para a app ASGI local).
+
+Tamanhos configuráveis por variáveis de ambiente:
+    BENCH_HISTORY_ROWS (10000), BENCH_HISTORY_USERS (200), BENCH_TAXA (500),
+    BENCH_CANDIDATES (300), BENCH_DOCUMENTS (1000), BENCH_SPECIES_CLASSES (575),
+    BENCH_DB_LATENCY (0.0005 s por query), FAKE_UPSTREAM_LATENCY (0.05 s)
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fakes  # noqa: E402
+
+HISTORY_ROWS = int(os.environ.get("BENCH_HISTORY_ROWS", "10000"))
+HISTORY_USERS = int(os.environ.get("BENCH_HISTORY_USERS", "200"))
+TAXA = int(os.environ.get("BENCH_TAXA", "500"))
+CANDIDATES = int(os.environ.get("BENCH_CANDIDATES", "300"))
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", "1000"))
+SPECIES_CLASSES = int(os.environ.get("BENCH_SPECIES_CLASSES", "575"))
+DB_LATENCY = float(os.environ.get("BENCH_DB_LATENCY", "0.0005"))
+
+
+_WORKDIR = tempfile.mkdtemp(prefix="ia_bench_")
+_model_path, _map_path = fakes.synthetic_species_model(_WORKDIR, SPECIES_CLASSES)
+os.environ.update({
+    "SPECIES_MODEL_PATH": _model_path,
+    "SPECIES_MAP_PATH": _map_path,
+    "SPECIES_ANNOTATIONS_PATH": os.path.join(_WORKDIR, "annotations.json"),
+    "SPECIES_INDEX_DIR": os.path.join(_WORKDIR, "species_index"),
+    "KNOWN_FACES_DIR": os.path.join(_WORKDIR, "known_faces"),
+    "IDENTIFY_SPECIES_DIR": os.path.join(_WORKDIR, "identify_species"),
+    "OLLAMA_URL": "http://fake-ollama",
+    "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+})
+
+_real_async_client = httpx.AsyncClient
+_fake_upstreams = fakes.create_fake_upstreams()
+
+
+class _StubbedAsyncClient(_real_async_client):
+    """httpx.AsyncClient com todos os pedidos encaminhados para os upstreams falsos"""
+    def __init__(self, *args, **kwargs):
+        kwargs["transport"] = httpx.ASGITransport(app=_fake_upstreams)
+        super().__init__(*args, **kwargs)
+
+
+@pytest.fixture(scope="session")
+def event_loop_runner():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def service(event_loop_runner):
+    """Módulo main.py com as dependências externas substituídas"""
+    httpx.AsyncClient = _StubbedAsyncClient
+    import main
+
+    history = fakes.synthetic_history(HISTORY_ROWS, HISTORY_USERS, TAXA)
+    main._db_pool = fakes.FakePool(history, fakes.synthetic_documents(DOCUMENTS), latency=DB_LATENCY)
+    yield main
+    httpx.AsyncClient = _real_async_client
+
+
+@pytest.fixture(scope="session")
+def candidates():
+    return fakes.synthetic_candidates(CANDIDATES)
+
+
+@pytest.fixture
+def run_async(event_loop_runner):
+    """Executa uma corrotina no loop partilhado da sessão (os benchmarks do pytest-benchmark são síncronos)"""
+    def runner(coro_factory):
+        return event_loop_runner(coro_factory())
+    return runner
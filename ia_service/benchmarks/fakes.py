@@ -0,0 +1,260 @@
+"""
+Substitutos locais das dependências externas do ia_service, para benchmarks e testes de carga.
+
+- FakePool/FakeConnection: pool asyncpg em memória com user_species_history e documents sintéticos
+  (responde às queries do main.py pelo seu texto; latência por query configurável)
+- fake_upstreams: app ASGI que simula o Ollama (/api/embeddings, /api/chat) e o OpenRouter
+  (/api/v1/chat/completions), com latência e streaming de tokens configuráveis
+- Geradores de dados sintéticos (histórico de interações, candidatos, imagens, galerias de faces,
+  modelo de espécies com pesos aleatórios)
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
+
+ACTIONS = ("view", "favorite", "identify", "search")
+GROUPS = ("Aves", "Mammalia", "Reptilia", "Amphibia", "Insecta", "Plantae")
+EMBEDDING_DIM = 768  # nomic-embed-text
+
+
+# ==========================
+# DADOS SINTÉTICOS
+# ==========================
+
+def synthetic_history(rows: int, users: int, taxa: int, seed: int = 42) -> list:
+    """Linhas de user_species_history: (user_id, taxon_id, action, created_at)"""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    return [
+        {
+            "user_id": rng.randrange(1, users + 1),
+            "taxon_id": rng.randrange(1, taxa + 1),
+            "action": rng.choice(ACTIONS),
+            "created_at": start + timedelta(minutes=i),
+        }
+        for i in range(rows)
+    ]
+
+
+def synthetic_candidates(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            "taxon_id": str(taxon_id),
+            "common_name": f"Espécie {taxon_id}",
+            "group": rng.choice(GROUPS),
+            "family": f"Familia{rng.randrange(40)}",
+            "habitat": rng.choice(("floresta", "zona húmida", "urbano", "montanha")),
+            "observation_type": rng.choice(("foto", "som")),
+        }
+        for taxon_id in range(1, count + 1)
+    ]
+
+
+def synthetic_documents(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    words = ("lince", "ibérico", "águia", "habitat", "floresta", "ninho", "migração", "predador", "pardal")
+    return [
+        {"id": doc_id, "content": " ".join(rng.choice(words) for _ in range(60))}
+        for doc_id in range(1, count + 1)
+    ]
+
+
+def synthetic_image_b64(width: int = 640, height: int = 480, seed: int = 0) -> str:
+    rng = np.random.default_rng(seed)
+    image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def synthetic_face_gallery(size: int, seed: int = 42):
+    """(encodings de 128 dimensões como devolvidos pelo face_recognition, emails)"""
+    rng = np.random.default_rng(seed)
+    encodings = list(rng.normal(0, 0.1, (size, 128)))
+    return encodings, [f"user{i}@example.com" for i in range(size)]
+
+
+def synthetic_species_model(workdir: str, classes: int):
+    """ResNet18 com pesos aleatórios e mapa de espécies sintético (mesmo formato do model.py): (modelo, mapa)"""
+    import torch
+    import torchvision
+
+    model = torchvision.models.resnet18(weights=None)
+    model.fc = torch.nn.Linear(model.fc.in_features, classes)
+    model_path = os.path.join(workdir, "species_model.pt")
+    torch.save(model.state_dict(), model_path)
+    map_path = os.path.join(workdir, "species_taxon_map.json")
+    with open(map_path, "w", encoding="utf-8") as f:
+        json.dump([
+            {"class_name": str(i), "taxon_id": str(i), "sci_name": f"Species {i}", "common_name": f"Espécie {i}", "group": "Aves"}
+            for i in range(classes)
+        ], f)
+    return model_path, map_path
+
+
+def fake_embedding(text: str) -> list:
+    """Embedding determinístico (mesmo texto -> mesmo vetor), normalizado"""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    vector = np.random.default_rng(seed).normal(size=EMBEDDING_DIM)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+# ==========================
+# POSTGRES EM MEMÓRIA
+# ==========================
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def _latency(self):
+        if self.pool.latency:
+            await asyncio.sleep(self.pool.latency)
+
+    async def fetch(self, query: str, *args):
+        await self._latency()
+        if "FROM user_species_history" in query and "WHERE user_id = $1" in query:
+            rows = self.pool.history_by_user.get(int(args[0]), [])
+            return rows[:args[1]] if len(args) > 1 else rows
+        if "PARTITION BY user_id" in query:  # Interações recentes dos outros utilizadores (colaborativo)
+            return [
+                row for user_id, rows in self.pool.history_by_user.items() if user_id != int(args[0])
+                for row in rows[:args[1]]
+            ]
+        if "SELECT action, taxon_id FROM user_species_history" in query:
+            return self.pool.history
+        if "FROM documents" in query:
+            top_k = args[-1] if args and isinstance(args[-1], int) else 3
+            docs = self.pool.rng.sample(self.pool.documents, min(top_k, len(self.pool.documents)))
+            return [{**doc, "distance": self.pool.rng.uniform(0, 2), "score": self.pool.rng.random()} for doc in docs]
+        if "FROM recommendation_feedback" in query:
+            return []
+        return []
+
+    async def fetchrow(self, query: str, *args):
+        rows = await self.fetch(query, *args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query: str, *args):
+        await self._latency()
+        if "COUNT(DISTINCT user_id)" in query:
+            return len(self.pool.history_by_user)
+        if "COUNT(*)" in query:
+            return len(self.pool.history)
+        return None
+
+    async def execute(self, query: str, *args):
+        await self._latency()
+        return "OK"
+
+    async def close(self):
+        pass
+
+
+class FakePool:
+    """Interface mínima do asyncpg.Pool usada pelo main.py (acquire/release/close + tamanhos)"""
+
+    def __init__(self, history: list, documents: list, latency: float = 0.0, max_size: int = 10, seed: int = 42):
+        self.history = history
+        self.history_by_user = {}
+        for row in sorted(history, key=lambda r: r["created_at"], reverse=True):
+            self.history_by_user.setdefault(row["user_id"], []).append(row)
+        self.documents = documents
+        self.latency = latency
+        self.max_size = max_size
+        self.rng = random.Random(seed)
+        self.semaphore = asyncio.Semaphore(max_size)
+        self.in_use = 0
+
+    async def acquire(self, timeout=None):
+        await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        self.in_use += 1
+        return FakeConnection(self)
+
+    async def release(self, conn):
+        self.in_use -= 1
+        self.semaphore.release()
+
+    async def close(self):
+        pass
+
+    def get_max_size(self):
+        return self.max_size
+
+    def get_size(self):
+        return self.max_size
+
+    def get_idle_size(self):
+        return self.max_size - self.in_use
+
+
+# ==========================
+# OLLAMA / OPENROUTER FALSOS
+# ==========================
+
+def create_fake_upstreams(latency: float = None, token_delay: float = None, tokens: int = None) -> FastAPI:
+    """
+    App ASGI que responde como o Ollama e o OpenRouter.
+    latency: segundos até à primeira resposta; token_delay/tokens: streaming de tokens (pedidos com "stream": true).
+    Valores por omissão vindos de FAKE_UPSTREAM_LATENCY, FAKE_UPSTREAM_TOKEN_DELAY e FAKE_UPSTREAM_TOKENS.
+    """
+    latency = float(os.environ.get("FAKE_UPSTREAM_LATENCY", "0.05")) if latency is None else latency
+    token_delay = float(os.environ.get("FAKE_UPSTREAM_TOKEN_DELAY", "0.01")) if token_delay is None else token_delay
+    tokens = int(os.environ.get("FAKE_UPSTREAM_TOKENS", "40")) if tokens is None else tokens
+    app = FastAPI()
+    words = ["O", "lince-ibérico", "vive", "em", "matagal", "mediterrânico", "e", "caça", "coelhos."]
+
+    def answer() -> list:
+        return [words[i % len(words)] for i in range(tokens)]
+
+    @app.get("/")
+    async def root():
+        return JSONResponse({"status": "ok"})
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency / 5)
+        return JSONResponse({"embedding": fake_embedding(body.get("prompt", ""))})
+
+    @app.post("/api/chat")
+    async def ollama_chat(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency)
+        if body.get("stream"):
+            async def stream():
+                for word in answer():
+                    await asyncio.sleep(token_delay)
+                    yield json.dumps({"message": {"role": "assistant", "content": word + " "}, "done": False}) + "\n"
+                yield json.dumps({"done": True}) + "\n"
+            return StreamingResponse(stream(), media_type="application/x-ndjson")
+        await asyncio.sleep(token_delay * tokens)
+        return JSONResponse({"message": {"role": "assistant", "content": " ".join(answer())}, "done": True})
+
+    @app.post("/api/v1/chat/completions")
+    async def openrouter_chat(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency)
+        if body.get("stream"):
+            async def stream():
+                for word in answer():
+                    await asyncio.sleep(token_delay)
+                    chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(stream(), media_type="text/event-stream")
+        await asyncio.sleep(token_delay * tokens)
+        return JSONResponse({"choices": [{"message": {"role": "assistant", "content": " ".join(answer())}}]})
+
+    return app
@@ -0,0 +1,252 @@
+"""
+Coordenação entre workers do ia_service (uvicorn --workers N / WEB_CONCURRENCY).
+
+- MESSAGE_QUEUE: vazio (um só processo, por omissão), "postgres" (LISTEN/NOTIFY na base de dados do
+  serviço, POSTGRES_*) ou um URL redis://... (Redis ou compatível; requer o pacote redis)
+- Socket.IO: client manager sobre a fila. Emits para um sid ligado a este worker (todas as respostas do
+  chatbot) são entregues diretamente; só emits para salas ou sids de outros workers passam pela fila
+- Invalidação de caches: invalidate(nome) limpa a cache neste worker e publica-a para os restantes,
+  que executam o handler registado com on_invalidate(nome, handler). O endpoint de administração
+  (POST /admin/cache/invalidate) só existe com CACHE_ADMIN_TOKEN definido e exige o cabeçalho X-Admin-Token
+
+Os payloads do NOTIFY estão limitados a 8000 bytes: mensagens maiores são enviadas em partes.
+"""
+import asyncio
+import hmac
+import json
+import os
+import socket
+import time
+from typing import Callable, Dict, Optional
+from uuid import uuid4
+
+import asyncpg
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+from service_log import get_logger
+
+MESSAGE_QUEUE = os.environ.get("MESSAGE_QUEUE", "").strip()
+CACHE_ADMIN_TOKEN = os.environ.get("CACHE_ADMIN_TOKEN", "")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+NOTIFY_MAX_BYTES = 7900
+CHUNK_TTL = 60.0  # segundos até descartar uma mensagem incompleta
+
+logger = get_logger("ia_service.cluster")
+
+
+def postgres_kwargs() -> dict:
+    return {
+        "host": os.environ.get("POSTGRES_HOST"),
+        "port": int(os.environ.get("POSTGRES_PORT", "5432")),
+        "user": os.environ.get("POSTGRES_USER"),
+        "password": os.environ.get("POSTGRES_PASSWORD"),
+        "database": os.environ.get("POSTGRES_DB"),
+    }
+
+
+# ==========================
+# CANAIS (POSTGRES / REDIS)
+# ==========================
+
+def _split(message: str) -> list:
+    """Partes de uma mensagem JSON (ASCII) que cabem no payload do NOTIFY"""
+    if len(message) <= NOTIFY_MAX_BYTES:
+        return [message]
+    size = (NOTIFY_MAX_BYTES - 200) // 2  # Pior caso: cada carácter escapado (\" ou \\) no JSON da parte
+    parts = [message[i:i + size] for i in range(0, len(message), size)]
+    message_id = uuid4().hex
+    return [
+        json.dumps({"__chunk__": message_id, "i": i, "n": len(parts), "d": part})
+        for i, part in enumerate(parts)
+    ]
+
+
+class PostgresChannel:
+    """Canal LISTEN/NOTIFY com uma ligação dedicada (reaberta se cair)"""
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self._conn = None
+        self._queue = asyncio.Queue()
+        self._lock = asyncio.Lock()
+        self._partial: Dict[str, tuple] = {}
+
+    async def _connection(self):
+        async with self._lock:
+            if self._conn is None or self._conn.is_closed():
+                self._conn = await asyncpg.connect(**postgres_kwargs())
+                await self._conn.add_listener(self.channel, self._on_notify)
+            return self._conn
+
+    def _on_notify(self, conn, pid, channel, payload):
+        message = json.loads(payload)
+        if "__chunk__" in message:
+            message = self._reassemble(message)
+        if message is not None:
+            self._queue.put_nowait(message)
+
+    def _reassemble(self, part: dict) -> Optional[dict]:
+        now = time.monotonic()
+        for message_id in [k for k, (created, _) in self._partial.items() if now - created > CHUNK_TTL]:
+            del self._partial[message_id]
+        created, parts = self._partial.setdefault(part["__chunk__"], (now, [None] * part["n"]))
+        parts[part["i"]] = part["d"]
+        if any(p is None for p in parts):
+            return None
+        del self._partial[part["__chunk__"]]
+        return json.loads("".join(parts))
+
+    async def publish(self, data: dict):
+        conn = await self._connection()
+        async with self._lock:  # Uma query de cada vez na ligação
+            for part in _split(json.dumps(data, default=str)):
+                await conn.execute("SELECT pg_notify($1, $2)", self.channel, part)
+
+    async def messages(self):
+        await self._connection()
+        while True:
+            try:
+                yield await asyncio.wait_for(self._queue.get(), timeout=30)
+            except asyncio.TimeoutError:
+                await self._connection()  # Verifica a ligação (e volta a escutar se caiu)
+
+
+class RedisChannel:
+    def __init__(self, url: str, channel: str):
+        import redis.asyncio as redis
+
+        self.channel = channel
+        self.redis = redis.from_url(url)
+
+    async def publish(self, data: dict):
+        await self.redis.publish(self.channel, json.dumps(data, default=str))
+
+    async def messages(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self.channel)
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                yield json.loads(message["data"])
+
+
+def create_channel(name: str):
+    if MESSAGE_QUEUE.startswith(("redis://", "rediss://", "unix://")):
+        return RedisChannel(MESSAGE_QUEUE, name)
+    if MESSAGE_QUEUE.lower() in ("postgres", "postgresql"):
+        return PostgresChannel(name)
+    raise ValueError(f"MESSAGE_QUEUE não suportado: {MESSAGE_QUEUE!r} (use postgres ou redis://...)")
+
+
+# ==========================
+# SOCKET.IO
+# ==========================
+
+class LocalDeliveryMixin:
+    """Emits para um sid ligado a este worker não passam pela fila"""
+
+    async def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if isinstance(room, str) and self.is_connected(room, namespace or "/"):
+            kwargs["ignore_queue"] = True
+        return await super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                                  callback=callback, **kwargs)
+
+
+class RedisManager(LocalDeliveryMixin, socketio.AsyncRedisManager):
+    pass
+
+
+class PostgresManager(LocalDeliveryMixin, AsyncPubSubManager):
+    name = "postgres"
+
+    def __init__(self, channel: str = "ia_socketio", write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.pg = PostgresChannel(channel)
+
+    async def _publish(self, data):
+        await self.pg.publish(data)
+
+    async def _listen(self):
+        async for message in self.pg.messages():
+            yield message
+
+
+def create_client_manager():
+    """Client manager do Socket.IO para MESSAGE_QUEUE (None = só este processo)"""
+    if not MESSAGE_QUEUE:
+        return None
+    if MESSAGE_QUEUE.startswith(("redis://", "rediss://", "unix://")):
+        return RedisManager(MESSAGE_QUEUE, channel="ia_socketio")
+    if MESSAGE_QUEUE.lower() in ("postgres", "postgresql"):
+        return PostgresManager()
+    raise ValueError(f"MESSAGE_QUEUE não suportado: {MESSAGE_QUEUE!r} (use postgres ou redis://...)")
+
+
+# ==========================
+# INVALIDAÇÃO DE CACHES
+# ==========================
+
+_handlers: Dict[str, Callable[[], None]] = {}
+_channel = None
+_listener_task = None
+
+
+def authorized(headers) -> bool:
+    """Pedidos de administração das caches: só com CACHE_ADMIN_TOKEN definido e o cabeçalho X-Admin-Token igual"""
+    if not CACHE_ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(headers.get("x-admin-token", ""), CACHE_ADMIN_TOKEN)
+
+
+def on_invalidate(cache: str, handler: Callable[[], None]):
+    _handlers[cache] = handler
+
+
+def _apply(cache: str):
+    names = list(_handlers) if cache == "all" else [cache]
+    for name in names:
+        handler = _handlers.get(name)
+        if handler is not None:
+            handler()
+    return names
+
+
+async def invalidate(cache: str) -> list:
+    """Invalida a cache neste worker e nos restantes; devolve as caches invalidadas"""
+    if cache != "all" and cache not in _handlers:
+        raise KeyError(cache)
+    names = _apply(cache)
+    if _channel is not None:
+        await _channel.publish({"cache": cache, "origin": WORKER_ID})
+    logger.info("cache_invalidated", extra={"cache": cache, "propagated": _channel is not None})
+    return names
+
+
+async def _listen():
+    while True:
+        try:
+            async for message in _channel.messages():
+                if message.get("origin") != WORKER_ID:
+                    _apply(message.get("cache", ""))
+                    logger.info("cache_invalidated_remote", extra={"cache": message.get("cache"), "origin": message.get("origin")})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("invalidation_listener_failed", extra={"error": str(e)})
+            await asyncio.sleep(1)
+
+
+async def start():
+    """Começa a escutar invalidações dos outros workers (sem MESSAGE_QUEUE não faz nada)"""
+    global _channel, _listener_task
+    if MESSAGE_QUEUE and _listener_task is None:
+        _channel = create_channel("ia_cache_invalidation")
+        _listener_task = asyncio.create_task(_listen())
+
+
+async def stop():
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        _listener_task = None
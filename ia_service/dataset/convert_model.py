@@ -0,0 +1,30 @@
+"""
+Converte modelos de espécies guardados inteiros (torch.save(model), formato anterior) para ficheiros só
+com pesos (state_dict), o formato que o serviço carrega com weights_only=True e memory-mapped.
+O original fica em <modelo>.module. O serviço recusa modelos no formato antigo (carregá-los exigiria
+weights_only=False, que executa código do ficheiro): converter uma vez antes do deploy.
+
+Uso (no diretório ia_service/): python -m dataset.convert_model [species_model.pt ...]
+"""
+import pickle
+import sys
+
+import torch
+
+from dataset.embedding_index import convert_pickled_model
+
+
+def main(paths):
+    for path in paths:
+        try:
+            torch.load(path, map_location="cpu", weights_only=True)
+            print(f"{path}: já contém só pesos")
+            continue
+        except pickle.UnpicklingError:
+            pass
+        state_dict = convert_pickled_model(path)
+        print(f"{path}: convertido ({len(state_dict)} tensores; original em {path}.module)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ["species_model.pt"])
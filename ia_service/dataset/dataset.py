@@ -1,184 +1,225 @@
 import os
 import json
-import requests
-import uuid
+import asyncio
 from pathlib import Path
 from collections import defaultdict
 
+from downloader import AsyncDownloader, ResumableWorkQueue
+from manifest import JsonlManifest, atomic_write_json
+from image_store import ContentAddressedStore
+
 # CONFIGURAÇÕES
-BASE_URL = "https://api.inaturalist.org/v1/observations/species_counts?locale=pt&verifiable=true&photos=true&is_atice=true&hrank=kingdom&iconic_taxa%5B%5D={GROUP}&lrank=species&place_id=7122&per_page=200&page={page}&order_by=votes&order=desc&spam=false"
+# URL base da API (pode apontar para um servidor local que simule o iNaturalist)
+INATURALIST_API_URL = os.environ.get("INATURALIST_API_URL", "https://api.inaturalist.org/v1")
+BASE_URL = INATURALIST_API_URL + "/observations/species_counts?locale=pt&verifiable=true&photos=true&is_atice=true&hrank=kingdom&iconic_taxa%5B%5D={GROUP}&lrank=species&place_id=7122&per_page=200&page={page}&order_by=votes&order=desc&spam=false"
+OBSERVATIONS_URL = INATURALIST_API_URL + "/observations?taxon_id={taxon_id}&preferred_place_id=7122&order_by=votes&quality_grade=research&photos=true&page=&per_page={per_page}"
 DATASET_DIR = Path("dataset")
-ANNOTATIONS_JSON = "annotations.json"
-TRAIN_JSON = "train.json"
+# Manifestos append-only (JSONL); os .json legados são convertidos na primeira execução
+ANNOTATIONS_JSONL = "annotations.jsonl"
+TRAIN_JSONL = "train.jsonl"
+LEGACY_ANNOTATIONS_JSON = "annotations.json"
+LEGACY_TRAIN_JSON = "train.json"
 PROGRESS_JSON = "progress.json"
+COMPACT_EVERY_PAGES = 10  # Compactação periódica dos manifestos
+IMAGE_INDEX_JSONL = "image_index.jsonl"  # Índice de hashes das imagens (persistente entre execuções)
+PHASH_DEDUP = True  # Filtro de quase-duplicados por hash percetual
+PHASH_THRESHOLD = 4  # Distância de Hamming máxima (em 64 bits) para considerar quase-duplicado
+DONE_TAXA_PATH = "downloaded_taxa.txt"  # Fila retomável: espécies já descarregadas
 GROUP = "Aves"  # Grupo taxonómico a processar
 DOWNLOAD_IMAGES = True
-DOWNLOAD_DELAY = 1.0  # segundos entre downloads
-
-def download_simple_species_photos(taxon_id, group, max_photos=50, base_dir="dataset", train_images_set=None):
-    url = f"https://api.inaturalist.org/v1/observations?taxon_id={taxon_id}&preferred_place_id=7122&order_by=votes&quality_grade=research&photos=true&page=&per_page={max_photos*4}"
-    try:
-        resp = requests.get(url)
-        resp.raise_for_status()
-        data = resp.json()
-    except Exception as e:
-        print(f"[ERRO] Falha ao obter observações para taxon {taxon_id}: {e}")
-        return []
-
-    img_paths = []
-    dir_path = os.path.join(base_dir, group, taxon_id)
-    os.makedirs(dir_path, exist_ok=True)
-    downloaded_urls = set()
-
+RATE_LIMIT = float(os.environ.get("DATASET_RATE_LIMIT", "2.0"))  # pedidos por segundo (global)
+MAX_CONCURRENCY = int(os.environ.get("DATASET_MAX_CONCURRENCY", "8"))  # pedidos HTTP em simultâneo
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get("DATASET_MAX_CONNECTIONS_PER_HOST", "4"))
+SPECIES_WORKERS = int(os.environ.get("DATASET_SPECIES_WORKERS", "4"))  # espécies processadas em paralelo
+MAX_RETRIES = int(os.environ.get("DATASET_MAX_RETRIES", "4"))
+
+async def download_simple_species_photos(downloader, store, taxon_id, group, max_photos=50):
+    """
+    Descarrega até `max_photos` fotos de uma espécie em paralelo e guarda-as no armazenamento
+    endereçado por conteúdo. URLs já indexados não são descarregados e duplicados não são guardados.
+    Devolve a lista de caminhos relativos novos, ou None se não foi possível obter as observações.
+    """
+    url = OBSERVATIONS_URL.format(taxon_id=taxon_id, per_page=max_photos * 4)
+    data = await downloader.get_json(url)
+    if data is None:
+        print(f"[ERRO] Falha ao obter observações para taxon {taxon_id}")
+        return None
+
+    # Seleciona URLs únicos (até max_photos) antes de descarregar
+    img_urls = []
     for obs in data.get("results", []):
         taxon = obs.get("taxon", {})
         default_photo = taxon.get("default_photo", {})
         img_url = default_photo.get("medium_url")
-        if img_url and img_url not in downloaded_urls:
-            img_filename = f"default_{len(img_paths)}_{uuid.uuid4().hex}.jpg"
-            rel_path = os.path.join(group, taxon_id, img_filename)
-            img_path = os.path.join(dir_path, img_filename)
-            if train_images_set and rel_path in train_images_set:
-                continue
-            try:
-                r = requests.get(img_url, timeout=10)
-                if r.status_code == 200:
-                    with open(img_path, "wb") as f:
-                        f.write(r.content)
-                    print(f"[IMG] {img_url} -> {img_path}")
-                    img_paths.append(rel_path)
-                    downloaded_urls.add(img_url)
-                else:
-                    print(f"[ERRO] {img_url} - HTTP {r.status_code}")
-            except Exception as e:
-                print(f"[ERRO] {img_url} - {e}")
-            if len(img_paths) >= max_photos:
-                break
-    return img_paths
-
-# Inicializa ficheiro de progresso se não existir
-if not Path(PROGRESS_JSON).exists():
-    with open(PROGRESS_JSON, "w", encoding="utf-8") as f:
-        json.dump({
-            "page": 1,
-            "last_page": 50,
-            "species_per_group": {},
-            "total_species": 0
-        }, f, ensure_ascii=False, indent=2)
-
-# Carrega progresso
-with open(PROGRESS_JSON, encoding="utf-8") as f:
-    progress = json.load(f)
-
-page = progress["page"]
-last_page = progress["last_page"]
-species_per_group = defaultdict(int, progress.get("species_per_group", {}))
-total_species = progress.get("total_species", 0)
-species_ids = set(progress.get("species_ids", []))
-
-# Carrega annotations e train se existirem
-if Path(ANNOTATIONS_JSON).exists():
-    with open(ANNOTATIONS_JSON, encoding="utf-8") as f:
-        annotations = json.load(f)
-else:
-    annotations = {}
-
-if Path(TRAIN_JSON).exists():
-    with open(TRAIN_JSON, encoding="utf-8") as f:
-        train_entries = json.load(f)
-else:
-    train_entries = []
-
-train_images_set = set(e["image"] for e in train_entries)
-
-try:
-    while page <= last_page:
-        url = BASE_URL.format(GROUP=GROUP, page=page)
-        print(f"\n[INFO] A processar página {page}: {url}")
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            print(f"[ERRO] Falha ao obter página {page}: HTTP {resp.status_code}")
+        if img_url and img_url not in img_urls:
+            img_urls.append(img_url)
+        if len(img_urls) >= max_photos:
             break
-        data = resp.json()
-        results = data.get("results", [])
-        if not results:
-            print("[INFO] Não há mais resultados.")
-            break
-
-        for item in results:
-            t = item["taxon"] if "taxon" in item else item
-            taxon_id = str(t["id"])
-            group = t.get("iconic_taxon_name", "Unknown")
-            sci_name = t.get("name")
-            common_name = t.get("preferred_common_name")
-            wikipedia_url = t.get("wikipedia_url")
-
-            # Atualizar annotations
-            if taxon_id not in annotations:
-                annotations[taxon_id] = {
-                    "taxon_id": taxon_id,
-                    "sci_name": sci_name,
-                    "common_name": common_name,
-                    "group": group,
-                    "wikipedia_url": wikipedia_url
-                }
-                species_per_group[group] += 1
-                total_species += 1
-                species_ids.add(taxon_id)
-
-            # Download até 50 fotos reais da espécie e adiciona ao train.json
-            fotos_desc = []
-            if DOWNLOAD_IMAGES:
-                fotos_desc = download_simple_species_photos(
-                    taxon_id, group, max_photos=50, base_dir=DATASET_DIR, train_images_set=train_images_set
-                )
-                if not fotos_desc:
-                    print(f"[INFO] Sem fotos reais para {sci_name} ({taxon_id}), a espécie será ignorada.")
-                    continue  # Salta para a próxima espécie
-                for rel_path in fotos_desc:
-                    rel_path_str = str(rel_path)
-                    if rel_path_str not in train_images_set:
-                        entry = {
-                            "image": rel_path_str,
-                            "label": taxon_id
-                        }
-                        train_entries.append(entry)
-                        train_images_set.add(rel_path_str)
 
+    async def fetch(img_url):
+        if store.has_url(img_url):
+            return None
+        content = await downloader.get_bytes(img_url)
+        if content is None:
+            return None
+        rel_path = store.add(content, group, taxon_id, url=img_url)
+        if rel_path is None:
+            print(f"[IMG] {img_url} -> duplicado, ignorado")
+            return None
+        print(f"[IMG] {img_url} -> {rel_path}")
+        return rel_path
+
+    results = await asyncio.gather(*(fetch(u) for u in img_urls))
+    return [rel_path for rel_path in results if rel_path]
+
+def save_progress(page, last_page, species_per_group, total_species):
+    """Checkpoint atómico (a lista de espécies vive no manifesto de anotações)"""
+    atomic_write_json(PROGRESS_JSON, {
+        "page": page,
+        "last_page": last_page,
+        "species_per_group": dict(species_per_group),
+        "total_species": total_species
+    })
+
+def checkpoint(manifests, page, last_page, species_per_group, total_species, compact=False):
+    for manifest in manifests:
+        if compact:
+            manifest.compact()
+        else:
+            manifest.sync()
+    save_progress(page, last_page, species_per_group, total_species)
+
+async def main():
+    # Inicializa ficheiro de progresso se não existir
+    if not Path(PROGRESS_JSON).exists():
+        save_progress(1, 50, {}, 0)
+
+    # Carrega progresso
+    with open(PROGRESS_JSON, encoding="utf-8") as f:
+        progress = json.load(f)
+
+    page = progress["page"]
+    last_page = progress["last_page"]
+    species_per_group = defaultdict(int, progress.get("species_per_group", {}))
+    total_species = progress.get("total_species", 0)
+
+    # Manifestos append-only (converte annotations.json/train.json legados se necessário)
+    annotations = JsonlManifest(ANNOTATIONS_JSONL, key="taxon_id")
+    annotations.migrate_from(LEGACY_ANNOTATIONS_JSON)
+    train_manifest = JsonlManifest(TRAIN_JSONL, key="image")
+    train_manifest.migrate_from(LEGACY_TRAIN_JSON)
+    manifests = (annotations, train_manifest)
+
+    # Só as chaves ficam em memória
+    known_taxa = annotations.keys()
+    train_images_set = train_manifest.keys()
+    work_queue = ResumableWorkQueue(DONE_TAXA_PATH, workers=SPECIES_WORKERS)
+
+    # Armazenamento por hash; na primeira execução indexa as imagens já existentes
+    first_index = not Path(IMAGE_INDEX_JSONL).exists()
+    store = ContentAddressedStore(DATASET_DIR, IMAGE_INDEX_JSONL, phash_enabled=PHASH_DEDUP, phash_threshold=PHASH_THRESHOLD)
+    if first_index:
+        duplicates = store.index_directory()
+        print(f"[INFO] Índice de imagens criado: {len(store.by_sha)} imagens, {duplicates} duplicados existentes")
+    manifests += (store.index,)
+
+    async with AsyncDownloader(
+        rate_per_second=RATE_LIMIT,
+        max_concurrency=MAX_CONCURRENCY,
+        max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+        max_retries=MAX_RETRIES,
+    ) as downloader:
+
+        async def process_species(species):
+            taxon_id, group, sci_name = species
+            # Download até 50 fotos reais da espécie e adiciona ao train.jsonl
+            fotos_desc = await download_simple_species_photos(
+                downloader, store, taxon_id, group, max_photos=50
+            )
+            if fotos_desc is None:
+                return False  # Fica pendente para a próxima execução
+            if not fotos_desc:
+                print(f"[INFO] Sem fotos novas para {sci_name} ({taxon_id}).")
+                return True
+            # As entradas são acrescentadas ao manifesto antes de a espécie ser marcada como concluída
+            new_entries = []
+            for rel_path in fotos_desc:
+                rel_path_str = str(rel_path)
+                if rel_path_str not in train_images_set:
+                    new_entries.append({
+                        "image": rel_path_str,
+                        "label": taxon_id
+                    })
+                    train_images_set.add(rel_path_str)
+            train_manifest.append_many(new_entries)
             print(f"[INFO] {len(fotos_desc)} fotos reais guardadas para {sci_name} ({taxon_id})")
-
-        # Mostrar resumo
-        print(f"[RESUMO] Página {page} processada.")
-        for g, n in species_per_group.items():
-            print(f"  {g}: {n} espécies")
-        print(f"  Total acumulado: {total_species} espécies")
-
-        # Guardar progresso e ficheiros
-        with open(ANNOTATIONS_JSON, "w", encoding="utf-8") as f:
-            json.dump(annotations, f, ensure_ascii=False, indent=2)
-        with open(TRAIN_JSON, "w", encoding="utf-8") as f:
-            json.dump(train_entries, f, ensure_ascii=False, indent=2)
-        with open(PROGRESS_JSON, "w", encoding="utf-8") as f:
-            json.dump({
-                "page": page + 1,
-                "last_page": last_page,
-                "species_per_group": dict(species_per_group),
-                "total_species": total_species,
-                "species_ids": list(species_ids)
-            }, f, ensure_ascii=False, indent=2)
-
-        page += 1
-
-except KeyboardInterrupt:
-    print("\n[INFO] Interrompido pelo utilizador. Progresso guardado.")
-    with open(PROGRESS_JSON, "w", encoding="utf-8") as f:
-        json.dump({
-            "page": page,
-            "last_page": last_page,
-            "species_per_group": dict(species_per_group),
-            "total_species": total_species,
-            "species_ids": list(species_ids)
-        }, f, ensure_ascii=False, indent=2)
-    print(f"[INFO] Podes retomar a partir da página {page}.")
-
-print("\n[INFO] Script terminado.")
\ No newline at end of file
+            return True
+
+        try:
+            while page <= last_page:
+                url = BASE_URL.format(GROUP=GROUP, page=page)
+                print(f"\n[INFO] A processar página {page}: {url}")
+                data = await downloader.get_json(url)
+                if data is None:
+                    print(f"[ERRO] Falha ao obter página {page}")
+                    break
+                results = data.get("results", [])
+                if not results:
+                    print("[INFO] Não há mais resultados.")
+                    break
+
+                jobs = []
+                new_annotations = []
+                for item in results:
+                    t = item["taxon"] if "taxon" in item else item
+                    taxon_id = str(t["id"])
+                    group = t.get("iconic_taxon_name", "Unknown")
+                    sci_name = t.get("name")
+
+                    # Atualizar annotations
+                    if taxon_id not in known_taxa:
+                        new_annotations.append({
+                            "taxon_id": taxon_id,
+                            "sci_name": sci_name,
+                            "common_name": t.get("preferred_common_name"),
+                            "group": group,
+                            "wikipedia_url": t.get("wikipedia_url")
+                        })
+                        known_taxa.add(taxon_id)
+                        species_per_group[group] += 1
+                        total_species += 1
+                    jobs.append((taxon_id, (taxon_id, group, sci_name)))
+                annotations.append_many(new_annotations)
+
+                # Espécies da página descarregadas em paralelo (as já concluídas são saltadas)
+                if DOWNLOAD_IMAGES:
+                    await work_queue.run(jobs, process_species)
+
+                # Mostrar resumo
+                print(f"[RESUMO] Página {page} processada.")
+                for g, n in species_per_group.items():
+                    print(f"  {g}: {n} espécies")
+                print(f"  Total acumulado: {total_species} espécies")
+                print(f"  Duplicados ignorados: {store.duplicates_skipped} ({store.bytes_saved / 1e6:.1f} MB poupados)")
+
+                # Checkpoint (com compactação periódica dos manifestos)
+                checkpoint(manifests, page + 1, last_page, species_per_group, total_species,
+                           compact=page % COMPACT_EVERY_PAGES == 0)
+
+                page += 1
+
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print("\n[INFO] Interrompido pelo utilizador. Progresso guardado.")
+            # As espécies já concluídas nesta página ficam registadas na fila retomável
+            checkpoint(manifests, page, last_page, species_per_group, total_species)
+            print(f"[INFO] Podes retomar a partir da página {page}.")
+            return
+
+    checkpoint(manifests, page, last_page, species_per_group, total_species, compact=True)
+    print("\n[INFO] Script terminado.")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
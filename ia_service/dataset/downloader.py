@@ -0,0 +1,180 @@
+"""
+Motor de download assíncrono para a construção do dataset (API iNaturalist).
+
+- Limite global de pedidos por segundo (token bucket), partilhado por todos os pedidos
+- Pool de ligações httpx reutilizado, com limite de ligações simultâneas por host
+- Concorrência total limitada
+- Retentativas com backoff exponencial (respeita Retry-After em HTTP 429/503)
+- Fila de trabalho retomável: as tarefas concluídas ficam registadas em disco
+
+O URL base da API é configurável (INATURALIST_API_URL), pelo que o motor pode
+ser apontado para um servidor HTTP local que simule a API do iNaturalist
+(ver ia_service/tests/test_downloader.py: 429/5xx, Retry-After, respostas truncadas, retoma).
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+# Estados HTTP que justificam nova tentativa
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Limitador de taxa global: `rate` pedidos por segundo com rajadas até `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncDownloader:
+    """Cliente HTTP assíncrono com limite de taxa, concorrência limitada e retentativas"""
+
+    def __init__(
+        self,
+        rate_per_second: float = 2.0,
+        max_concurrency: int = 8,
+        max_connections_per_host: int = 4,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        timeout: float = 15.0,
+    ):
+        self.bucket = TokenBucket(rate_per_second)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_connections_per_host = max_connections_per_host
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+            headers={"User-Agent": "NaturaDetec-dataset/1.0"},
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self.host_semaphores[host]
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff_base * (2 ** attempt) + random.uniform(0, self.backoff_base)
+
+    async def get(self, url: str) -> Optional[httpx.Response]:
+        """GET com retentativas; devolve a última resposta (ou None se todas as tentativas falharem na ligação)"""
+        response = None
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            error = None
+            async with self.semaphore, self._host_semaphore(url):
+                try:
+                    response = await self.client.get(url)
+                except httpx.TransportError as e:
+                    response, error = None, e
+            if response is not None and response.status_code not in RETRY_STATUS:
+                return response
+            if attempt < self.max_retries:
+                reason = error if error is not None else f"HTTP {response.status_code}"
+                delay = self._backoff(attempt, response)
+                print(f"[AVISO] {url} - {reason}, nova tentativa em {delay:.1f}s")
+                await asyncio.sleep(delay)
+        return response
+
+    async def get_json(self, url: str) -> Optional[dict]:
+        response = await self.get(url)
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else "sem ligação"
+            print(f"[ERRO] {url} - {status}")
+            return None
+        return response.json()
+
+    async def get_bytes(self, url: str) -> Optional[bytes]:
+        response = await self.get(url)
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else "sem ligação"
+            print(f"[ERRO] {url} - {status}")
+            return None
+        return response.content
+
+
+class ResumableWorkQueue:
+    """
+    Fila de tarefas com N workers assíncronos.
+    As chaves das tarefas concluídas são acrescentadas a `done_path` (uma por linha),
+    pelo que uma execução interrompida retoma apenas as tarefas em falta.
+    """
+
+    def __init__(self, done_path: str, workers: int = 4):
+        self.done_path = done_path
+        self.workers = workers
+        self.done = set()
+        if os.path.exists(done_path):
+            with open(done_path, encoding="utf-8") as f:
+                self.done = {line.strip() for line in f if line.strip()}
+
+    def is_done(self, key: str) -> bool:
+        return key in self.done
+
+    def mark_done(self, key: str):
+        self.done.add(key)
+        with open(self.done_path, "a", encoding="utf-8") as f:
+            f.write(key + "\n")
+
+    async def run(self, items: Iterable[Tuple[str, object]], handler: Callable[[object], Awaitable[bool]]):
+        """Executa `handler(item)` para cada (chave, item) pendente; só marca como concluído se devolver True"""
+        queue: asyncio.Queue = asyncio.Queue()
+        for key, item in items:
+            if not self.is_done(key):
+                queue.put_nowait((key, item))
+
+        async def worker():
+            while True:
+                key, item = await queue.get()
+                try:
+                    if await handler(item):
+                        self.mark_done(key)
+                except Exception as e:
+                    print(f"[ERRO] Tarefa {key} falhou: {e}")
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            await queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,182 @@
+"""
+Índice de embeddings das imagens de treino/validação para pesquisa por imagem (open-set).
+
+- Embedding = saída da penúltima camada (avgpool, 512 dimensões) do modelo de espécies, normalizada (L2)
+- Um único forward devolve os logits do classificador e o embedding (resnet_forward)
+- O índice é um array float32 memory-mapped (N, 512) + metadados (imagem, classe, split);
+  a pesquisa é produto interno (similaridade de cosseno) sobre o memmap com argpartition
+- O sha256 dos pesos usados na construção fica nos metadados: um índice construído com outro
+  modelo é detetado e não é usado
+
+Estrutura do índice:
+    <index_dir>/embeddings_f32.npy
+    <index_dir>/index_meta.json
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+EMBEDDINGS_FILE = "embeddings_f32.npy"
+META_FILE = "index_meta.json"
+
+# Mesmo pré-processamento do serviço (/identify_species)
+index_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_resnet18(path: str, mmap: bool = False) -> torch.nn.Module:
+    """
+    Reconstrói a ResNet18 a partir de um ficheiro só com pesos (state_dict ou checkpoint de treino).
+    Com mmap, os pesos ficam mapeados do ficheiro (copy-on-write) em vez de copiados para a memória do
+    processo: vários workers partilham as mesmas páginas da cache do sistema operativo.
+    Um modelo guardado inteiro (torch.save(model), formato anterior) não é carregado: exigiria
+    weights_only=False. Converte-se uma vez, offline, com dataset/convert_model.py.
+    """
+    try:
+        state_dict = torch.load(path, map_location=torch.device("cpu"), weights_only=True, mmap=mmap)
+    except pickle.UnpicklingError as e:
+        raise ValueError(
+            f"{path} contém um modelo guardado inteiro (formato antigo): converte-o para state_dict com "
+            f"`python -m dataset.convert_model {path}` (no diretório ia_service)"
+        ) from e
+    if "model_state" in state_dict:  # Checkpoint de treino (checkpoints/last.pt)
+        state_dict = state_dict["model_state"]
+    model = torchvision.models.resnet18(weights=None)
+    model.fc = torch.nn.Linear(model.fc.in_features, state_dict["fc.weight"].shape[0])
+    model.load_state_dict(state_dict, assign=mmap)  # assign: usa os tensores mapeados em vez de os copiar
+    return model.eval()
+
+
+def convert_pickled_model(path: str, write: bool = True) -> dict:
+    """
+    Extrai o state_dict de um modelo guardado inteiro e, com write, substitui o ficheiro por um só com
+    pesos (conversão única; o original fica em <path>.module). Só para o convert_model.py (offline): o
+    unpickling completo executa código do ficheiro, usar só com modelos de confiança.
+    """
+    module = torch.load(path, map_location=torch.device("cpu"), weights_only=False)
+    state_dict = module.state_dict() if isinstance(module, torch.nn.Module) else module
+    if write:
+        if not os.path.exists(path + ".module"):
+            shutil.copy2(path, path + ".module")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, path)
+    return state_dict
+
+
+def resnet_forward(model: torch.nn.Module, batch: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Forward da ResNet que devolve (logits, embedding da penúltima camada) numa única passagem"""
+    x = model.maxpool(model.relu(model.bn1(model.conv1(batch))))
+    x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+    embedding = torch.flatten(model.avgpool(x), 1)
+    return model.fc(embedding), embedding
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class _ImageList(Dataset):
+    def __init__(self, paths: List[str]):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        with Image.open(self.paths[idx]) as image:
+            return index_transform(image.convert("RGB"))
+
+
+def build_index(model_path: str, data_dir: str, splits: List[Tuple[str, str]], index_dir: str,
+                batch_size: int = 64, num_workers: int = 0) -> int:
+    """
+    Constrói o índice a partir dos manifestos de split (lista de {"image", "label"} relativos a `data_dir`).
+    `splits` = [(nome do split, caminho do manifesto)]. Devolve o número de imagens indexadas.
+    """
+    entries = []
+    for split, manifest_path in splits:
+        with open(manifest_path, encoding="utf-8") as f:
+            for entry in json.load(f):
+                entries.append({"image": entry["image"], "label": str(entry["label"]), "split": split})
+
+    model = load_resnet18(model_path)
+    os.makedirs(index_dir, exist_ok=True)
+    embeddings_path = os.path.join(index_dir, EMBEDDINGS_FILE)
+    tmp_path = embeddings_path + ".tmp"
+    embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(entries), 512))
+
+    loader = DataLoader(_ImageList([os.path.join(data_dir, e["image"]) for e in entries]),
+                        batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    done = 0
+    with torch.no_grad():
+        for batch in loader:
+            _, embedding = resnet_forward(model, batch)
+            embeddings[done:done + len(batch)] = normalize(embedding.numpy())
+            done += len(batch)
+            print(f"[INDEX] {done}/{len(entries)} imagens indexadas")
+    embeddings.flush()
+    del embeddings
+
+    meta_path = os.path.join(index_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    os.replace(tmp_path, embeddings_path)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"model_sha256": file_sha256(model_path), "entries": entries}, f, ensure_ascii=False)
+    return len(entries)
+
+
+class EmbeddingIndex:
+    def __init__(self, index_dir: str):
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.model_sha256: Optional[str] = meta.get("model_sha256")
+        self.entries: List[dict] = meta["entries"]
+        # mmap só de leitura: as páginas são partilhadas entre processos e só carregadas quando usadas
+        self.embeddings = np.load(os.path.join(index_dir, EMBEDDINGS_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, embedding: np.ndarray, top_k: int = 5) -> List[Tuple[int, float]]:
+        """Devolve [(linha, similaridade de cosseno)] por ordem decrescente"""
+        if not len(self.entries):
+            return []
+        query = normalize(np.asarray(embedding, dtype=np.float32).reshape(-1))
+        scores = self.embeddings @ query
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(row), float(scores[row])) for row in best]
+
+
+if __name__ == "__main__":
+    # Corre no diretório dataset/ depois do model.py (usa os splits e os pesos gerados no treino)
+    import sys
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "species_model.pt"
+    index_dir = sys.argv[2] if len(sys.argv) > 2 else "species_index"
+    total = build_index(model_path, "train_val/Aves", [("train", "train_clean.json"), ("val", "val.json")], index_dir)
+    print(f"[INDEX] Índice criado em {index_dir} com {total} imagens")
@@ -0,0 +1,143 @@
+"""
+Cache de embeddings do backbone congelado (ResNet18 pré-treinada no ImageNet).
+
+O backbone corre UMA vez sobre o dataset. As features de 512 dimensões (penúltima camada) ficam num
+array float32 memory-mapped, e treinar apenas a camada `fc` sobre elas demora segundos. Ao acrescentar
+espécies só as imagens novas passam pelo backbone: as linhas já calculadas são reutilizadas pelo caminho
+da imagem (os nomes são o sha256 do conteúdo, por isso o caminho identifica a imagem).
+
+Estrutura da cache:
+    <cache_dir>/features_f32.npy   features (N, 512), pela ordem de dataset.samples
+    <cache_dir>/meta.json          backbone e caminhos das imagens (uma entrada por linha)
+"""
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+from torchvision import models
+
+FEATURES_FILE = "features_f32.npy"
+META_FILE = "meta.json"
+FEATURE_DIM = 512
+BACKBONE = "resnet18-IMAGENET1K_V1"
+
+
+def build_backbone() -> nn.Module:
+    """ResNet18 pré-treinada sem a camada de classificação (devolve o vetor de 512 dimensões)"""
+    model = models.resnet18(weights="IMAGENET1K_V1")
+    model.fc = nn.Identity()
+    return model.eval()
+
+
+def _load_meta(cache_dir: str) -> Optional[dict]:
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path) or not os.path.exists(os.path.join(cache_dir, FEATURES_FILE)):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    return meta if meta.get("backbone") == BACKBONE else None
+
+
+def extract_features(dataset, cache_dir: str, backbone: Optional[nn.Module] = None, batch_size: int = 64,
+                     num_workers: int = 0, device: Optional[torch.device] = None) -> Tuple[np.ndarray, int]:
+    """
+    Devolve (features memory-mapped alinhadas com dataset.samples, número de imagens novas extraídas).
+    `dataset` tem de expor `samples` (caminho, label) e devolver tensores normalizados como no treino.
+    """
+    device = device or torch.device("cpu")
+    paths: List[str] = [path for path, _ in dataset.samples]
+    os.makedirs(cache_dir, exist_ok=True)
+    features_path = os.path.join(cache_dir, FEATURES_FILE)
+    meta_path = os.path.join(cache_dir, META_FILE)
+
+    meta = _load_meta(cache_dir)
+    if meta is not None and meta["samples"] == paths:
+        return np.load(features_path, mmap_mode="r"), 0
+
+    # Linhas reutilizáveis da cache anterior
+    old_rows = {path: row for row, path in enumerate(meta["samples"])} if meta else {}
+    src, dst, missing = [], [], []
+    for row, path in enumerate(paths):
+        if path in old_rows:
+            src.append(old_rows[path])
+            dst.append(row)
+        else:
+            missing.append(row)
+
+    tmp_path = features_path + ".tmp"
+    features = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(paths), FEATURE_DIM))
+    if src:
+        old = np.load(features_path, mmap_mode="r")
+        features[dst] = old[src]
+        del old
+
+    if missing:
+        backbone = (backbone or build_backbone()).to(device).eval()
+        loader = DataLoader(Subset(dataset, missing), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        done = 0
+        with torch.no_grad():
+            for imgs, _ in loader:
+                batch = backbone(imgs.to(device)).float().cpu().numpy()
+                features[missing[done:done + len(batch)]] = batch
+                done += len(batch)
+                print(f"[FEAT] {done}/{len(missing)} imagens novas processadas pelo backbone")
+    features.flush()
+    del features
+
+    # O meta.json antigo é removido antes da troca: uma cache interrompida nunca fica desalinhada
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    os.replace(tmp_path, features_path)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"backbone": BACKBONE, "samples": paths}, f, ensure_ascii=False)
+    return np.load(features_path, mmap_mode="r"), len(missing)
+
+
+def train_head(features: np.ndarray, labels: Sequence[int], train_idx: Sequence[int], val_idx: Sequence[int],
+               num_classes: int, epochs: int = 100, lr: float = 1e-3, batch_size: int = 256,
+               patience: int = 10, seed: int = 42) -> Tuple[dict, float]:
+    """
+    Treina uma camada linear (a `fc` da ResNet18) sobre as features em cache.
+    Devolve (state_dict da melhor `fc` pela accuracy de validação, melhor accuracy).
+    """
+    torch.manual_seed(seed)
+    labels = torch.as_tensor(np.asarray(labels), dtype=torch.long)
+    train_idx = np.asarray(train_idx)
+    val_idx = np.asarray(val_idx)
+    x_train = torch.from_numpy(np.ascontiguousarray(features[train_idx]))
+    y_train = labels[train_idx]
+    x_val = torch.from_numpy(np.ascontiguousarray(features[val_idx]))
+    y_val = labels[val_idx]
+
+    head = nn.Linear(FEATURE_DIM, num_classes)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr)
+
+    best_state, best_acc, epochs_without_improvement = None, -1.0, 0
+    for epoch in range(epochs):
+        head.train()
+        permutation = torch.randperm(len(x_train))
+        for start in range(0, len(x_train), batch_size):
+            batch = permutation[start:start + batch_size]
+            optimizer.zero_grad(set_to_none=True)
+            loss = criterion(head(x_train[batch]), y_train[batch])
+            loss.backward()
+            optimizer.step()
+
+        head.eval()
+        with torch.no_grad():
+            val_acc = (head(x_val).argmax(1) == y_val).float().mean().item() if len(x_val) else 0.0
+        if val_acc > best_acc:
+            best_acc = val_acc
+            best_state = {k: v.clone() for k, v in head.state_dict().items()}
+            epochs_without_improvement = 0
+        else:
+            epochs_without_improvement += 1
+        if epochs_without_improvement >= patience:
+            print(f"[FEAT] Early stopping da camada fc na época {epoch + 1}")
+            break
+    return best_state, best_acc
@@ -0,0 +1,156 @@
+"""
+Armazenamento de imagens do dataset endereçado por conteúdo.
+
+- Cada imagem é guardada como <grupo>/<taxon_id>/<sha256>.jpg: a mesma foto nunca é guardada duas vezes
+- Índice persistente (image_index.jsonl) com hash, URL de origem e hash percetual, partilhado entre execuções
+- URLs já indexados não voltam a ser descarregados
+- Filtro opcional de quase-duplicados por hash percetual (dHash de 64 bits, requer Pillow)
+"""
+import hashlib
+import io
+import os
+from typing import Dict, List, Optional
+
+from manifest import JsonlManifest
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow é opcional: sem ele o filtro percetual fica desativado
+    Image = None
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def perceptual_hash(content: bytes) -> Optional[int]:
+    """dHash: compara píxeis adjacentes de uma miniatura 9x8 em tons de cinzento (64 bits)"""
+    if Image is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(content)).convert("L").resize((9, 8))
+    except Exception:
+        return None
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+class ContentAddressedStore:
+    def __init__(self, base_dir: str, index_path: str = "image_index.jsonl",
+                 phash_enabled: bool = True, phash_threshold: int = 4):
+        self.base_dir = str(base_dir)
+        self.index = JsonlManifest(index_path, key="sha256")
+        self.phash_enabled = phash_enabled and Image is not None
+        self.phash_threshold = phash_threshold
+        self.by_sha: Dict[str, str] = {}
+        self.paths = set()
+        self.urls = set()
+        self.phashes_by_label: Dict[str, List[int]] = {}
+        self.duplicates_skipped = 0
+        self.bytes_saved = 0
+        for record in self.index:
+            self._remember(record)
+
+    def _remember(self, record: dict):
+        self.by_sha[record["sha256"]] = record["image"]
+        self.paths.add(record["image"])
+        if record.get("url"):
+            self.urls.add(record["url"])
+        if record.get("phash") is not None:
+            self.phashes_by_label.setdefault(record["label"], []).append(int(record["phash"], 16))
+
+    def has_url(self, url: str) -> bool:
+        return url in self.urls
+
+    def _near_duplicate(self, label: str, phash: Optional[int]) -> bool:
+        if phash is None:
+            return False
+        return any(bin(phash ^ other).count("1") <= self.phash_threshold
+                   for other in self.phashes_by_label.get(label, ()))
+
+    def _fingerprint(self, content: bytes, label: str):
+        """(sha256, hash percetual, é duplicado?)"""
+        sha256 = hashlib.sha256(content).hexdigest()
+        phash = perceptual_hash(content) if self.phash_enabled else None
+        return sha256, phash, sha256 in self.by_sha or self._near_duplicate(label, phash)
+
+    def add(self, content: bytes, group: str, label: str, url: Optional[str] = None) -> Optional[str]:
+        """
+        Guarda a imagem e devolve o caminho relativo, ou None se for duplicada
+        (mesmo conteúdo, ou quase-duplicada de outra imagem da mesma espécie).
+        """
+        sha256, phash, duplicate = self._fingerprint(content, label)
+        if duplicate:
+            self.duplicates_skipped += 1
+            self.bytes_saved += len(content)
+            if url:
+                self.urls.add(url)
+            return None
+
+        rel_path = os.path.join(group, label, f"{sha256}.jpg")
+        abs_path = os.path.join(self.base_dir, rel_path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        tmp_path = abs_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, abs_path)
+
+        record = {
+            "sha256": sha256,
+            "image": rel_path,
+            "label": label,
+            "url": url,
+            "phash": format(phash, "016x") if phash is not None else None,
+        }
+        self.index.append(record)
+        self._remember(record)
+        return rel_path
+
+    def index_directory(self):
+        """
+        Indexa imagens já existentes (ex: nomes uuid de execuções anteriores) sem as mover,
+        para que a deduplicação também as considere. Devolve o número de duplicados encontrados.
+        """
+        duplicates = 0
+        for group in sorted(os.listdir(self.base_dir)) if os.path.isdir(self.base_dir) else []:
+            group_dir = os.path.join(self.base_dir, group)
+            if not os.path.isdir(group_dir):
+                continue
+            for label in sorted(os.listdir(group_dir)):
+                label_dir = os.path.join(group_dir, label)
+                if not os.path.isdir(label_dir):
+                    continue
+                for entry in sorted(os.scandir(label_dir), key=lambda e: e.name):
+                    if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    if os.path.join(group, label, entry.name) in self.paths:
+                        continue  # Já indexada numa execução anterior
+                    with open(entry.path, "rb") as f:
+                        content = f.read()
+                    sha256, phash, duplicate = self._fingerprint(content, label)
+                    if duplicate:
+                        duplicates += 1
+                        continue
+                    record = {
+                        "sha256": sha256,
+                        "image": os.path.join(group, label, entry.name),
+                        "label": label,
+                        "url": None,
+                        "phash": format(phash, "016x") if phash is not None else None,
+                    }
+                    self.index.append(record)
+                    self._remember(record)
+        return duplicates
+
+
+if __name__ == "__main__":
+    # Indexa o dataset existente e reporta duplicados (não apaga nada)
+    import sys
+    base_dir = sys.argv[1] if len(sys.argv) > 1 else "train_val"
+    store = ContentAddressedStore(base_dir)
+    found = store.index_directory()
+    print(f"[INFO] Imagens indexadas: {len(store.by_sha)} | Duplicados encontrados: {found}")
@@ -0,0 +1,131 @@
+"""
+Manifestos do dataset em JSONL (um registo JSON por linha).
+
+- Escrita append-only: acrescentar uma espécie/imagem não reescreve o ficheiro inteiro
+- Compactação periódica (último registo por chave) com substituição atómica
+- Leitura em streaming, com suporte aos ficheiros .json legados (lista ou dicionário)
+- Checkpoints JSON escritos de forma atómica (ficheiro temporário + os.replace)
+
+Só usa a biblioteca standard, para poder ser importado pelos scripts do dataset
+e pelo serviço (main.py).
+"""
+import json
+import os
+from typing import Dict, Iterable, Iterator, Optional
+
+
+def resolve_manifest(path: str) -> str:
+    """Prefere a versão .jsonl de um manifesto se existir (ex: annotations.json -> annotations.jsonl)"""
+    base, ext = os.path.splitext(path)
+    jsonl_path = base + ".jsonl"
+    if ext != ".jsonl" and os.path.exists(jsonl_path):
+        return jsonl_path
+    return path
+
+
+def iter_records(path: str) -> Iterator[dict]:
+    """
+    Lê os registos de um manifesto.
+    JSONL é lido linha a linha (uma linha incompleta no fim, de uma escrita interrompida, é ignorada);
+    os ficheiros .json legados são carregados de uma vez (lista de registos ou dicionário id -> registo).
+    """
+    if not os.path.exists(path):
+        return
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    else:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        yield from (data.values() if isinstance(data, dict) else data)
+
+
+def load_annotations(path: str) -> Dict[str, dict]:
+    """Anotações por taxon_id (annotations.jsonl ou annotations.json legado)"""
+    return {str(r["taxon_id"]): r for r in iter_records(resolve_manifest(path)) if r.get("taxon_id")}
+
+
+def atomic_write_json(path: str, data, indent: Optional[int] = 2):
+    """Escreve JSON num ficheiro temporário e substitui o destino atomicamente"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonlManifest:
+    """Manifesto append-only com chave por registo (ex: taxon_id, image)"""
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        self.appended_since_compact = 0
+        self._repair_tail()
+
+    def _repair_tail(self):
+        """Remove uma linha final incompleta (escrita interrompida) para não corromper o próximo append"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            content = f.read()
+            f.truncate(content.rfind(b"\n") + 1)
+
+    def migrate_from(self, legacy_path: str):
+        """Converte um manifesto .json legado para JSONL (apenas se o JSONL ainda não existir)"""
+        if os.path.exists(self.path) or not os.path.exists(legacy_path):
+            return
+        self._write_atomic(iter_records(legacy_path))
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter_records(self.path)
+
+    def keys(self) -> set:
+        return {str(r[self.key]) for r in self if self.key in r}
+
+    def append(self, record: dict):
+        self.append_many([record])
+
+    def append_many(self, records: Iterable[dict]):
+        lines = [json.dumps(r, ensure_ascii=False) + "\n" for r in records]
+        if not lines:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+        self.appended_since_compact += len(lines)
+
+    def sync(self):
+        """Garante que os registos acrescentados estão em disco (usado nos checkpoints)"""
+        if os.path.exists(self.path):
+            with open(self.path, "a", encoding="utf-8") as f:
+                os.fsync(f.fileno())
+
+    def compact(self):
+        """Reescreve o manifesto com um registo por chave (o último registo prevalece)"""
+        latest: Dict[str, dict] = {}
+        for record in self:
+            latest[str(record.get(self.key))] = record
+        self._write_atomic(latest.values())
+        self.appended_since_compact = 0
+
+    def _write_atomic(self, records: Iterable[dict]):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -1,9 +1,14 @@
 import os
+import time
 import torch
 from torch import nn, optim
 from torchvision import datasets, transforms, models
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import DataLoader, Subset
 import json
+from taxa import TaxonCatalogue, write_species_map
+from preprocess import build_cache, PreprocessedImageDataset
+from features import build_backbone, extract_features, train_head
+from split import scan_image_folder, stratified_split
 
 # Configurações
 DATA_DIR = "train_val/Aves"
@@ -15,123 +20,257 @@ TAXON_MAP_PATH = "species_taxon_map.json"
 ANNOTATIONS_JSON = "annotations.json"
 BATCH_SIZE = 32
 NUM_EPOCHS = 10
-NUM_WORKERS = 0
+NUM_WORKERS = int(os.environ.get("TRAIN_NUM_WORKERS", min(8, os.cpu_count() or 1)))  # 0 = carregamento no processo principal
+PREFETCH_FACTOR = 4  # Batches preparados antecipadamente por worker
 LR = 1e-3
 VAL_RATIO = 0.2  # 20% para validação
+USE_PREPROCESSED = True  # Redimensiona uma vez para um shard uint8 memory-mapped (em vez de descodificar JPEGs a cada época)
+PREPROCESSED_DIR = "preprocessed"
+IMAGE_SIZE = 224
+SPLIT_SEED = 42  # Divisão treino/validação reprodutível (necessária para retomar o treino e comparar benchmarks)
+SPLIT_PATH = "split.json"  # Atribuição treino/validação persistida por sha256 da imagem
+FILE_INDEX_PATH = "file_index.json"  # Listagem das pastas em cache (só as pastas alteradas são relidas)
+CHECKPOINT_DIR = "checkpoints"  # Checkpoint por época (pesos + estado do otimizador)
+RESUME = os.environ.get("TRAIN_RESUME", "0") == "1"  # Retoma a partir de checkpoints/last.pt
+EARLY_STOPPING_PATIENCE = int(os.environ.get("TRAIN_PATIENCE", "3"))  # Épocas sem melhoria na val acc antes de parar
+TRAIN_MODE = os.environ.get("TRAIN_MODE", "full")  # "full": fine-tuning da rede inteira | "head": só a camada fc sobre features em cache
+FEATURES_DIR = "features"  # Cache das features de 512 dimensões do backbone congelado (modo "head")
+HEAD_EPOCHS = 100
+CHANNELS_LAST = True  # Formato de memória NHWC (convoluções mais rápidas em CPU com oneDNN)
+USE_BF16 = os.environ.get("TRAIN_BF16", "auto")  # "auto": bf16 autocast apenas em CPUs com suporte nativo
 
 # Transforms
 transform = transforms.Compose([
-    transforms.Resize((224, 224)),
+    transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 ])
 
-# Dataset
-dataset = datasets.ImageFolder(DATA_DIR, transform=transform)
-num_classes = len(dataset.classes)
-print(f"Espécies (classes) encontradas: {num_classes}")
-print(f"Lista de espécies: {dataset.classes}")
-
-# Divide em treino/validação (80/20)
-val_size = int(VAL_RATIO * len(dataset))
-train_size = len(dataset) - val_size
-train_ds, val_ds = random_split(dataset, [train_size, val_size])
-
-# Gerar val.json
-val_imgs = []
-for idx in val_ds.indices:
-    img_path, label = dataset.samples[idx]
-    val_imgs.append({
-        "image": os.path.relpath(img_path, DATA_DIR),
-        "label": dataset.classes[label]
-    })
-with open(VAL_JSON, "w", encoding="utf-8") as f:
-    json.dump(val_imgs, f, ensure_ascii=False, indent=2)
-print(f"Ficheiro val.json criado com {len(val_imgs)} imagens.")
-
-# Gerar train_clean.json
-train_imgs = []
-for idx in train_ds.indices:
-    img_path, label = dataset.samples[idx]
-    train_imgs.append({
-        "image": os.path.relpath(img_path, DATA_DIR),
-        "label": dataset.classes[label]
-    })
-with open(TRAIN_JSON, "w", encoding="utf-8") as f:
-    json.dump(train_imgs, f, ensure_ascii=False, indent=2)
-print(f"Ficheiro train_clean.json criado com {len(train_imgs)} imagens.")
-
-# Mapping índice -> {class_name, taxon_id} usando annotations.json
-with open(ANNOTATIONS_JSON, "r", encoding="utf-8") as f:
-    annotations = json.load(f)
-
-idx_to_info = []
-for idx, class_name in enumerate(dataset.classes):
-    # Procura taxon_id pelo nome científico (class_name)
-    taxon_id = None
-    for ann in annotations.values():
-        if ann.get("sci_name") == class_name:
-            taxon_id = ann.get("taxon_id")
-            break
-    idx_to_info.append({"class_name": class_name, "taxon_id": taxon_id})
-
-with open(TAXON_MAP_PATH, "w", encoding="utf-8") as f:
-    json.dump(idx_to_info, f, indent=2, ensure_ascii=False)
-
-# Resumo
-print("\nResumo do dataset:")
-print(f"Total de imagens: {len(dataset)}")
-print(f"Imagens de treino: {len(train_imgs)}")
-print(f"Imagens de validação: {len(val_imgs)}")
-print(f"Número de espécies (classes): {num_classes}")
 
-# DataLoaders
-train_loader = DataLoader(train_ds, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS)
-val_loader = DataLoader(val_ds, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS)
+def cpu_supports_bf16():
+    """Deteta suporte nativo a bf16 na CPU (AVX512-BF16 ou AMX)"""
+    checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    return any(getattr(torch.cpu, name, lambda: False)() for name in checks)
 
-# Modelo (ResNet18)
-model = models.resnet18(weights="IMAGENET1K_V1")
-model.fc = nn.Linear(model.fc.in_features, num_classes)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = model.to(device)
+def make_loader(ds, shuffle, device):
+    """DataLoader com workers persistentes, prefetch e pinned memory (se houver GPU)"""
+    kwargs = {}
+    if NUM_WORKERS > 0:
+        kwargs = {"persistent_workers": True, "prefetch_factor": PREFETCH_FACTOR}
+    return DataLoader(
+        ds,
+        batch_size=BATCH_SIZE,
+        shuffle=shuffle,
+        num_workers=NUM_WORKERS,
+        pin_memory=device.type == "cuda",
+        **kwargs
+    )
 
-criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=LR)
 
-# Treino
-for epoch in range(NUM_EPOCHS):
+def train_one_epoch(model, loader, criterion, optimizer, device, memory_format, autocast_kwargs):
     model.train()
-    running_loss = 0.0
-    for imgs, labels in train_loader:
-        imgs, labels = imgs.to(device), labels.to(device)
-        optimizer.zero_grad()
-        outputs = model(imgs)
-        loss = criterion(outputs, labels)
+    # A loss é acumulada num tensor: evita uma sincronização (loss.item()) por passo
+    running_loss = torch.zeros((), device=device)
+    seen = 0
+    start = time.perf_counter()
+    for imgs, labels in loader:
+        imgs = imgs.to(device, memory_format=memory_format, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(**autocast_kwargs):
+            outputs = model(imgs)
+            loss = criterion(outputs, labels)
         loss.backward()
         optimizer.step()
-        running_loss += loss.item() * imgs.size(0)
-    avg_loss = running_loss / len(train_loader.dataset)
+        running_loss += loss.detach().float() * imgs.size(0)
+        seen += imgs.size(0)
+    elapsed = time.perf_counter() - start
+    return running_loss.item() / max(seen, 1), seen / elapsed if elapsed > 0 else 0.0
+
 
-    # Validação
+def evaluate(model, loader, device, memory_format, autocast_kwargs):
     model.eval()
-    correct = 0
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
-    with torch.no_grad():
-        for imgs, labels in val_loader:
-            imgs, labels = imgs.to(device), labels.to(device)
+    with torch.no_grad(), torch.autocast(**autocast_kwargs):
+        for imgs, labels in loader:
+            imgs = imgs.to(device, memory_format=memory_format, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
             outputs = model(imgs)
             _, preds = torch.max(outputs, 1)
-            correct += (preds == labels).sum().item()
+            correct += (preds == labels).sum()
             total += labels.size(0)
-    val_acc = correct / total
-    print(f"Época {epoch+1}/{NUM_EPOCHS} - Loss: {avg_loss:.4f} - Val Acc: {val_acc:.4f}")
+    return correct.item() / total if total else 0.0
+
+
+def save_checkpoint(path, state):
+    """Escreve o checkpoint num ficheiro temporário e substitui o anterior atomicamente"""
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def train_head_only(dataset, train_ds, val_ds, num_classes, device):
+    """Modo "head": backbone congelado, features em cache (só as imagens novas são extraídas) e treino da fc"""
+    backbone = build_backbone()
+    features, extracted = extract_features(dataset, FEATURES_DIR, backbone=backbone, batch_size=BATCH_SIZE * 2,
+                                           num_workers=NUM_WORKERS, device=device)
+    print(f"Features em cache: {len(features)} imagens ({extracted} novas extraídas)")
+
+    head_state, best_val_acc = train_head(
+        features, dataset.targets, train_ds.indices, val_ds.indices, num_classes,
+        epochs=HEAD_EPOCHS, lr=LR, patience=EARLY_STOPPING_PATIENCE * 3, seed=SPLIT_SEED
+    )
+    print(f"Camada fc treinada - Val Acc: {best_val_acc:.4f}")
+
+    # Exporta a ResNet18 completa (backbone congelado + fc treinada), compatível com load_species_model
+    backbone.fc = nn.Linear(features.shape[1], num_classes)
+    backbone.fc.load_state_dict(head_state)
+    save_checkpoint(MODEL_PATH, backbone.state_dict())
+    return best_val_acc
+
+
+def main():
+    # Listagem em cache e divisão estratificada (por espécie), determinística e persistida
+    classes, samples, keys = scan_image_folder(DATA_DIR, FILE_INDEX_PATH)
+    train_indices, val_indices = stratified_split(samples, keys, VAL_RATIO, SPLIT_SEED, SPLIT_PATH)
+
+    # Dataset
+    if USE_PREPROCESSED:
+        if build_cache(DATA_DIR, PREPROCESSED_DIR, size=IMAGE_SIZE, listing=(classes, samples)):
+            print(f"Cache de imagens pré-processadas criada em {PREPROCESSED_DIR}")
+        dataset = PreprocessedImageDataset(PREPROCESSED_DIR, DATA_DIR)
+    else:
+        dataset = datasets.ImageFolder(DATA_DIR, transform=transform)
+    if [os.path.relpath(path, DATA_DIR) for path, _ in dataset.samples] != [path for path, _ in samples]:
+        raise RuntimeError("A listagem do dataset não corresponde ao índice de ficheiros (apaga file_index.json)")
+    num_classes = len(dataset.classes)
+    print(f"Espécies (classes) encontradas: {num_classes}")
+    print(f"Lista de espécies: {dataset.classes}")
+
+    train_ds = Subset(dataset, train_indices)
+    val_ds = Subset(dataset, val_indices)
+
+    # Gerar val.json
+    val_imgs = []
+    for idx in val_ds.indices:
+        img_path, label = dataset.samples[idx]
+        val_imgs.append({
+            "image": os.path.relpath(img_path, DATA_DIR),
+            "label": dataset.classes[label]
+        })
+    with open(VAL_JSON, "w", encoding="utf-8") as f:
+        json.dump(val_imgs, f, ensure_ascii=False, indent=2)
+    print(f"Ficheiro val.json criado com {len(val_imgs)} imagens.")
+
+    # Gerar train_clean.json
+    train_imgs = []
+    for idx in train_ds.indices:
+        img_path, label = dataset.samples[idx]
+        train_imgs.append({
+            "image": os.path.relpath(img_path, DATA_DIR),
+            "label": dataset.classes[label]
+        })
+    with open(TRAIN_JSON, "w", encoding="utf-8") as f:
+        json.dump(train_imgs, f, ensure_ascii=False, indent=2)
+    print(f"Ficheiro train_clean.json criado com {len(train_imgs)} imagens.")
+
+    # Mapa índice -> taxon (taxon_id, sci_name, common_name, group) a partir do catálogo de anotações
+    catalogue = TaxonCatalogue.from_annotations(ANNOTATIONS_JSON)
+    write_species_map(TAXON_MAP_PATH, catalogue.species_map(dataset.classes))
+
+    # Resumo
+    print("\nResumo do dataset:")
+    print(f"Total de imagens: {len(dataset)}")
+    print(f"Imagens de treino: {len(train_imgs)}")
+    print(f"Imagens de validação: {len(val_imgs)}")
+    print(f"Número de espécies (classes): {num_classes}")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if TRAIN_MODE == "head":
+        best_val_acc = train_head_only(dataset, train_ds, val_ds, num_classes, device)
+        with open(LABELS_PATH, "w", encoding="utf-8") as f:
+            json.dump(dataset.classes, f, ensure_ascii=False, indent=2)
+        print(f"Pesos (backbone congelado + fc, Val Acc: {best_val_acc:.4f}) guardados em {MODEL_PATH}")
+        return
+
+    # DataLoaders
+    train_loader = make_loader(train_ds, shuffle=True, device=device)
+    val_loader = make_loader(val_ds, shuffle=False, device=device)
+
+    # Modelo (ResNet18)
+    model = models.resnet18(weights="IMAGENET1K_V1")
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+
+    memory_format = torch.channels_last if CHANNELS_LAST else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format)
+
+    # bf16 autocast em CPU (só com suporte nativo, ou se forçado com TRAIN_BF16=1)
+    use_bf16 = device.type == "cpu" and (USE_BF16 == "1" or (USE_BF16 == "auto" and cpu_supports_bf16()))
+    autocast_kwargs = {"device_type": device.type, "dtype": torch.bfloat16, "enabled": use_bf16}
+    print(f"Dispositivo: {device} | workers: {NUM_WORKERS} | channels_last: {CHANNELS_LAST} | bf16: {use_bf16}")
+
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=LR)
+
+    # Retoma o treino a partir do último checkpoint
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    last_checkpoint = os.path.join(CHECKPOINT_DIR, "last.pt")
+    best_checkpoint = os.path.join(CHECKPOINT_DIR, "best.pt")
+    start_epoch = 0
+    best_val_acc = -1.0
+    epochs_without_improvement = 0
+    if RESUME and os.path.exists(last_checkpoint):
+        checkpoint = torch.load(last_checkpoint, map_location=device, weights_only=True)
+        if checkpoint["classes"] != dataset.classes:
+            raise RuntimeError("As classes do checkpoint não correspondem ao dataset atual")
+        model.load_state_dict(checkpoint["model_state"])
+        optimizer.load_state_dict(checkpoint["optimizer_state"])
+        start_epoch = checkpoint["epoch"] + 1
+        best_val_acc = checkpoint["best_val_acc"]
+        epochs_without_improvement = checkpoint["epochs_without_improvement"]
+        print(f"Treino retomado na época {start_epoch + 1} (melhor Val Acc: {best_val_acc:.4f})")
+
+    # Treino
+    for epoch in range(start_epoch, NUM_EPOCHS):
+        avg_loss, throughput = train_one_epoch(model, train_loader, criterion, optimizer, device, memory_format, autocast_kwargs)
+        # Validação
+        val_acc = evaluate(model, val_loader, device, memory_format, autocast_kwargs)
+        print(f"Época {epoch+1}/{NUM_EPOCHS} - Loss: {avg_loss:.4f} - Val Acc: {val_acc:.4f} - {throughput:.1f} imagens/s")
+
+        if val_acc > best_val_acc:
+            best_val_acc = val_acc
+            epochs_without_improvement = 0
+            save_checkpoint(best_checkpoint, model.state_dict())
+            print(f"Novo melhor modelo (Val Acc: {val_acc:.4f})")
+        else:
+            epochs_without_improvement += 1
+
+        save_checkpoint(last_checkpoint, {
+            "epoch": epoch,
+            "model_state": model.state_dict(),
+            "optimizer_state": optimizer.state_dict(),
+            "best_val_acc": best_val_acc,
+            "epochs_without_improvement": epochs_without_improvement,
+            "classes": dataset.classes,
+        })
+
+        if epochs_without_improvement >= EARLY_STOPPING_PATIENCE:
+            print(f"Early stopping: {EARLY_STOPPING_PATIENCE} épocas sem melhoria")
+            break
+
+    # Exporta apenas os pesos do melhor modelo (carregável com weights_only=True) e as classes
+    best_state = torch.load(best_checkpoint, map_location="cpu", weights_only=True)
+    save_checkpoint(MODEL_PATH, best_state)
+    with open(LABELS_PATH, "w", encoding="utf-8") as f:
+        json.dump(dataset.classes, f, ensure_ascii=False, indent=2)
+
+    print(f"Pesos do melhor modelo (Val Acc: {best_val_acc:.4f}) guardados em {MODEL_PATH}")
+    print(f"Classes guardadas em {LABELS_PATH}")
+    print(f"Mapa índice->taxon guardado em {TAXON_MAP_PATH}")
 
-# Guarda o modelo e as classes
-torch.save(model, MODEL_PATH)
-with open(LABELS_PATH, "w", encoding="utf-8") as f:
-    json.dump(dataset.classes, f, ensure_ascii=False, indent=2)
 
-print(f"Modelo guardado em {MODEL_PATH}")
-print(f"Classes guardadas em {LABELS_PATH}")
-print(f"Mapping índice->taxon_id guardado em {TAXON_MAP_PATH}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Pré-processamento do dataset para treino.
+
+As imagens são descodificadas e redimensionadas UMA vez (ingestão) e guardadas num shard
+uint8 memory-mapped (N, H, W, 3) + labels. O PreprocessedImageDataset lê esse shard sem cópias
+(mmap copy-on-write), pelo que cada época deixa de re-descodificar todos os JPEGs.
+
+Estrutura da cache:
+    <cache_dir>/images_uint8.npy   imagens redimensionadas (uint8, NHWC)
+    <cache_dir>/labels.npy         índice da classe de cada imagem (int64)
+    <cache_dir>/meta.json          classes, caminhos relativos e tamanho
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+IMG_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+IMAGES_FILE = "images_uint8.npy"
+LABELS_FILE = "labels.npy"
+META_FILE = "meta.json"
+
+
+def list_image_folder(data_dir: str) -> Tuple[List[str], List[Tuple[str, int]]]:
+    """Lista classes e amostras com a mesma ordenação do torchvision ImageFolder"""
+    classes = sorted(entry.name for entry in os.scandir(data_dir) if entry.is_dir())
+    samples = []
+    for class_idx, class_name in enumerate(classes):
+        class_dir = os.path.join(data_dir, class_name)
+        for root, _, files in sorted(os.walk(class_dir, followlinks=True)):
+            for fname in sorted(files):
+                if fname.lower().endswith(IMG_EXTENSIONS):
+                    rel_path = os.path.relpath(os.path.join(root, fname), data_dir)
+                    samples.append((rel_path, class_idx))
+    return classes, samples
+
+
+def _resize_chunk(args):
+    """Worker: descodifica e redimensiona um bloco de imagens diretamente no shard"""
+    data_dir, cache_dir, size, start, rel_paths = args
+    images = np.load(os.path.join(cache_dir, IMAGES_FILE), mmap_mode="r+")
+    for offset, rel_path in enumerate(rel_paths):
+        with Image.open(os.path.join(data_dir, rel_path)) as image:
+            # Mesma interpolação do transforms.Resize((224, 224)) usado no treino
+            image = image.convert("RGB").resize((size, size), Image.BILINEAR)
+            images[start + offset] = np.asarray(image, dtype=np.uint8)
+    images.flush()
+    return len(rel_paths)
+
+
+def cache_is_current(cache_dir: str, classes: List[str], samples: List[Tuple[str, int]], size: int) -> bool:
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    return (
+        meta.get("size") == size
+        and meta.get("classes") == classes
+        and meta.get("samples") == [path for path, _ in samples]
+    )
+
+
+def build_cache(data_dir: str, cache_dir: str, size: int = 224, workers: Optional[int] = None,
+                chunk_size: int = 256, force: bool = False,
+                listing: Optional[Tuple[List[str], List[Tuple[str, int]]]] = None) -> bool:
+    """
+    Redimensiona todas as imagens de `data_dir` (layout ImageFolder) para o shard em `cache_dir`.
+    `listing` = (classes, amostras) já conhecidas (ex: índice de ficheiros em cache do split.py);
+    sem ela a árvore é percorrida. Não faz nada se a cache já corresponder à listagem atual.
+    Devolve True se a cache foi (re)construída.
+    """
+    classes, samples = listing or list_image_folder(data_dir)
+    if not force and cache_is_current(cache_dir, classes, samples, size):
+        return False
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_dir, IMAGES_FILE), mode="w+", dtype=np.uint8, shape=(len(samples), size, size, 3)
+    )
+    del images  # Os workers abrem o shard em modo r+
+    np.save(os.path.join(cache_dir, LABELS_FILE), np.array([label for _, label in samples], dtype=np.int64))
+
+    rel_paths = [path for path, _ in samples]
+    chunks = [
+        (data_dir, cache_dir, size, start, rel_paths[start:start + chunk_size])
+        for start in range(0, len(rel_paths), chunk_size)
+    ]
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for count in executor.map(_resize_chunk, chunks):
+            done += count
+            print(f"[PRE] {done}/{len(rel_paths)} imagens redimensionadas")
+
+    # meta.json é escrito no fim: uma cache incompleta nunca é considerada válida
+    with open(os.path.join(cache_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"size": size, "classes": classes, "samples": rel_paths}, f, ensure_ascii=False)
+    return True
+
+
+class PreprocessedImageDataset(Dataset):
+    """
+    Dataset PyTorch sobre o shard uint8 memory-mapped.
+    Expõe `classes` e `samples` como o ImageFolder; devolve (tensor CHW normalizado, label).
+    """
+
+    def __init__(self, cache_dir: str, data_dir: str, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        with open(os.path.join(cache_dir, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.classes = meta["classes"]
+        # mmap copy-on-write: leitura sem cópias, sem avisos de array não gravável
+        self.images = np.load(os.path.join(cache_dir, IMAGES_FILE), mmap_mode="c")
+        self.labels = np.load(os.path.join(cache_dir, LABELS_FILE))
+        self.samples = [
+            (os.path.join(data_dir, path), int(label)) for path, label in zip(meta["samples"], self.labels)
+        ]
+        self.targets = [label for _, label in self.samples]
+        self.mean = torch.tensor(mean).view(3, 1, 1)
+        self.std = torch.tensor(std).view(3, 1, 1)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(self.images[idx]).permute(2, 0, 1).float().div_(255)
+        return (image - self.mean) / self.std, int(self.labels[idx])
+
+
+if __name__ == "__main__":
+    import sys
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else "train_val/Aves"
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else "preprocessed"
+    rebuilt = build_cache(data_dir, cache_dir, force="--force" in sys.argv)
+    print("[PRE] Cache construída" if rebuilt else "[PRE] Cache já atualizada")
@@ -0,0 +1,126 @@
+"""
+Divisão treino/validação estratificada e determinística.
+
+- Índice de ficheiros em cache (file_index.json): cada pasta de classe só é relida quando o seu mtime muda,
+  em vez de percorrer a árvore inteira em cada treino
+- Cada imagem é identificada pelo sha256 do conteúdo (o nome do ficheiro no ContentAddressedStore;
+  calculado a partir do conteúdo para nomes antigos)
+- Estratificação por classe: cada espécie com pelo menos 2 imagens tem pelo menos 1 imagem de validação
+- A ordem dentro de cada classe é dada por sha256(seed:hash), pelo que o resultado não depende da ordem
+  de listagem; as atribuições ficam guardadas em split.json e são mantidas entre treinos
+  (imagens novas são distribuídas de forma a repor a proporção de validação da classe)
+
+Só usa a biblioteca standard.
+"""
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Tuple
+
+from manifest import atomic_write_json
+
+IMG_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+SHA256_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _content_hash(path: str) -> str:
+    name = os.path.splitext(os.path.basename(path))[0]
+    if SHA256_NAME.match(name):
+        return name
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_image_folder(data_dir: str, cache_path: str = "file_index.json") -> Tuple[List[str], List[Tuple[str, int]], List[str]]:
+    """
+    Lista (classes, amostras (caminho relativo, índice da classe), sha256 de cada amostra),
+    com a mesma ordenação do ImageFolder. Usa e atualiza a cache de listagens por pasta.
+    """
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f).get("dirs", {})
+
+    classes = sorted(entry.name for entry in os.scandir(data_dir) if entry.is_dir())
+    dirs: Dict[str, dict] = {}
+    rescanned = 0
+    for class_name in classes:
+        class_dir = os.path.join(data_dir, class_name)
+        mtime = os.stat(class_dir).st_mtime_ns
+        cached = cache.get(class_name)
+        if cached and cached["mtime"] == mtime:
+            dirs[class_name] = cached
+            continue
+        rescanned += 1
+        known = {item["image"]: item["sha256"] for item in (cached or {}).get("files", [])}
+        files = []
+        for root, _, names in sorted(os.walk(class_dir, followlinks=True)):
+            for fname in sorted(names):
+                if fname.lower().endswith(IMG_EXTENSIONS):
+                    rel_path = os.path.relpath(os.path.join(root, fname), data_dir)
+                    sha256 = known.get(rel_path) or _content_hash(os.path.join(data_dir, rel_path))
+                    files.append({"image": rel_path, "sha256": sha256})
+        dirs[class_name] = {"mtime": mtime, "files": files}
+
+    if rescanned or set(cache) != set(dirs):
+        atomic_write_json(cache_path, {"dirs": dirs}, indent=None)
+
+    samples, keys = [], []
+    for class_idx, class_name in enumerate(classes):
+        for item in dirs[class_name]["files"]:
+            samples.append((item["image"], class_idx))
+            keys.append(item["sha256"])
+    return classes, samples, keys
+
+
+def _rank(seed: int, key: str) -> str:
+    return hashlib.sha256(f"{seed}:{key}".encode()).hexdigest()
+
+
+def stratified_split(samples: List[Tuple[str, int]], keys: List[str], val_ratio: float = 0.2, seed: int = 42,
+                     split_path: str = "split.json") -> Tuple[List[int], List[int]]:
+    """
+    Devolve (índices de treino, índices de validação). As atribuições anteriores guardadas em `split_path`
+    são respeitadas se a seed e a proporção forem as mesmas.
+    """
+    assignments: Dict[str, str] = {}
+    if os.path.exists(split_path):
+        with open(split_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("seed") == seed and saved.get("val_ratio") == val_ratio:
+            assignments = saved.get("assignments", {})
+
+    by_class: Dict[int, List[int]] = {}
+    for idx, (_, label) in enumerate(samples):
+        by_class.setdefault(label, []).append(idx)
+
+    train_idx, val_idx = [], []
+    new_assignments = {}
+    for label, indices in by_class.items():
+        target = int(round(val_ratio * len(indices)))
+        if len(indices) >= 2:
+            target = min(max(target, 1), len(indices) - 1)
+        else:
+            target = 0
+        val_count = sum(1 for idx in indices if assignments.get(keys[idx]) == "val")
+        pending = sorted((idx for idx in indices if keys[idx] not in assignments),
+                         key=lambda idx: _rank(seed, keys[idx]))
+        for idx in indices:
+            if keys[idx] in assignments:
+                new_assignments[keys[idx]] = assignments[keys[idx]]
+        for idx in pending:
+            if val_count < target:
+                new_assignments[keys[idx]] = "val"
+                val_count += 1
+            else:
+                new_assignments[keys[idx]] = "train"
+        for idx in indices:
+            (val_idx if new_assignments[keys[idx]] == "val" else train_idx).append(idx)
+
+    if new_assignments != assignments:
+        atomic_write_json(split_path, {"seed": seed, "val_ratio": val_ratio, "assignments": new_assignments}, indent=None)
+    return sorted(train_idx), sorted(val_idx)
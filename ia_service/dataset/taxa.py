@@ -0,0 +1,81 @@
+"""
+Catálogo de taxa do dataset (a partir das anotações).
+
+- Índices taxon_id -> taxon e sci_name -> taxon construídos uma única vez (lookup O(1) por classe)
+- Gera o species_taxon_map canónico: uma entrada por classe do modelo (pela ordem dos índices),
+  com taxon_id, sci_name, common_name, group e wikipedia_url
+- Usado pelo model.py, pelo generate_species_taxon_map.py e pelo serviço (load_species_model)
+
+Só usa a biblioteca standard, tal como o manifest.py.
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from manifest import atomic_write_json, iter_records, resolve_manifest
+except ImportError:  # Importado como dataset.taxa (main.py)
+    from .manifest import atomic_write_json, iter_records, resolve_manifest
+
+SPECIES_MAP_FIELDS = ("taxon_id", "sci_name", "common_name", "group", "wikipedia_url")
+
+
+class TaxonCatalogue:
+    def __init__(self, records: Iterable[dict]):
+        self.by_id: Dict[str, dict] = {}
+        self.by_sci_name: Dict[str, dict] = {}
+        for record in records:
+            if record.get("taxon_id"):
+                self.by_id[str(record["taxon_id"])] = record
+            if record.get("sci_name"):
+                self.by_sci_name[record["sci_name"].strip().lower()] = record
+
+    @classmethod
+    def from_annotations(cls, path: str) -> "TaxonCatalogue":
+        """annotations.jsonl (ou o annotations.json legado)"""
+        return cls(iter_records(resolve_manifest(path)))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def lookup(self, key) -> Optional[dict]:
+        """Procura por taxon_id (nome das pastas do dataset) e, em alternativa, pelo nome científico"""
+        if key is None:
+            return None
+        key = str(key)
+        return self.by_id.get(key) or self.by_sci_name.get(key.strip().lower())
+
+    def species_entry(self, class_name: str) -> dict:
+        taxon = self.lookup(class_name) or {}
+        entry = {"class_name": class_name}
+        for field in SPECIES_MAP_FIELDS:
+            entry[field] = taxon.get(field)
+        entry["taxon_id"] = str(entry["taxon_id"] or class_name)
+        return entry
+
+    def species_map(self, classes: List[str]) -> List[dict]:
+        """Mapa índice da classe -> informação do taxon"""
+        return [self.species_entry(class_name) for class_name in classes]
+
+
+def write_species_map(path: str, species_map: List[dict]):
+    """Escreve o mapa em JSON compacto, de forma atómica"""
+    atomic_write_json(path, species_map, indent=None)
+
+
+def load_species_map(path: str, annotations_path: Optional[str] = None) -> List[dict]:
+    """
+    Lê o species_taxon_map. Mapas antigos sem common_name/group/sci_name são completados
+    a partir das anotações, se existirem.
+    """
+    with open(path, encoding="utf-8") as f:
+        species_map = json.load(f)
+    incomplete = any(not entry.get(field) for entry in species_map for field in ("sci_name", "common_name", "group"))
+    if incomplete and annotations_path and os.path.exists(resolve_manifest(annotations_path)):
+        catalogue = TaxonCatalogue.from_annotations(annotations_path)
+        for entry in species_map:
+            taxon = catalogue.lookup(entry.get("taxon_id")) or catalogue.lookup(entry.get("class_name")) or {}
+            for field in SPECIES_MAP_FIELDS:
+                if not entry.get(field) and taxon.get(field):
+                    entry[field] = taxon[field]
+    return species_map
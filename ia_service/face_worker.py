@@ -0,0 +1,79 @@
+"""
+Trabalho facial (dlib/face_recognition) executado no pool de processos do serviço.
+
+Módulo leve (sem torch/FastAPI): é importado pelos processos do pool em modo spawn, e as funções
+recebem e devolvem apenas tipos serializáveis (bytes, listas, arrays NumPy).
+O face_recognition (dlib e modelos) só é importado dentro dos processos do pool, na primeira utilização
+ou no aquecimento (warm_up): o processo principal do serviço nunca o carrega.
+"""
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from service_log import debug_sampled, get_logger
+
+logger = get_logger("ia_service.face")
+
+
+def warm_up() -> int:
+    """Importa o face_recognition (carrega os modelos dlib) neste processo; devolve o pid"""
+    import face_recognition  # noqa: F401
+    return os.getpid()
+
+
+def _decode(image_data: bytes) -> np.ndarray:
+    return np.array(Image.open(io.BytesIO(image_data)).convert("RGB"))
+
+
+def count_faces(image_data: bytes) -> int:
+    """Número de faces detetadas (-1 se a imagem for inválida)"""
+    import face_recognition
+    try:
+        return len(face_recognition.face_locations(_decode(image_data)))
+    except Exception:
+        return -1
+
+
+def encode_faces(image_data: bytes) -> list:
+    """Encodings (128 dimensões) de todas as faces detetadas na imagem"""
+    import face_recognition
+    image_np = _decode(image_data)
+    face_locations = face_recognition.face_locations(image_np)
+    return face_recognition.face_encodings(image_np, face_locations)
+
+
+def load_known_faces(known_faces_dir: str):
+    """Carrega faces conhecidas do diretório: (encodings, emails)"""
+    import face_recognition
+    known_encodings = []
+    known_emails = []
+
+    if not known_faces_dir or not os.path.exists(known_faces_dir):
+        logger.warning("known_faces_dir_missing", extra={"dir": known_faces_dir})
+        return known_encodings, known_emails
+
+    files = os.listdir(known_faces_dir)
+
+    for filename in files:
+        if filename.lower().endswith((".jpg", ".jpeg", ".png")):
+            try:
+                filepath = os.path.join(known_faces_dir, filename)
+                image = face_recognition.load_image_file(filepath)
+                encodings = face_recognition.face_encodings(image)
+
+                if encodings:
+                    known_encodings.append(encodings[0])
+                    # Extrair email do nome do arquivo (remove extensão e possível número)
+                    email = os.path.splitext(filename)[0]
+                    # Remove números do final se existirem (ex: "user@email.com_1" -> "user@email.com")
+                    email = email.split('_')[0] if '_' in email else email
+                    known_emails.append(email)
+                else:
+                    logger.warning("known_face_without_face", extra={"file": filename})
+            except Exception as e:
+                logger.error("known_face_load_failed", extra={"file": filename, "error": str(e)})
+
+    debug_sampled(logger, "known_faces_loaded", files=len(files), faces=len(known_encodings))
+    return known_encodings, known_emails
@@ -0,0 +1,117 @@
+"""
+Serialização JSON rápida das respostas do ia_service (orjson).
+
+- ORJSONResponse: classe de resposta por omissão da app (FastAPI(default_response_class=...)), com
+  escalares e arrays NumPy (OPT_SERIALIZE_NUMPY), chaves não-string e objetos que só o
+  jsonable_encoder sabia converter (fallback se o orjson recusar o conteúdo)
+- FastJSONRoute: rota que serializa diretamente com orjson o que o endpoint devolve, sem passar pelo
+  jsonable_encoder do FastAPI (que percorre e copia todo o dicionário antes de o serializar). Endpoints
+  com response_model ou com um parâmetro Response (status/cabeçalhos) mantêm o caminho normal
+- Compressão: gzip (ou brotli, se brotli-asgi estiver instalado) acima de RESPONSE_COMPRESSION_MIN_BYTES
+"""
+import inspect
+import os
+from decimal import Decimal
+from functools import wraps
+from typing import Any
+
+import numpy as np
+import orjson
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # Dependência opcional
+    BrotliMiddleware = None
+
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))  # 0 = desligada
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def default(obj: Any):
+    """Tipos que o orjson não serializa nativamente"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):  # Arrays não contíguos ou de dtypes não suportados
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, "model_dump"):  # Modelos pydantic
+        return obj.model_dump()
+    if hasattr(obj, "keys"):  # asyncpg.Record e outros mapeamentos
+        return dict(obj)
+    raise TypeError(f"Tipo não serializável: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    try:
+        return orjson.dumps(content, default=default, option=ORJSON_OPTIONS)
+    except TypeError:  # orjson.JSONEncodeError: o jsonable_encoder converte o resto
+        return orjson.dumps(jsonable_encoder(content), default=default, option=ORJSON_OPTIONS)
+
+
+class ORJSONResponse(JSONResponse):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _has_response_parameter(endpoint) -> bool:
+    for parameter in inspect.signature(endpoint).parameters.values():
+        if inspect.isclass(parameter.annotation) and issubclass(parameter.annotation, Response):
+            return True
+    return False
+
+
+def _has_response_model(endpoint, response_model) -> bool:
+    if isinstance(response_model, DefaultPlaceholder):  # Por omissão o FastAPI usa a anotação de retorno
+        response_model = inspect.signature(endpoint).return_annotation
+        if response_model is inspect.Signature.empty or (
+            inspect.isclass(response_model) and issubclass(response_model, Response)
+        ):
+            return False
+    return response_model is not None
+
+
+class FastJSONRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not _has_response_model(endpoint, kwargs.get("response_model")) and not _has_response_parameter(endpoint):
+            endpoint = _direct(endpoint, kwargs.get("status_code"))
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _direct(endpoint, status_code):
+    """Envolve o endpoint para devolver ORJSONResponse (o FastAPI devolve Responses sem as serializar)"""
+    def respond(result):
+        if isinstance(result, Response):
+            return result
+        return ORJSONResponse(result, status_code=status_code or 200)
+
+    if inspect.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            return respond(await endpoint(*args, **kwargs))
+    else:
+        @wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            return respond(endpoint(*args, **kwargs))
+    return wrapper
+
+
+def add_compression(app):
+    """Compressão das respostas acima de RESPONSE_COMPRESSION_MIN_BYTES (brotli se disponível, senão gzip)"""
+    if RESPONSE_COMPRESSION_MIN_BYTES <= 0:
+        return
+    if BrotliMiddleware is not None:
+        app.add_middleware(BrotliMiddleware, minimum_size=RESPONSE_COMPRESSION_MIN_BYTES, gzip_fallback=True)
+    else:
+        app.add_middleware(GZipMiddleware, minimum_size=RESPONSE_COMPRESSION_MIN_BYTES)
@@ -0,0 +1,349 @@
+"""
+Gerador de carga (asyncio) para o ia_service, com cenários pré-definidos:
+
+- login:            POST /recognize (login facial)
+- species:          rajadas de POST /identify_species em paralelo (várias fotos do mesmo avistamento)
+- recommendations:  página de recomendações (POST /advanced_recommendations + GET /user_insights/{id})
+- chat:             sessões Socket.IO com várias perguntas ao chatbot (llm2_message ou llm_message)
+
+Cada cenário tem N utilizadores virtuais em ciclo fechado (pedido -> resposta -> tempo de reflexão).
+O relatório dá, por operação, pedidos, erros, throughput e latências p50/p95/p99 (texto + JSON em results/).
+
+Sem --target, arranca o serviço localmente (serve.py: main:socket_app com Postgres em memória e
+Ollama/OpenRouter falsos). Exemplos:
+    python run.py --duration 60 --users login=2,species=4,recommendations=8,chat=20
+    FAKE_UPSTREAM_LATENCY=0.5 FAKE_UPSTREAM_TOKENS=200 python run.py --scenarios chat --users chat=50
+    python run.py --target http://ia-service:8000 --scenarios species,recommendations
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+import httpx
+import socketio
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(LOADTEST_DIR), "benchmarks"))
+
+import fakes  # noqa: E402
+
+DEFAULT_USERS = {"login": 2, "species": 4, "recommendations": 8, "chat": 10}
+CHAT_PROMPTS = [
+    "Onde vive o lince-ibérico?",
+    "O que come a águia-real?",
+    "Quais são as aves migratórias mais comuns em Portugal?",
+    "Como distinguir um pardal de um tentilhão?",
+    "Que anfíbios existem na serra da Estrela?",
+]
+
+
+# ==========================
+# RECOLHA DE RESULTADOS
+# ==========================
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Percentil pelo método nearest-rank (valores já ordenados)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(q / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.started = None
+        self.finished = None
+
+    def record(self, operation: str, elapsed: float, error: str = None):
+        if self.started is None:  # Fase de aquecimento: não conta
+            return
+        self.latencies[operation].append(elapsed)
+        if error:
+            self.errors[operation][error] += 1
+
+    async def measure(self, operation: str, coro, check=None):
+        """Executa e regista a operação; check(resultado) devolve a descrição do erro ou None"""
+        start = time.perf_counter()
+        try:
+            result = await coro
+        except Exception as e:
+            self.record(operation, time.perf_counter() - start, type(e).__name__)
+            return None
+        self.record(operation, time.perf_counter() - start, check(result) if check else None)
+        return result
+
+    def report(self) -> dict:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        operations = {}
+        for operation, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            errors = sum(self.errors[operation].values())
+            operations[operation] = {
+                "requests": len(values),
+                "errors": errors,
+                "error_kinds": dict(self.errors[operation]),
+                "throughput_rps": round(len(values) / elapsed, 2),
+                "ok_rps": round((len(values) - errors) / elapsed, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        return {"duration_s": round(elapsed, 1), "operations": operations}
+
+
+def http_check(response: httpx.Response):
+    if response.status_code >= 400:
+        return f"http_{response.status_code}"
+    return None
+
+
+def body_check(response: httpx.Response):
+    """Erro HTTP ou resposta com campo "error" (o serviço devolve 200 com error em várias rotas)"""
+    error = http_check(response)
+    if error:
+        return error
+    body = response.json()
+    return "error_field" if isinstance(body, dict) and "error" in body else None
+
+
+# ==========================
+# CENÁRIOS
+# ==========================
+
+class Context:
+    """Dados partilhados pelos utilizadores virtuais (gerados uma vez, fora da medição)"""
+
+    def __init__(self, args):
+        self.args = args
+        self.client = httpx.AsyncClient(base_url=args.target, timeout=args.timeout,
+                                        limits=httpx.Limits(max_connections=None, max_keepalive_connections=None))
+        self.images = [fakes.synthetic_image_b64(seed=seed) for seed in range(8)]
+        self.candidates = fakes.synthetic_candidates(args.candidates)
+        self.rng = random.Random(args.seed)
+
+    async def think(self):
+        if self.args.think_time:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.args.think_time)
+
+
+async def scenario_login(ctx: Context, recorder: Recorder):
+    await recorder.measure(
+        "login",
+        ctx.client.post("/recognize", json={"image": ctx.rng.choice(ctx.images)}),
+        http_check,  # "Nenhuma face detetada" é uma resposta válida (imagens sintéticas)
+    )
+    await ctx.think()
+
+
+async def scenario_species(ctx: Context, recorder: Recorder):
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        recorder.measure("species_identify", ctx.client.post("/identify_species", json={"image": image}), body_check)
+        for image in ctx.rng.sample(ctx.images, min(ctx.args.burst, len(ctx.images)))
+    ))
+    recorder.record("species_burst", time.perf_counter() - start)
+    await ctx.think()
+
+
+async def scenario_recommendations(ctx: Context, recorder: Recorder):
+    user_id = str(ctx.rng.randrange(1, ctx.args.history_users + 1))
+    request = {
+        "user_id": user_id,
+        "user_groups": ["Aves", "Mammalia"],
+        "user_families": ["Familia1", "Familia2"],
+        "seen_taxon_ids": [str(ctx.rng.randrange(1, ctx.args.candidates + 1)) for _ in range(10)],
+        "candidates": ctx.candidates,
+        "algorithm": ctx.args.algorithm,
+        "limit": 20,
+    }
+
+    async def page():
+        return await asyncio.gather(
+            recorder.measure("recommendations_advanced", ctx.client.post("/advanced_recommendations", json=request), body_check),
+            recorder.measure("recommendations_insights", ctx.client.get(f"/user_insights/{user_id}"), http_check),
+        )
+
+    await recorder.measure("recommendations_page", page())
+    await ctx.think()
+
+
+async def scenario_chat(ctx: Context, recorder: Recorder):
+    """Uma sessão: liga, faz várias perguntas (esperando cada resposta) e desliga"""
+    event, response_event = ("llm2_message", "llm2_response") if ctx.args.chat_backend == "openrouter" else ("llm_message", "llm_response")
+    responses = asyncio.Queue()
+    client = socketio.AsyncClient(reconnection=False)
+    client.on(response_event, responses.put)
+
+    await recorder.measure("chat_connect", client.connect(ctx.args.target, transports=["websocket"]))
+    if not client.connected:
+        await ctx.think()
+        return
+    try:
+        for _ in range(ctx.args.chat_messages):
+            await client.emit(event, {"prompt": ctx.rng.choice(CHAT_PROMPTS), "api_key": "loadtest"})
+            await recorder.measure(
+                "chat_message",
+                asyncio.wait_for(responses.get(), ctx.args.timeout),
+                lambda data: data.get("code", "error_field") if "error" in data else None,
+            )
+            await ctx.think()
+    finally:
+        await client.disconnect()
+
+
+SCENARIOS = {
+    "login": scenario_login,
+    "species": scenario_species,
+    "recommendations": scenario_recommendations,
+    "chat": scenario_chat,
+}
+
+
+# ==========================
+# EXECUÇÃO
+# ==========================
+
+async def virtual_user(scenario, ctx: Context, recorder: Recorder, delay: float, deadline: float):
+    await asyncio.sleep(delay)
+    while time.perf_counter() < deadline:
+        await scenario(ctx, recorder)
+
+
+async def run_load(args) -> dict:
+    ctx = Context(args)
+    recorder = Recorder()
+    users = {name: args.users.get(name, DEFAULT_USERS[name]) for name in args.scenarios}
+
+    # Aquecimento: uma iteração de cada cenário (carrega modelos, abre o pool), fora das estatísticas
+    for name in args.scenarios:
+        await SCENARIOS[name](ctx, recorder)
+
+    recorder.started = time.perf_counter()
+    deadline = recorder.started + args.duration
+    total = sum(users.values())
+    tasks = []
+    for name, count in users.items():
+        for i in range(count):
+            # Arranque escalonado ao longo do ramp-up
+            delay = args.ramp_up * len(tasks) / total if total else 0
+            tasks.append(asyncio.create_task(virtual_user(SCENARIOS[name], ctx, recorder, delay, deadline)))
+    await asyncio.gather(*tasks)
+    recorder.finished = time.perf_counter()
+    await ctx.client.aclose()
+
+    report = recorder.report()
+    report["config"] = {
+        "target": args.target,
+        "users": users,
+        "duration_s": args.duration,
+        "ramp_up_s": args.ramp_up,
+        "think_time_s": args.think_time,
+        "burst": args.burst,
+        "chat_messages": args.chat_messages,
+        "chat_backend": args.chat_backend,
+        "algorithm": args.algorithm,
+        "candidates": args.candidates,
+        "fake_upstream": {
+            name: os.environ[name]
+            for name in ("FAKE_UPSTREAM_LATENCY", "FAKE_UPSTREAM_TOKEN_DELAY", "FAKE_UPSTREAM_TOKENS")
+            if name in os.environ
+        },
+    }
+    return report
+
+
+def print_report(report: dict):
+    header = f"{'operação':<26}{'pedidos':>9}{'erros':>7}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(f"\nDuração: {report['duration_s']} s | utilizadores: {report['config']['users']}")
+    print(header)
+    print("-" * len(header))
+    for operation, stats in report["operations"].items():
+        print(f"{operation:<26}{stats['requests']:>9}{stats['errors']:>7}{stats['throughput_rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+        if stats["error_kinds"]:
+            print(f"{'':<26}erros: {stats['error_kinds']}")
+
+
+def start_local_stack(args):
+    """Lança o serve.py e espera que o serviço responda"""
+    process = subprocess.Popen([
+        sys.executable, os.path.join(LOADTEST_DIR, "serve.py"),
+        "--port", str(args.port), "--upstream-port", str(args.port + 1),
+    ])
+    args.target = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py terminou com código {process.returncode}")
+        try:
+            if httpx.get(f"{args.target}/metrics", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"O serviço não respondeu em {args.startup_timeout} s")
+
+
+def parse_users(value: str) -> dict:
+    users = {}
+    for item in filter(None, value.split(",")):
+        name, _, count = item.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"cenário desconhecido: {name}")
+        users[name] = int(count)
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", help="URL do serviço (sem ela, arranca o serve.py localmente)")
+    parser.add_argument("--port", type=int, default=8900, help="porta do serviço local (upstreams falsos em port+1)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="lista separada por vírgulas")
+    parser.add_argument("--users", type=parse_users, default={}, help="utilizadores por cenário, ex: chat=20,species=4")
+    parser.add_argument("--duration", type=float, default=30, help="segundos de medição")
+    parser.add_argument("--ramp-up", type=float, default=5, help="segundos até todos os utilizadores estarem ativos")
+    parser.add_argument("--think-time", type=float, default=1.0, help="pausa média entre ações de um utilizador")
+    parser.add_argument("--burst", type=int, default=4, help="fotos por rajada de identificação")
+    parser.add_argument("--chat-messages", type=int, default=3, help="perguntas por sessão de chat")
+    parser.add_argument("--chat-backend", choices=("openrouter", "ollama"), default="openrouter")
+    parser.add_argument("--algorithm", default="hybrid", choices=("knn", "content", "collaborative", "hybrid"))
+    parser.add_argument("--candidates", type=int, default=300, help="candidatos por pedido de recomendações")
+    parser.add_argument("--history-users", type=int, default=int(os.environ.get("LOAD_HISTORY_USERS", "200")))
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="ficheiro JSON do relatório (por omissão results/loadtest-<data>.json)")
+    args = parser.parse_args()
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"cenário desconhecido: {name}")
+
+    process = None if args.target else start_local_stack(args)
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_report(report)
+    output = args.output or os.path.join(LOADTEST_DIR, "results", f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nRelatório: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Arranca o ia_service (main:socket_app) para testes de carga, com as dependências externas substituídas:
+
+- Postgres em memória (benchmarks/fakes.FakePool), salvo com --real-db
+- Ollama e OpenRouter falsos noutro processo (fakes.create_fake_upstreams), com latência e streaming
+  configuráveis (FAKE_UPSTREAM_LATENCY, FAKE_UPSTREAM_TOKEN_DELAY, FAKE_UPSTREAM_TOKENS)
+- Modelo de espécies com pesos aleatórios, se SPECIES_MODEL_PATH não estiver definido
+
+Uso: python serve.py --port 8900 --upstream-port 8901
+(normalmente lançado pelo run.py; útil à parte para correr o gerador de carga noutra máquina)
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(LOADTEST_DIR)
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.join(SERVICE_DIR, "benchmarks"))
+
+import uvicorn  # noqa: E402
+
+import fakes  # noqa: E402
+
+HISTORY_ROWS = int(os.environ.get("LOAD_HISTORY_ROWS", "10000"))
+HISTORY_USERS = int(os.environ.get("LOAD_HISTORY_USERS", "200"))
+TAXA = int(os.environ.get("LOAD_TAXA", "500"))
+DOCUMENTS = int(os.environ.get("LOAD_DOCUMENTS", "1000"))
+SPECIES_CLASSES = int(os.environ.get("LOAD_SPECIES_CLASSES", "575"))
+DB_LATENCY = float(os.environ.get("LOAD_DB_LATENCY", "0.001"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+
+
+def serve_upstreams(host: str, port: int):
+    uvicorn.run(fakes.create_fake_upstreams(), host=host, port=port, log_level="warning")
+
+
+def prepare_environment(upstream_url: str):
+    workdir = tempfile.mkdtemp(prefix="ia_load_")
+    if not os.environ.get("SPECIES_MODEL_PATH"):
+        model_path, map_path = fakes.synthetic_species_model(workdir, SPECIES_CLASSES)
+        os.environ["SPECIES_MODEL_PATH"] = model_path
+        os.environ["SPECIES_MAP_PATH"] = map_path
+        os.environ["SPECIES_ANNOTATIONS_PATH"] = os.path.join(workdir, "annotations.json")
+    for name in ("SPECIES_INDEX_DIR", "KNOWN_FACES_DIR", "IDENTIFY_SPECIES_DIR"):
+        os.environ.setdefault(name, os.path.join(workdir, name.lower()))
+    os.environ["OLLAMA_URL"] = upstream_url
+    os.environ["OPENROUTER_URL"] = f"{upstream_url}/api/v1/chat/completions"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # O limite por sessão Socket.IO mediria o rate limiter e não o serviço; o admission control mantém-se
+    os.environ.setdefault("LLM_RATE_LIMIT_PER_MINUTE", "6000")
+    os.environ.setdefault("LLM_RATE_LIMIT_BURST", "100")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--upstream-port", type=int, default=8901)
+    parser.add_argument("--real-db", action="store_true", help="usa o Postgres de POSTGRES_HOST/POSTGRES_DB (como em produção) em vez do FakePool")
+    args = parser.parse_args()
+
+    upstreams = multiprocessing.Process(target=serve_upstreams, args=(args.host, args.upstream_port), daemon=True)
+    upstreams.start()
+    prepare_environment(f"http://{args.host}:{args.upstream_port}")
+
+    import main as service
+
+    if not args.real_db:
+        history = fakes.synthetic_history(HISTORY_ROWS, HISTORY_USERS, TAXA)
+        with service.SUBSYSTEMS["db_pool"].loading():
+            service._db_pool = fakes.FakePool(history, fakes.synthetic_documents(DOCUMENTS),
+                                              latency=DB_LATENCY, max_size=DB_POOL_MAX_SIZE)
+
+    try:
+        uvicorn.run(service.socket_app, host=args.host, port=args.port, log_level="warning")
+    finally:
+        upstreams.terminate()
+
+
+if __name__ == "__main__":
+    main()
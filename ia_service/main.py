@@ -1,6 +1,6 @@
-from fastapi import Body, FastAPI, HTTPException, APIRouter
+from fastapi import Body, Depends, FastAPI, HTTPException, APIRouter, Request, Response
+from fastapi.responses import FileResponse, PlainTextResponse
 from pydantic import BaseModel
-import face_recognition
 import numpy as np
 import io
 import base64
@@ -11,19 +11,404 @@ import httpx
 import socketio
 from uuid import uuid4
 import time 
-from typing import List, Dict
-from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import OneHotEncoder
+from typing import List, Dict, NamedTuple
+from functools import lru_cache
 import asyncpg
+import asyncio
 import re
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextvars
+from contextvars import ContextVar
+from functools import wraps
+import multiprocessing
+import threading
+
+from dataset.manifest import iter_records, resolve_manifest
+from dataset.taxa import load_species_map
 
-import torch
-import torchvision
-from torchvision import transforms
 from typing import Optional, List
+import face_worker
+from metrics import (
+    EXECUTOR_PENDING, EXECUTOR_WORKERS, DB_POOL_CONNECTIONS, HTTP_LATENCY, IMAGE_CLEANUP_BYTES,
+    IMAGE_CLEANUP_FILES, IMAGE_DIR_USAGE, LLM_GATE_REQUESTS, MULTIPROC_DIR,
+    mark_process_dead, observe_stage, record_cache, record_lru_cache, render as render_metrics, stage, track_event
+)
+from service_log import bind_request, debug_sampled, get_logger
+import profiling
+from json_responses import FastJSONRoute, ORJSONResponse, add_compression
+import cluster
+
+logger = get_logger("ia_service")
+
+# Com vários workers (WEB_CONCURRENCY), MESSAGE_QUEUE liga as instâncias do Socket.IO (ver cluster.py)
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', client_manager=cluster.create_client_manager())
+app = FastAPI(default_response_class=ORJSONResponse)
+app.router.route_class = FastJSONRoute  # Respostas serializadas com orjson sem jsonable_encoder (ver json_responses.py)
+
+# ==========================
+# EXECUTORES DE INFERÊNCIA
+# ==========================
+# Trabalho CPU pesado nunca corre no event loop nem no threadpool por omissão do Starlette (40 threads):
+# - face_executor: pool de processos (dlib não liberta o GIL de forma fiável), em modo spawn
+# - inference_executor: poucas threads para torch/sklearn, com torch.set_num_threads coordenado para que
+#   threads de inferência × threads intra-op de torch não excedam os cores disponíveis
+# torch/torchvision, scikit-learn e face_recognition não são importados no arranque do módulo: cada
+# subsistema carrega-os na primeira utilização ou no aquecimento em segundo plano (ver ARRANQUE E PRONTIDÃO)
+
+CPU_COUNT = os.cpu_count() or 1
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", max(1, min(4, CPU_COUNT // 2))))
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", max(1, CPU_COUNT // INFERENCE_THREADS)))
+FACE_PROCESSES = int(os.environ.get("FACE_PROCESSES", max(1, min(4, CPU_COUNT // 2))))
+
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+face_executor = ProcessPoolExecutor(max_workers=FACE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+EXECUTOR_WORKERS.labels("inference").set(INFERENCE_THREADS)
+EXECUTOR_WORKERS.labels("face").set(FACE_PROCESSES)
+
+async def _run_in(executor, name: str, fn, *args):
+    EXECUTOR_PENDING.labels(name).inc()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    finally:
+        EXECUTOR_PENDING.labels(name).dec()
+
+async def run_inference(fn, *args):
+    """Executa fn(*args) no pool de threads de inferência (torch/sklearn), com o contexto do pedido (request_id)"""
+    return await _run_in(inference_executor, "inference", contextvars.copy_context().run, profiling.call, fn, *args)
 
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
-app = FastAPI()
+async def run_face(fn, *args):
+    """Executa fn(*args) no pool de processos de face (fn tem de estar em face_worker)"""
+    return await _run_in(face_executor, "face", fn, *args)
+
+# ==========================
+# BASE DE DADOS (POOL DE LIGAÇÕES)
+# ==========================
+# Um pool asyncpg partilhado substitui o asyncpg.connect por pedido. db_connect() devolve uma ligação
+# com a mesma interface (conn.fetch/execute/close); close() devolve-a ao pool. Ligações não devolvidas
+# (ex: exceção antes do close) são libertadas no fim do pedido HTTP ou do evento Socket.IO.
+
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+# Espera máxima por uma ligação livre: com o pool esgotado, o pedido falha em vez de ficar preso
+DB_ACQUIRE_TIMEOUT = float(os.environ.get("DB_ACQUIRE_TIMEOUT", "10"))  # segundos
+
+_db_pool = None
+_db_pool_lock = asyncio.Lock()
+_open_connections: ContextVar[Optional[list]] = ContextVar("open_connections", default=None)
+
+class PooledConnection:
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._acquired_at = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        observe_stage("db", time.perf_counter() - self._acquired_at)
+        await self._pool.release(conn)
+
+async def get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        async with _db_pool_lock:
+            if _db_pool is None:
+                with SUBSYSTEMS["db_pool"].loading():
+                    _db_pool = await asyncpg.create_pool(
+                        host=os.environ.get("POSTGRES_HOST"),
+                        port=int(os.environ.get("POSTGRES_PORT")),
+                        user=os.environ.get("POSTGRES_USER"),
+                        password=os.environ.get("POSTGRES_PASSWORD"),
+                        database=os.environ.get("POSTGRES_DB"),
+                        min_size=DB_POOL_MIN_SIZE,
+                        max_size=DB_POOL_MAX_SIZE,
+                    )
+    return _db_pool
+
+async def db_connect() -> PooledConnection:
+    pool = await get_db_pool()
+    with stage("db_acquire"):
+        conn = PooledConnection(pool, await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT))
+    open_connections = _open_connections.get()
+    if open_connections is not None:
+        open_connections.append(conn)
+    return conn
+
+class db_scope:
+    """Âmbito de um pedido/evento: no fim devolve ao pool as ligações que ficaram por fechar"""
+    async def __aenter__(self):
+        self.token = _open_connections.set([])
+
+    async def __aexit__(self, *exc):
+        open_connections = _open_connections.get()
+        _open_connections.reset(self.token)
+        for conn in open_connections:
+            await conn.close()
+
+def instrumented_event(handler):
+    """Handlers Socket.IO: request_id, latência por evento e âmbito das ligações à BD (aplicar por baixo de @sio.event)"""
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        bind_request()
+        async with db_scope():
+            return await handler(*args, **kwargs)
+    return track_event(wrapper)
+
+@app.middleware("http")
+async def request_context_middleware(request: Request, call_next):
+    """request_id (X-Request-ID), âmbito das ligações à BD, latência por rota e profiling opcional"""
+    start = time.perf_counter()
+    status = 500
+    request_id = bind_request(request.headers.get("x-request-id"))
+    profile = profiling.start_request(request.headers, request.query_params, request_id)
+    try:
+        async with db_scope():
+            if profile is None:
+                response = await call_next(request)
+            else:
+                response = await _call_profiled(profile, call_next, request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_LATENCY.labels(request.method, route.path if route else "unmatched", str(status)).observe(
+            time.perf_counter() - start
+        )
+
+async def _call_profiled(profile, call_next, request: Request):
+    """Pedido com X-Profile / ?profile= (ver profiling.py): perfil guardado e indicado em X-Profile-Trace"""
+    try:
+        with profile.thread_profiler("event_loop", async_mode=True):
+            response = await call_next(request)
+    finally:
+        report_path = profiling.finish_request(profile)
+    if "inline" in profile.options:
+        with open(report_path, encoding="utf-8") as f:
+            response = Response(content=f.read(), media_type="text/plain; charset=utf-8")
+    response.headers["X-Profile-Trace"] = os.path.basename(report_path)
+    return response
+
+# Compressão gzip/brotli das respostas grandes (RESPONSE_COMPRESSION_MIN_BYTES)
+add_compression(app)
+
+# Com PROMETHEUS_MULTIPROC_DIR (vários workers), cada worker atualiza periodicamente os seus gauges:
+# o /metrics é servido por um worker qualquer e agrega os valores escritos por todos
+METRICS_REFRESH_SECONDS = float(os.environ.get("METRICS_REFRESH_SECONDS", "5"))
+
+def refresh_gauges():
+    """Estado atual deste worker: pool da BD, filas dos LLM e caches lru_cache"""
+    if _db_pool is not None:
+        DB_POOL_CONNECTIONS.labels("max").set(_db_pool.get_max_size())
+        DB_POOL_CONNECTIONS.labels("open").set(_db_pool.get_size())
+        DB_POOL_CONNECTIONS.labels("idle").set(_db_pool.get_idle_size())
+        DB_POOL_CONNECTIONS.labels("in_use").set(_db_pool.get_size() - _db_pool.get_idle_size())
+    for gate in (ollama_gate, openrouter_gate):
+        gate_stats = gate.stats()
+        LLM_GATE_REQUESTS.labels(gate.name, "active").set(gate_stats["active"])
+        LLM_GATE_REQUESTS.labels(gate.name, "queued").set(gate_stats["queued"])
+    record_lru_cache("prompt_analysis", analyse_prompt.cache_info())
+
+async def refresh_gauges_loop():
+    while True:
+        await asyncio.sleep(METRICS_REFRESH_SECONDS)
+        refresh_gauges()
+
+_metrics_refresh_task = None
+
+@app.on_event("startup")
+async def start_metrics_refresh():
+    global _metrics_refresh_task
+    if MULTIPROC_DIR and METRICS_REFRESH_SECONDS > 0:
+        _metrics_refresh_task = asyncio.create_task(refresh_gauges_loop())
+
+@app.on_event("shutdown")
+async def stop_metrics_refresh():
+    if _metrics_refresh_task is not None:
+        _metrics_refresh_task.cancel()
+    mark_process_dead()
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas no formato Prometheus"""
+    refresh_gauges()
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.on_event("shutdown")
+async def shutdown_executors():
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+    profiling.sampler.stop()
+    inference_executor.shutdown(wait=False, cancel_futures=True)
+    face_executor.shutdown(wait=False, cancel_futures=True)
+    if _db_pool is not None:
+        await _db_pool.close()
+
+# ==========================
+# ARRANQUE E PRONTIDÃO
+# ==========================
+# Os subsistemas pesados são inicializados na primeira utilização ou, com WARMUP_ON_STARTUP (ativo por
+# omissão), por uma tarefa em segundo plano lançada no arranque: o servidor aceita pedidos de imediato
+# e GET /ready indica quando cada subsistema (modelo de espécies, índice de faces, pool da BD) está pronto.
+
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+# Subsistemas que têm de estar prontos para /ready responder 200
+READINESS_REQUIRED = [
+    name.strip() for name in os.environ.get("READINESS_REQUIRED", "species_model,face_index,db_pool").split(",")
+    if name.strip()
+]
+
+class Subsystem:
+    """Estado de inicialização de um subsistema: cold -> warming -> ready | failed"""
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "cold"
+        self.error = None
+        self.load_seconds = None
+
+    @contextmanager
+    def loading(self):
+        """(Re)carregamento: regista a duração e o resultado; fail() dentro do bloco marca-o como falhado"""
+        self.state = "warming"
+        self.error = None
+        start = time.perf_counter()
+        try:
+            yield self
+        except Exception as e:
+            self.error = str(e)
+            raise
+        finally:
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            self.state = "failed" if self.error else "ready"
+            observe_stage(f"load_{self.name}", self.load_seconds)
+
+    def fail(self, error: str):
+        self.error = error
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "load_seconds": self.load_seconds, "error": self.error}
+
+SUBSYSTEMS = {name: Subsystem(name) for name in ("species_model", "face_index", "db_pool")}
+
+def _warm_species_model():
+    """Importa torch, carrega o modelo e faz um forward de aquecimento (alocações e kernels)"""
+    model, _ = get_species_model()
+    if model is not None:
+        torch, _ = _species_runtime()
+        with torch.no_grad():
+            model(torch.zeros(1, 3, 224, 224))
+
+def _warm_recommender():
+    from sklearn.neighbors import NearestNeighbors  # noqa: F401
+    from sklearn.preprocessing import OneHotEncoder  # noqa: F401
+
+async def _warm_faces():
+    # Importa o face_recognition (dlib) nos processos do pool e carrega a galeria de faces conhecidas
+    with SUBSYSTEMS["face_index"].loading():
+        await asyncio.gather(*(run_face(face_worker.warm_up) for _ in range(FACE_PROCESSES)))
+        await get_face_index()
+
+async def warm_up():
+    """Aquece todos os subsistemas em paralelo; a falha de um não impede os restantes"""
+    async def warm(name, coro):
+        try:
+            await coro
+        except Exception as e:
+            logger.warning("warmup_failed", extra={"subsystem": name, "error": str(e)})
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        warm("db_pool", get_db_pool()),
+        warm("species_model", run_inference(_warm_species_model)),
+        warm("face_index", _warm_faces()),
+        warm("recommender", run_inference(_warm_recommender)),
+    )
+    logger.info("warmup_finished", extra={
+        "seconds": round(time.perf_counter() - start, 3),
+        "subsystems": {name: subsystem.state for name, subsystem in SUBSYSTEMS.items()},
+    })
+
+_warmup_task = None
+
+@app.on_event("startup")
+async def start_warmup():
+    global _warmup_task
+    if WARMUP_ON_STARTUP:
+        _warmup_task = asyncio.create_task(warm_up())
+
+@app.get("/ready")
+async def readiness(response: Response):
+    """Prontidão por subsistema: 503 enquanto algum subsistema de READINESS_REQUIRED não estiver pronto"""
+    ready = all(SUBSYSTEMS[name].state == "ready" for name in READINESS_REQUIRED if name in SUBSYSTEMS)
+    response.status_code = 200 if ready else 503
+    return {
+        "ready": ready,
+        "required": READINESS_REQUIRED,
+        "subsystems": {name: subsystem.snapshot() for name, subsystem in SUBSYSTEMS.items()},
+    }
+
+# ==========================
+# PROFILING (ADMINISTRAÇÃO)
+# ==========================
+# Perfis por pedido (X-Profile / ?profile=) no middleware; aqui a amostragem contínua e os ficheiros
+# guardados. Só com PROFILING_ENABLED e, se definido, o cabeçalho X-Profile-Token (ver profiling.py).
+
+def require_profiling(request: Request):
+    if not profiling.PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling desligado (PROFILING_ENABLED)")
+    if not profiling.authorized(request.headers):
+        raise HTTPException(status_code=403, detail="X-Profile-Token inválido")
+
+class ContinuousProfilingConfig(BaseModel):
+    enabled: bool
+    interval_ms: Optional[float] = None
+    reset: bool = False
+
+@app.get("/admin/profiling", dependencies=[Depends(require_profiling)])
+async def profiling_status():
+    return {
+        "engine": profiling.engine(),
+        "continuous": profiling.sampler.status(),
+        "traces": profiling.list_traces(),
+    }
+
+@app.post("/admin/profiling/continuous", dependencies=[Depends(require_profiling)])
+async def set_continuous_profiling(config: ContinuousProfilingConfig):
+    """Liga/desliga a amostragem contínua das stacks (reset apaga as amostras acumuladas)"""
+    if config.reset:
+        profiling.sampler.reset()
+    if config.enabled:
+        profiling.sampler.start(config.interval_ms)
+    else:
+        await asyncio.to_thread(profiling.sampler.stop)
+    logger.info("continuous_profiling", extra=profiling.sampler.status())
+    return profiling.sampler.status()
+
+@app.get("/admin/profiling/continuous/stacks", dependencies=[Depends(require_profiling)])
+async def continuous_profiling_stacks():
+    """Stacks colapsadas (flamegraph.pl / speedscope)"""
+    return PlainTextResponse(await asyncio.to_thread(profiling.sampler.collapsed))
+
+@app.get("/admin/profiling/traces/{name}", dependencies=[Depends(require_profiling)])
+async def profiling_trace(name: str):
+    path = profiling.trace_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    return FileResponse(path)
+
+@app.on_event("startup")
+async def start_continuous_profiling():
+    if profiling.PROFILING_ENABLED and profiling.PROFILING_CONTINUOUS:
+        profiling.sampler.start()
 
 @app.get("/debug_checkpoint_start")
 async def debug_checkpoint_start():
@@ -31,17 +416,114 @@ async def debug_checkpoint_start():
     return {"checkpoint": "start", "status": "ok"}
 
 
-def clean_old_images(directory, max_age_minutes=10):
+# ==========================
+# LIMPEZA DE IMAGENS TEMPORÁRIAS
+# ==========================
+# As imagens que a API grava em IDENTIFY_SPECIES_DIR são apagadas por uma tarefa periódica, fora do
+# caminho dos pedidos: ficheiros mais antigos que IMAGE_RETENTION_MINUTES e, acima dos limites de
+# tamanho/número (0 = sem limite), os mais antigos primeiro. Os limites de tamanho nunca apagam ficheiros
+# com menos de IMAGE_CLEANUP_MIN_AGE segundos (podem estar à espera de ser processados).
+
+IMAGE_CLEANUP_INTERVAL = float(os.environ.get("IMAGE_CLEANUP_INTERVAL", "60"))  # segundos
+IMAGE_RETENTION_MINUTES = float(os.environ.get("IMAGE_RETENTION_MINUTES", "10"))
+IMAGE_DIR_MAX_MB = float(os.environ.get("IMAGE_DIR_MAX_MB", "0"))
+IMAGE_DIR_MAX_FILES = int(os.environ.get("IMAGE_DIR_MAX_FILES", "0"))
+IMAGE_CLEANUP_MIN_AGE = float(os.environ.get("IMAGE_CLEANUP_MIN_AGE", "60"))
+IMAGE_CLEANUP_BATCH = int(os.environ.get("IMAGE_CLEANUP_BATCH", "500"))
+
+def plan_image_cleanup(directory, max_age_minutes=10, max_bytes=0, max_files=0, min_age_seconds=60):
+    """
+    Uma passagem com os.scandir: devolve ([(caminho, bytes, motivo)] a apagar, ficheiros restantes,
+    bytes restantes). motivo: "expired" (retenção) ou "size_cap" (limites de tamanho/número).
+    """
     now = time.time()
-    for fname in os.listdir(directory):
-        fpath = os.path.join(directory, fname)
-        if os.path.isfile(fpath):
-            file_age = (now - os.path.getmtime(fpath)) / 60  # em minutos
-            if file_age > max_age_minutes:
-                try:
-                    os.remove(fpath)
-                except Exception:
-                    pass
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+            except OSError:  # Apagado entretanto
+                continue
+    files.sort()  # Mais antigos primeiro
+    expired_before = now - max_age_minutes * 60
+    plan = [(path, size, "expired") for mtime, path, size in files if mtime < expired_before]
+    kept = [(mtime, path, size) for mtime, path, size in files if mtime >= expired_before]
+    kept_bytes = sum(size for _, _, size in kept)
+    for mtime, path, size in list(kept):
+        over = (max_bytes and kept_bytes > max_bytes) or (max_files and len(kept) > max_files)
+        if not over or now - mtime < min_age_seconds:
+            break
+        plan.append((path, size, "size_cap"))
+        kept.pop(0)
+        kept_bytes -= size
+    return plan, len(kept), kept_bytes
+
+def remove_files(batch):
+    """Apaga um lote do plano; devolve {motivo: (ficheiros, bytes)} do que foi efetivamente apagado"""
+    removed = {}
+    for path, size, reason in batch:
+        try:
+            os.remove(path)
+        except OSError:  # Já apagado (outro worker) ou sem permissão
+            continue
+        files, reclaimed = removed.get(reason, (0, 0))
+        removed[reason] = (files + 1, reclaimed + size)
+    return removed
+
+def clean_old_images(directory, max_age_minutes=10, max_bytes=0, max_files=0, min_age_seconds=60):
+    """Limpeza síncrona completa (ver cleanup_images para a versão em lotes no event loop)"""
+    plan, _, _ = plan_image_cleanup(directory, max_age_minutes, max_bytes, max_files, min_age_seconds)
+    return remove_files(plan)
+
+async def cleanup_images(directory):
+    """Uma passagem de limpeza: o scan e cada lote de remoções correm numa thread, com métricas por lote"""
+    with stage("image_cleanup"):
+        plan, kept_files, kept_bytes = await asyncio.to_thread(
+            plan_image_cleanup, directory, IMAGE_RETENTION_MINUTES,
+            int(IMAGE_DIR_MAX_MB * 1024 * 1024), IMAGE_DIR_MAX_FILES, IMAGE_CLEANUP_MIN_AGE,
+        )
+        totals = {}
+        for start in range(0, len(plan), IMAGE_CLEANUP_BATCH):
+            removed = await asyncio.to_thread(remove_files, plan[start:start + IMAGE_CLEANUP_BATCH])
+            for reason, (files, reclaimed) in removed.items():
+                IMAGE_CLEANUP_FILES.labels(reason).inc(files)
+                IMAGE_CLEANUP_BYTES.labels(reason).inc(reclaimed)
+                total_files, total_bytes = totals.get(reason, (0, 0))
+                totals[reason] = (total_files + files, total_bytes + reclaimed)
+    IMAGE_DIR_USAGE.labels("files").set(kept_files)
+    IMAGE_DIR_USAGE.labels("bytes").set(kept_bytes)
+    if totals:
+        logger.info("images_cleaned", extra={
+            "dir": directory,
+            "removed": {reason: files for reason, (files, _) in totals.items()},
+            "bytes": sum(reclaimed for _, reclaimed in totals.values()),
+        })
+    return totals
+
+async def image_cleanup_loop():
+    while True:
+        directory = os.environ.get("IDENTIFY_SPECIES_DIR")
+        if directory and os.path.isdir(directory):
+            try:
+                await cleanup_images(directory)
+            except Exception as e:
+                logger.warning("image_cleanup_failed", extra={"dir": directory, "error": str(e)})
+        await asyncio.sleep(IMAGE_CLEANUP_INTERVAL)
+
+_image_cleanup_task = None
+
+@app.on_event("startup")
+async def start_image_cleanup():
+    global _image_cleanup_task
+    if IMAGE_CLEANUP_INTERVAL > 0:
+        _image_cleanup_task = asyncio.create_task(image_cleanup_loop())
+
+@app.on_event("shutdown")
+async def stop_image_cleanup():
+    if _image_cleanup_task is not None:
+        _image_cleanup_task.cancel()
 
 
 
@@ -69,27 +551,38 @@ class RegisterFaceBatchData(BaseModel):
     images: List[str]  # lista de imagens base64
 
 @app.post("/register_faces_batch")
-def register_faces_batch(data: RegisterFaceBatchData):
+async def register_faces_batch(data: RegisterFaceBatchData):
     """
     Recebe várias imagens base64, seleciona as melhores (com face clara) e guarda-as.
+    A deteção de faces das imagens corre em paralelo no pool de processos.
     """
     KNOWN_FACES_DIR = os.environ.get("KNOWN_FACES_DIR")
     os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
     selected = 0
     max_to_save = 5
-    for idx, img_b64 in enumerate(data.images):
+    decoded = []
+    for img_b64 in data.images:
         try:
-            image_data = base64.b64decode(img_b64)
-            image = Image.open(io.BytesIO(image_data)).convert("RGB")
-            image_np = np.array(image)
-            faces = face_recognition.face_locations(image_np)
-            # Só guarda se detetar exatamente uma face
-            if len(faces) == 1 and selected < max_to_save:
+            decoded.append(base64.b64decode(img_b64))
+        except Exception:
+            decoded.append(None)
+    with stage("face_detect"):
+        face_counts = await asyncio.gather(*(
+            run_face(face_worker.count_faces, image_data) for image_data in decoded if image_data is not None
+        ))
+    face_counts = iter(face_counts)
+    for image_data in decoded:
+        if image_data is None:
+            continue
+        # Só guarda se detetar exatamente uma face
+        if next(face_counts) == 1 and selected < max_to_save:
+            try:
+                image = Image.open(io.BytesIO(image_data)).convert("RGB")
                 filename = f"{data.email}_{selected+1}.jpg"
                 image.save(os.path.join(KNOWN_FACES_DIR, filename))
                 selected += 1
-        except Exception:
-            continue
+            except Exception:
+                continue
     return {"saved": selected, "total": len(data.images)}
 
 
@@ -97,75 +590,130 @@ def register_faces_batch(data: RegisterFaceBatchData):
 # 2. RECONHECIMENTO FACIAL
 # ==========================
 
-def load_known_faces():
-    """Carrega faces conhecidas dinamicamente do diretório"""
-    KNOWN_FACES_DIR = os.environ.get("KNOWN_FACES_DIR")
-    known_encodings = []
-    known_emails = []
-    
-    if not KNOWN_FACES_DIR or not os.path.exists(KNOWN_FACES_DIR):
-        print(f"[DEBUG] Diretório de faces não existe: {KNOWN_FACES_DIR}")
-        return known_encodings, known_emails
-    
-    files = os.listdir(KNOWN_FACES_DIR)
-    print(f"[DEBUG] Arquivos encontrados: {files}")
-    
-    for filename in files:
-        if filename.lower().endswith((".jpg", ".jpeg", ".png")):
-            try:
-                filepath = os.path.join(KNOWN_FACES_DIR, filename)
-                image = face_recognition.load_image_file(filepath)
-                encodings = face_recognition.face_encodings(image)
-                
-                if encodings:
-                    known_encodings.append(encodings[0])
-                    # Extrair email do nome do arquivo (remove extensão e possível número)
-                    email = os.path.splitext(filename)[0]
-                    # Remove números do final se existirem (ex: "user@email.com_1" -> "user@email.com")
-                    email = email.split('_')[0] if '_' in email else email
-                    known_emails.append(email)
-                    print(f"[DEBUG] Face carregada: {filename} -> {email}")
-                else:
-                    print(f"[DEBUG] Nenhuma face encontrada em: {filename}")
-            except Exception as e:
-                print(f"[DEBUG] Erro ao carregar {filename}: {str(e)}")
-    
-    print(f"[DEBUG] Total de faces carregadas: {len(known_encodings)}")
-    return known_encodings, known_emails
+# Galeria de faces conhecidas (índice): calculada no pool de processos e mantida em memória até o
+# diretório mudar (fotos adicionadas, substituídas ou removidas pelo serviço ou pela API).
+# Com FACE_INDEX_DIR, o índice é guardado em disco (.npy) por assinatura do diretório: só um worker o
+# calcula (flock) e todos o abrem memory-mapped, partilhando as páginas em vez de manter cópias.
+FACE_INDEX_DIR = os.environ.get("FACE_INDEX_DIR", "")
+
+_face_index_cache = {"key": None, "encodings": None, "emails": []}
+_face_index_lock = asyncio.Lock()
+
+def _known_faces_key(known_faces_dir):
+    if not known_faces_dir or not os.path.isdir(known_faces_dir):
+        return None
+    with os.scandir(known_faces_dir) as entries:
+        return tuple(sorted(
+            (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries if entry.is_file()
+        ))
+
+def _face_index_paths(key):
+    digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(FACE_INDEX_DIR, f"faces-{digest}.npy"), os.path.join(FACE_INDEX_DIR, f"faces-{digest}.json")
+
+def _read_face_index(key):
+    """Índice guardado por outro worker (encodings memory-mapped, emails), ou None"""
+    npy_path, json_path = _face_index_paths(key)
+    try:
+        with open(json_path, encoding="utf-8") as f:
+            emails = json.load(f)
+        return np.load(npy_path, mmap_mode="r"), emails
+    except (OSError, ValueError):
+        return None
+
+def _write_face_index(key, encodings, emails):
+    npy_path, json_path = _face_index_paths(key)
+    # Escrita atómica (tmp + replace): o .json só aparece depois do .npy completo
+    np.save(npy_path + ".tmp.npy", encodings)
+    os.replace(npy_path + ".tmp.npy", npy_path)
+    with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(emails, f)
+    os.replace(json_path + ".tmp", json_path)
+    # Índices de versões anteriores da galeria (os workers que ainda os usam mantêm o mapeamento aberto)
+    current = {os.path.basename(npy_path), os.path.basename(json_path)}
+    with os.scandir(FACE_INDEX_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith("faces-") and entry.name not in current:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+def _lock_face_index():
+    import fcntl
+
+    os.makedirs(FACE_INDEX_DIR, exist_ok=True)
+    fd = os.open(os.path.join(FACE_INDEX_DIR, ".lock"), os.O_CREAT | os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+async def _load_face_index(known_faces_dir, key):
+    if not FACE_INDEX_DIR:
+        encodings, emails = await run_face(face_worker.load_known_faces, known_faces_dir)
+        return np.asarray(encodings, dtype=np.float64).reshape(-1, 128), emails
+    shared = await asyncio.to_thread(_read_face_index, key)
+    if shared is not None:
+        return shared
+    fd = await asyncio.to_thread(_lock_face_index)
+    try:
+        shared = await asyncio.to_thread(_read_face_index, key)  # Outro worker pode tê-lo calculado entretanto
+        if shared is None:
+            encodings, emails = await run_face(face_worker.load_known_faces, known_faces_dir)
+            encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, 128)
+            await asyncio.to_thread(_write_face_index, key, encodings, emails)
+            shared = await asyncio.to_thread(_read_face_index, key)
+    finally:
+        os.close(fd)  # Liberta o flock
+    return shared
+
+async def get_face_index():
+    """(encodings N×128, emails) das faces conhecidas, recarregados só quando o diretório muda"""
+    known_faces_dir = os.environ.get("KNOWN_FACES_DIR")
+    key = await asyncio.to_thread(_known_faces_key, known_faces_dir)
+    async with _face_index_lock:
+        hit = _face_index_cache["key"] == key and _face_index_cache["encodings"] is not None
+        record_cache("face_index", hit)
+        if not hit:
+            with SUBSYSTEMS["face_index"].loading():
+                encodings, emails = await _load_face_index(known_faces_dir, key)
+                _face_index_cache.update({"key": key, "encodings": encodings, "emails": emails})
+    return _face_index_cache["encodings"], _face_index_cache["emails"]
 
 class ImageData(BaseModel):
     image: str  # base64 string
 
 
+def match_face(known_encodings, face_encoding):
+    """(índice, distância euclidiana) da face conhecida mais próxima (igual a face_recognition.face_distance)"""
+    distances = np.linalg.norm(np.asarray(known_encodings) - face_encoding, axis=1)
+    best = int(np.argmin(distances))
+    return best, float(distances[best])
+
 @app.post("/recognize")
-def recognize_face(data: ImageData):
+async def recognize_face(data: ImageData):
     """
     Recebe uma imagem base64, deteta e reconhece a face.
     Retorna o email correspondente (se reconhecido) e a confiança.
     """
-    # Carregar faces conhecidas dinamicamente
-    known_encodings, known_emails = load_known_faces()
-    
     try:
         image_data = base64.b64decode(data.image)
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
-        image_np = np.array(image)
-
-        face_locations = face_recognition.face_locations(image_np)
-        face_encodings = face_recognition.face_encodings(image_np, face_locations)
+        # Encoding da imagem no pool de processos; a galeria de faces conhecidas vem da cache (get_face_index)
+        with stage("face_encode"):
+            (known_encodings, known_emails), face_encodings = await asyncio.gather(
+                get_face_index(),
+                run_face(face_worker.encode_faces, image_data),
+            )
 
         if not face_encodings:
             return {"email": None, "confidence": 0, "error": "Nenhuma face detetada na imagem."}
         
-        if not known_encodings:
+        if not len(known_encodings):
             return {"email": None, "confidence": 0, "error": "Nenhuma face conhecida registada."}
 
-        face_to_check = face_encodings[0]
-        distances = face_recognition.face_distance(known_encodings, face_to_check)
-        best_match_index = np.argmin(distances)
-        confidence = 1 - distances[best_match_index]
+        best_match_index, distance = match_face(known_encodings, face_encodings[0])
+        confidence = 1 - distance
 
-        print(f"[DEBUG] Melhor correspondência: {known_emails[best_match_index]} (confiança: {confidence:.2f})")
+        debug_sampled(logger, "face_match", email=known_emails[best_match_index], confidence=round(float(confidence), 3))
 
         if confidence > 0.4:  # Reduzir threshold para teste
             return {
@@ -179,7 +727,7 @@ def recognize_face(data: ImageData):
                 "error": f"Confiança muito baixa ({confidence:.2f})"
             }
     except Exception as e:
-        print(f"[DEBUG] Erro ao processar imagem: {str(e)}")
+        logger.warning("face_recognition_failed", extra={"error": str(e)})
         raise HTTPException(status_code=400, detail=f"Erro ao processar imagem: {str(e)}")
 
 # ==========================
@@ -192,44 +740,107 @@ class SpeciesImageData(BaseModel):
 class SpeciesBatchImageData(BaseModel):
     images: List[str]
 
+@lru_cache(maxsize=None)
+def _species_runtime():
+    """torch e transforms das imagens, importados só na primeira utilização do modelo: (torch, transform)"""
+    import torch
+    from torchvision import transforms
+
+    torch.set_num_threads(TORCH_THREADS)
+    # Transforms para as imagens (ajusta conforme o treino do modelo feito)
+    transform = transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        # Normalização típica para modelos ImageNet
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    return torch, transform
+
+# Pesos mapeados do ficheiro: com vários workers, uma só cópia na cache de páginas do sistema operativo
+SPECIES_MODEL_MMAP = os.environ.get("SPECIES_MODEL_MMAP", "true").lower() in ("1", "true", "yes")
+
 def load_species_model():
     """Carrega o modelo de espécies dinamicamente"""
     MODEL_PATH = os.environ.get("SPECIES_MODEL_PATH")
     SPECIES_MAP_PATH = os.environ.get("SPECIES_MAP_PATH", "species_taxon_map.json")
     
     if not MODEL_PATH or not os.path.exists(MODEL_PATH):
-        print(f"[DEBUG] Modelo não encontrado: {MODEL_PATH}")
+        logger.warning("species_model_missing", extra={"path": MODEL_PATH})
         return None, {}
     
     if not SPECIES_MAP_PATH or not os.path.exists(SPECIES_MAP_PATH):
-        print(f"[DEBUG] Mapa de espécies não encontrado: {SPECIES_MAP_PATH}")
+        logger.warning("species_map_missing", extra={"path": SPECIES_MAP_PATH})
         return None, {}
     
     try:
-        torch.serialization.add_safe_globals([torchvision.models.resnet.ResNet])
-        model = torch.load(MODEL_PATH, map_location=torch.device('cpu'), weights_only=False)
-        model.eval()
+        _species_runtime()
+        from dataset.embedding_index import load_resnet18
+
+        # O ficheiro contém apenas os pesos (state_dict): a arquitetura é reconstruída em load_resnet18
+        try:
+            model = load_resnet18(MODEL_PATH, mmap=SPECIES_MODEL_MMAP)
+        except RuntimeError:  # Ficheiros no formato antigo (não zip) não podem ser mapeados
+            model = load_resnet18(MODEL_PATH)
         
-        with open(SPECIES_MAP_PATH, encoding="utf-8") as f:
-            idx_to_info = json.load(f)
+        # Mapa canónico (dataset/taxa.py); mapas antigos são completados com as anotações
+        idx_to_info = load_species_map(SPECIES_MAP_PATH, os.environ.get("SPECIES_ANNOTATIONS_PATH"))
         
-        print(f"[DEBUG] Modelo carregado com sucesso!")
-        print(f"[DEBUG] Espécies no mapa: {len(idx_to_info)}")
+        logger.info("species_model_loaded", extra={"path": MODEL_PATH, "species": len(idx_to_info)})
         return model, idx_to_info
     except Exception as e:
-        print(f"[DEBUG] Erro ao carregar modelo: {str(e)}")
+        logger.error("species_model_load_failed", extra={"path": MODEL_PATH, "error": str(e)})
         return None, {}
 
-# Transforms para as imagens (ajusta conforme o treino do modelo feito)
-species_transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    # Normalização típica para modelos ImageNet
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
+# Instância partilhada do modelo (recarregada apenas quando os ficheiros mudam)
+_species_model_cache = {"key": None, "model": None, "idx_to_info": {}, "sha256": None}
+_species_model_lock = threading.Lock()  # As threads de inferência partilham a mesma instância
+
+def _file_key(path):
+    return (path, os.path.getmtime(path)) if path and os.path.exists(path) else (path, None)
+
+def get_species_model():
+    """Modelo e mapa de espécies partilhados por /identify_species e /search_species"""
+    key = (
+        _file_key(os.environ.get("SPECIES_MODEL_PATH")),
+        _file_key(os.environ.get("SPECIES_MAP_PATH", "species_taxon_map.json")),
+    )
+    with _species_model_lock:
+        hit = _species_model_cache["key"] == key and _species_model_cache["model"] is not None
+        record_cache("species_model", hit)
+        if not hit:
+            with SUBSYSTEMS["species_model"].loading() as subsystem:
+                model, idx_to_info = load_species_model()
+                if model is None or not idx_to_info:
+                    subsystem.fail("Modelo de espécies não carregado ou mapa de espécies vazio")
+                    sha256 = None
+                else:
+                    from dataset.embedding_index import file_sha256
+                    sha256 = file_sha256(key[0][0])
+            _species_model_cache.update({"key": key, "model": model, "idx_to_info": idx_to_info, "sha256": sha256})
+        return _species_model_cache["model"], _species_model_cache["idx_to_info"]
+
+_species_index_cache = {"key": None, "index": None}
+
+def get_species_index():
+    """Índice de embeddings memory-mapped (dataset/embedding_index.py), ou None se não existir"""
+    index_dir = os.environ.get("SPECIES_INDEX_DIR", "dataset/species_index")
+    key = _file_key(os.path.join(index_dir, "index_meta.json"))
+    record_cache("species_index", _species_index_cache["key"] == key)
+    if _species_index_cache["key"] != key:
+        index = None
+        if key[1] is not None:
+            try:
+                from dataset.embedding_index import EmbeddingIndex
+
+                index = EmbeddingIndex(index_dir)
+                logger.info("species_index_loaded", extra={"dir": index_dir, "images": len(index)})
+            except Exception as e:
+                logger.error("species_index_load_failed", extra={"dir": index_dir, "error": str(e)})
+        _species_index_cache.update({"key": key, "index": index})
+    return _species_index_cache["index"]
 
 @app.post("/identify_species")
-def identify_species(
+async def identify_species(
     image: Optional[str] = Body(None),
     images: Optional[List[str]] = Body(None)
 ):
@@ -238,11 +849,13 @@ def identify_species(
     - Se receber 'image': processa uma imagem.
     - Se receber 'images': processa várias imagens (batch).
     """
-    IDENTIFY_SPECIES_DIR = os.environ.get("IDENTIFY_SPECIES_DIR")
-    model, idx_to_info = load_species_model()
+    return await run_inference(_identify_species, image, images)
+
+def _identify_species(image: Optional[str], images: Optional[List[str]]):
+    model, idx_to_info = get_species_model()
     
-    print(f"[DEBUG] Modelo carregado: {model is not None}")
-    print(f"[DEBUG] Mapa de espécies: {len(idx_to_info)} espécies")
+    debug_sampled(logger, "identify_species", model_loaded=model is not None, species=len(idx_to_info),
+                  batch_size=len(images) if images else 1)
     
     if model is None or not idx_to_info:
         return {
@@ -255,10 +868,6 @@ def identify_species(
             }
         }
     
-    # Limpa imagens antigas antes de processar
-    if IDENTIFY_SPECIES_DIR and os.path.exists(IDENTIFY_SPECIES_DIR):
-        clean_old_images(IDENTIFY_SPECIES_DIR, max_age_minutes=10)
-    
      # --- Batch ---
     if images:
         predictions = []
@@ -310,7 +919,7 @@ def identify_species(
             result = _identify_species_single(image, model, idx_to_info)
             return result
         except Exception as e:
-            print(f"[DEBUG] Erro ao identificar espécie: {str(e)}")
+            logger.warning("identify_species_failed", extra={"error": str(e)})
             return {
                 "error": f"Erro ao identificar espécie: {str(e)}",
                 "debug": {
@@ -320,24 +929,29 @@ def identify_species(
             }
     return {"error": "Nenhuma imagem fornecida."}
 
-def _identify_species_single(image_b64: str, model, idx_to_info):
-    image_data = base64.b64decode(image_b64)
-    image = Image.open(io.BytesIO(image_data)).convert("RGB")
-    input_tensor = species_transform(image).unsqueeze(0)
-    print(f"[DEBUG] Imagem processada: {input_tensor.shape}")
-    with torch.no_grad():
-        outputs = model(input_tensor)
+def _identify_species_single(image_b64: str, model, idx_to_info, return_embedding: bool = False):
+    from dataset.embedding_index import resnet_forward
+
+    torch, species_transform = _species_runtime()
+    with stage("decode"):
+        image_data = base64.b64decode(image_b64)
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    with stage("preprocess"):
+        input_tensor = species_transform(image).unsqueeze(0)
+    with stage("forward"), torch.no_grad(), profiling.torch_forward():
+        # Um único forward devolve os logits e o embedding da penúltima camada
+        outputs, embedding = resnet_forward(model, input_tensor)
         probs = torch.softmax(outputs, dim=1)
         confidence, predicted = torch.max(probs, 1)
         label = predicted.item()
-    print(f"[DEBUG] Predição - Label: {label}, Confiança: {confidence.item():.3f}")
     if 0 <= label < len(idx_to_info):
         species_info = idx_to_info[label]
-        print(f"[DEBUG] Espécie encontrada: {species_info.get('sci_name', 'Desconhecido')}")
+        debug_sampled(logger, "species_prediction", label=label, confidence=round(confidence.item(), 3),
+                      species=species_info.get("sci_name"))
     else:
         species_info = {}
-        print(f"[DEBUG] Label fora do range: {label} (máx: {len(idx_to_info)-1})")
-    return {
+        logger.warning("species_label_out_of_range", extra={"label": label, "species": len(idx_to_info)})
+    result = {
         "label": label,
         "species": species_info.get("sci_name", "Desconhecido"),
         "common_name": species_info.get("common_name", ""),
@@ -351,6 +965,73 @@ def _identify_species_single(image_b64: str, model, idx_to_info):
             "prediction_in_range": 0 <= label < len(idx_to_info)
         }
     }
+    if return_embedding:
+        result["embedding"] = embedding[0].numpy()
+    return result
+
+class SpeciesSearchData(BaseModel):
+    image: str  # base64 string
+    top_k: int = 5
+
+@app.post("/search_species")
+async def search_species(data: SpeciesSearchData):
+    """
+    Pesquisa por imagem (open-set): classifica a foto e procura as fotos rotuladas mais próximas
+    no índice de embeddings do treino/validação. Se a maior similaridade ficar abaixo de
+    SPECIES_UNKNOWN_SIMILARITY, a imagem é marcada como "espécie desconhecida".
+    """
+    return await run_inference(_search_species, data)
+
+def _search_species(data: SpeciesSearchData):
+    model, idx_to_info = get_species_model()
+    if model is None or not idx_to_info:
+        return {"error": "Modelo de espécies não carregado ou mapa de espécies vazio"}
+    index = get_species_index()
+    if index is None:
+        return {"error": "Índice de embeddings não encontrado (dataset/embedding_index.py)"}
+    if index.model_sha256 != _species_model_cache["sha256"]:
+        return {"error": "Índice de embeddings construído com outro modelo; é necessário reconstruí-lo"}
+
+    try:
+        result = _identify_species_single(data.image, model, idx_to_info, return_embedding=True)
+    except Exception as e:
+        logger.warning("species_search_failed", extra={"error": str(e)})
+        return {"error": f"Erro na pesquisa por imagem: {str(e)}"}
+    embedding = result.pop("embedding")
+    result.pop("debug", None)
+
+    # Informação do taxon por nome de classe (pasta do dataset = taxon_id)
+    info_by_class = {str(info.get("class_name")): info for info in idx_to_info}
+    neighbors = []
+    species = {}
+    with stage("index_search"):
+        matches = index.search(embedding, top_k=max(1, min(data.top_k, 50)))
+    for row, similarity in matches:
+        entry = index.entries[row]
+        info = info_by_class.get(entry["label"], {})
+        neighbors.append({
+            "image": entry["image"],
+            "split": entry["split"],
+            "taxon_id": info.get("taxon_id", entry["label"]),
+            "species": info.get("sci_name", "Desconhecido"),
+            "common_name": info.get("common_name", ""),
+            "similarity": round(similarity, 4),
+        })
+        # Espécies pela melhor similaridade de uma das suas fotos
+        taxon_id = neighbors[-1]["taxon_id"]
+        if taxon_id not in species:
+            species[taxon_id] = {k: neighbors[-1][k] for k in ("taxon_id", "species", "common_name", "similarity")}
+
+    threshold = float(os.environ.get("SPECIES_UNKNOWN_SIMILARITY", "0.6"))
+    best_similarity = neighbors[0]["similarity"] if neighbors else 0.0
+    result.update({
+        "unknown_species": best_similarity < threshold,
+        "best_similarity": best_similarity,
+        "similarity_threshold": threshold,
+        "neighbors": neighbors,
+        "nearest_species": list(species.values()),
+    })
+    return result
 
 # ==========================
 # 3. RECOMENDAÇÂO DE ESPÉCIES
@@ -363,7 +1044,11 @@ class RecommendationRequest(BaseModel):
     candidates: List[Dict]
 
 @app.post("/recommendations")
-def recommend(data: RecommendationRequest):
+async def recommend(data: RecommendationRequest):
+    # sklearn (one-hot + KNN) corre no pool de inferência
+    return await run_inference(_recommend, data)
+
+def _recommend(data: RecommendationRequest):
     # 1. Prepara os dados dos candidatos (só com grupo válido)
     candidates = [c for c in data.candidates if c.get("group")]
     taxon_ids = [str(c["taxon_id"]) for c in candidates]
@@ -378,6 +1063,9 @@ def recommend(data: RecommendationRequest):
         filtered = [c for c in data.candidates if str(c["taxon_id"]) not in data.seen_taxon_ids]
         return {"results": filtered[:10]}
 
+    from sklearn.neighbors import NearestNeighbors
+    from sklearn.preprocessing import OneHotEncoder
+
     # 3. One-hot encoding dos features
     encoder = OneHotEncoder(sparse_output=False)
     X = encoder.fit_transform(features)
@@ -403,10 +1091,10 @@ def recommend(data: RecommendationRequest):
 
     # 6. Filtra para não recomendar já vistos/favoritos
     recommended = []
-    print("=== Recomendações por proximidade (distância do KNN) ===")
     for dist, idx in zip(distances[0], indices[0]):
         especie = candidates[idx]
-        print(f"Distância: {dist:.4f} | Nome comum: {especie.get('common_name')} | Grupo: {especie.get('group')} | Família: {especie.get('family')} | taxon_id: {especie.get('taxon_id')}")
+        debug_sampled(logger, "knn_neighbor", distance=round(float(dist), 4), taxon_id=especie.get("taxon_id"),
+                      group=especie.get("group"), family=especie.get("family"))
         if taxon_ids[idx] not in data.seen_taxon_ids:
             recommended.append(especie)
         if len(recommended) == 10:
@@ -439,13 +1127,7 @@ class UserInteractionData(BaseModel):
 async def record_interaction(data: UserInteractionData):
     """Regista interações do utilizador na base de dados para melhorar recomendações"""
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
+        conn = await db_connect()
         
         await conn.execute(
             """INSERT INTO user_species_history (user_id, taxon_id, action, created_at) 
@@ -461,24 +1143,18 @@ async def record_interaction(data: UserInteractionData):
 async def get_user_interactions(user_id: str, limit: int = 100):
     """Obtém interações do utilizador da base de dados"""
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
-        
-        rows = await conn.fetch(
-            """SELECT taxon_id, action, created_at 
-               FROM user_species_history 
-               WHERE user_id = $1 
-               ORDER BY created_at DESC 
-               LIMIT $2""",
-            int(user_id), limit
-        )
-        
-        await conn.close()
+        conn = await db_connect()
+        try:
+            rows = await conn.fetch(
+                """SELECT taxon_id, action, created_at 
+                   FROM user_species_history 
+                   WHERE user_id = $1 
+                   ORDER BY created_at DESC 
+                   LIMIT $2""",
+                int(user_id), limit
+            )
+        finally:
+            await conn.close()
         
         interactions = []
         for row in rows:
@@ -490,7 +1166,7 @@ async def get_user_interactions(user_id: str, limit: int = 100):
         
         return interactions
     except Exception as e:
-        print(f"Erro ao obter interações: {e}")
+        logger.error("user_interactions_failed", extra={"user_id": user_id, "error": str(e)})
         return []
 
 @app.post("/advanced_recommendations")
@@ -508,6 +1184,19 @@ async def advanced_recommend(data: AdvancedRecommendationRequest):
     else:
         return {"error": "Algoritmo não suportado"}
 
+def _knn_rank(features: list, user_features: list, n_neighbors: int):
+    """One-hot encoding + KNN (cosseno) do vetor médio de preferências: (distâncias, índices)"""
+    from sklearn.neighbors import NearestNeighbors
+    from sklearn.preprocessing import OneHotEncoder
+
+    encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
+    X = encoder.fit_transform(features)
+    user_vec = encoder.transform(user_features).mean(axis=0).reshape(1, -1)
+    knn = NearestNeighbors(n_neighbors=min(n_neighbors, len(X)), metric='cosine')
+    knn.fit(X)
+    distances, indices = knn.kneighbors(user_vec)
+    return distances[0], indices[0]
+
 async def _knn_recommendations(data: AdvancedRecommendationRequest):
     """Recomendações baseadas em KNN """
     candidates = [c for c in data.candidates if c.get("group")]
@@ -526,9 +1215,6 @@ async def _knn_recommendations(data: AdvancedRecommendationRequest):
         )
         features.append(feature_tuple)
     
-    encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
-    X = encoder.fit_transform(features)
-    
     # Vetor de preferências baseado em interações passadas (da base de dados)
     user_interactions_data = await get_user_interactions(data.user_id)
     user_preferred_features = []
@@ -560,16 +1246,11 @@ async def _knn_recommendations(data: AdvancedRecommendationRequest):
         filtered = [c for c in candidates if str(c["taxon_id"]) not in data.seen_taxon_ids]
         return {"results": filtered[:data.limit], "algorithm": "knn", "explanation": "Sem preferências, retornando aleatório"}
     
-    user_vec = encoder.transform(user_preferred_features).mean(axis=0).reshape(1, -1)
-    
-    # KNN com pesos baseados em interações
-    n_neighbors = min(data.limit * 2, len(X))
-    knn = NearestNeighbors(n_neighbors=n_neighbors, metric='cosine')
-    knn.fit(X)
-    distances, indices = knn.kneighbors(user_vec)
+    # KNN com pesos baseados em interações (one-hot + KNN no pool de inferência, fora do event loop)
+    distances, indices = await run_inference(_knn_rank, features, user_preferred_features, data.limit * 2)
     
     recommended = []
-    for dist, idx in zip(distances[0], indices[0]):
+    for dist, idx in zip(distances, indices):
         especie = candidates[idx]
         if str(especie["taxon_id"]) not in data.seen_taxon_ids:
             especie["recommendation_score"] = round(1 - dist, 3)
@@ -659,24 +1340,34 @@ async def _collaborative_filtering(data: AdvancedRecommendationRequest):
     # Encontrar utilizadores similares (consultar base de dados)
     similar_users = []
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
+        # Últimas 100 interações de cada um dos outros utilizadores numa só query (como get_user_interactions);
+        # a ligação é devolvida ao pool antes do cálculo das similaridades
+        conn = await db_connect()
+        try:
+            rows = await conn.fetch(
+                """SELECT user_id, taxon_id, action, created_at
+                   FROM (
+                       SELECT user_id, taxon_id, action, created_at,
+                              ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC) AS rn
+                       FROM user_species_history
+                       WHERE user_id != $1
+                   ) recent
+                   WHERE rn <= $2
+                   ORDER BY user_id, created_at DESC""",
+                int(data.user_id), 100
+            )
+        finally:
+            await conn.close()
         
-        # Obter todos os utilizadores com interações
-        all_users = await conn.fetch(
-            "SELECT DISTINCT user_id FROM user_species_history WHERE user_id != $1",
-            int(data.user_id)
-        )
+        interactions_by_user = {}
+        for row in rows:
+            interactions_by_user.setdefault(str(row["user_id"]), []).append({
+                "taxon_id": str(row["taxon_id"]),
+                "type": row["action"],
+                "timestamp": str(row["created_at"])
+            })
         
-        for user_row in all_users:
-            other_user_id = str(user_row["user_id"])
-            other_interactions_data = await get_user_interactions(other_user_id)
-            
+        for other_user_id, other_interactions_data in interactions_by_user.items():
             other_interactions = set()
             for interaction in other_interactions_data:
                 if interaction["type"] in ["favorite", "identify"]:
@@ -690,10 +1381,8 @@ async def _collaborative_filtering(data: AdvancedRecommendationRequest):
                 
                 if similarity > 0.1:  # Threshold mínimo
                     similar_users.append((other_user_id, similarity, other_interactions_data))
-        
-        await conn.close()
     except Exception as e:
-        print(f"Erro ao obter utilizadores similares: {e}")
+        logger.error("similar_users_failed", extra={"user_id": data.user_id, "error": str(e)})
         return {"results": [], "algorithm": "collaborative", "explanation": "Erro ao processar dados"}
     
     # Recomendar espécies que utilizadores similares gostaram
@@ -830,24 +1519,276 @@ SYSTEM_PROMPT = (
     "NUNCA te identifiques como Llama, Claude, GPT ou qualquer outro nome que não seja NaturaBot."
 )
 
+# ==========================
+# CLASSIFICAÇÃO DE PROMPTS (identidade / espécies)
+# ==========================
+# Todos os padrões são compilados numa única regex no arranque, pelo que cada prompt
+# é classificado (identidade) e tem as palavras-chave extraídas numa só passagem.
+
+# Perguntas sobre a identidade do bot: respondidas sem RAG (nem pesquisa vetorial)
+IDENTITY_PATTERNS = [
+    "qual.*teu nome", "como.*chamas", "quem.*s", "que bot", "teu nome",
+    "qual.*o teu nome", "como.*te chamas", "quem.*tu", "quem és",
+    "apresenta-te", "apresentar", "identifica-te", "diz.*nome"
+]
+
+# Expressões sobre o bot que não são perguntas de identidade: desativam as palavras-chave e a pesquisa vetorial
+KEYWORD_EXCLUSION_PATTERNS = [
+    "who are you", "what is your name", "tell me about yourself",
+    "apresenta te", "nome do bot", "identificação"
+]
+
+# Palavras-chave comuns relacionadas com espécies
+SPECIES_INDICATORS = [
+    "espécie", "especie", "animal", "planta", "ave", "peixe", "mamífero", "mamifero",
+    "réptil", "reptil", "anfíbio", "anfibio", "inseto", "insecto", "aranha", "árvore", "arvore",
+    "flor", "pássaro", "passaro", "osga", "lagarto", "serpente", "cobra", "rato",
+    "gato", "cão", "cao", "cavalo", "vaca", "ovelha", "cabra", "porco", "galinha", "pato",
+    "fauna", "flora", "biodiversidade", "ecossistema", "habitat", "taxonomia",
+    "lince", "lynx", "bobcat", "felino", "felidae", "pardo", "ibérico", "iberico",
+    "rufus", "pardinus", "predador", "carnívoro", "carnivoro"
+]
+
+# Termos específicos de espécies conhecidas
+SPECIFIC_SPECIES_TERMS = [
+    "lince", "lynx", "bobcat", "felino", "pardo", "ibérico", "iberico", "rufus", "pardinus",
+    "lobo", "canis", "lupus", "águia", "aguia", "falcão", "falcao", "pardal", "tordo"
+]
+
+def load_species_vocabulary() -> set:
+    """Nomes científicos e comuns das espécies do mapa do modelo e das anotações do dataset"""
+    paths = [
+        os.environ.get("SPECIES_MAP_PATH", "species_taxon_map.json"),
+        os.environ.get("SPECIES_ANNOTATIONS_PATH", "dataset/annotations.json"),
+    ]
+    vocabulary = set()
+    for path in paths:
+        path = resolve_manifest(path) if path else path
+        if not path or not os.path.exists(path):
+            continue
+        try:
+            # Manifestos JSONL são lidos em streaming (JSON legado também suportado)
+            for entry in iter_records(path):
+                for key in ("sci_name", "common_name"):
+                    name = entry.get(key) if isinstance(entry, dict) else None
+                    if name and name.strip():
+                        vocabulary.add(name.strip().lower())
+        except Exception as e:
+            logger.error("species_vocabulary_failed", extra={"path": path, "error": str(e)})
+    return vocabulary
+
+def _trie_regex(words) -> str:
+    """
+    Constrói uma alternância regex em forma de trie (prefixos partilhados),
+    para que centenas de termos sejam testados sem percorrer cada alternativa.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node) -> str:
+        alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ""
+        body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        if "" in node:
+            return "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+def plural_forms(term: str) -> set:
+    """Plurais do termo (português e inglês): -s/-es, -l -> -is/-eis, -m -> -ns, -ão -> -ões/-ães"""
+    forms = {term + "s", term + "es"}
+    if term.endswith(("al", "el", "ol", "ul")):
+        forms.add(term[:-1] + "is")  # animal -> animais
+    elif term.endswith("il"):
+        forms.update({term[:-1] + "s", term[:-2] + "eis"})  # funil -> funis, réptil -> répteis
+    elif term.endswith("m"):
+        forms.add(term[:-1] + "ns")
+    elif term.endswith("ão"):
+        forms.update({term[:-2] + "ões", term[:-2] + "ães"})  # falcão -> falcões, cão -> cães
+    return forms
+
+def prompt_terms(vocabulary: set) -> Dict[str, str]:
+    """Forma (singular ou plural) -> termo: indicadores, termos específicos e nomes do vocabulário"""
+    forms = {}
+    for term in set(SPECIES_INDICATORS) | set(SPECIFIC_SPECIES_TERMS) | vocabulary:
+        for form in plural_forms(term):
+            forms.setdefault(form, term)
+    for term in set(SPECIES_INDICATORS) | set(SPECIFIC_SPECIES_TERMS) | vocabulary:
+        forms[term] = term  # Um termo nunca é tratado como plural de outro (ex: "ave" e "aves")
+    return forms
+
+def build_prompt_matcher(terms) -> "re.Pattern":
+    """
+    Regex única com quatro grupos:
+    - identity: pergunta sobre a identidade do bot
+    - excluded: expressão que desativa as palavras-chave e a pesquisa vetorial (KEYWORD_EXCLUSION_PATTERNS)
+    - term: indicador de espécie, termo específico ou nome do vocabulário, no singular ou plural (palavra completa)
+    - name: possível nome próprio/científico (palavras capitalizadas)
+    """
+    return re.compile(
+        r"(?P<identity>(?i:" + "|".join(IDENTITY_PATTERNS) + r"))"
+        r"|(?P<excluded>(?i:" + "|".join(re.escape(p) for p in KEYWORD_EXCLUSION_PATTERNS) + r"))"
+        r"|(?P<term>\b(?i:" + _trie_regex(terms) + r")\b)"
+        # A segunda palavra de um nome científico só é espreitada (lookahead): pode ainda ser um termo
+        r"|(?P<name>\b[A-Z][a-z]+\b(?=(?P<epithet> [a-z]+\b)?))"
+    )
+
+PROMPT_TERMS = prompt_terms(load_species_vocabulary())
+PROMPT_MATCHER = build_prompt_matcher(PROMPT_TERMS)
+
+class PromptAnalysis(NamedTuple):
+    is_identity: bool
+    keywords: tuple
+    skip_vector_search: bool = False  # Identidade ou KEYWORD_EXCLUSION_PATTERNS
+
+@lru_cache(maxsize=512)
+def analyse_prompt(prompt: str) -> PromptAnalysis:
+    """Classifica o prompt e extrai palavras-chave de espécies numa única passagem"""
+    terms = []
+    names = []
+    excluded = False
+    for match in PROMPT_MATCHER.finditer(prompt):
+        kind = match.lastgroup
+        if kind == "identity":
+            return PromptAnalysis(True, (), True)
+        text = match.group()
+        if kind == "excluded":
+            excluded = True
+        elif kind == "term":
+            terms.append(PROMPT_TERMS.get(text.lower(), text.lower()))  # Plural -> termo (singular)
+        else:
+            # Possível nome científico (duas palavras) e o género isolado
+            if match.group("epithet"):
+                names.append(text + match.group("epithet"))
+            names.append(text)
+    # Só considera nomes capitalizados se houver contexto de espécies
+    if excluded:
+        return PromptAnalysis(False, (), True)
+    if not terms:
+        return PromptAnalysis(False, ())
+    return PromptAnalysis(False, tuple(dict.fromkeys(terms + names)))  # Remove duplicados
+
 # Função para detectar perguntas sobre identidade do bot
 def is_identity_question(prompt: str) -> bool:
     """Verifica se a pergunta é sobre a identidade do bot"""
-    identity_patterns = [
-        "qual.*teu nome", "como.*chamas", "quem.*s", "que bot", "teu nome",
-        "qual.*o teu nome", "como.*te chamas", "quem.*tu", "quem és",
-        "apresenta-te", "apresentar", "identifica-te", "diz.*nome"
-    ]
-    
-    prompt_lower = prompt.lower()
-    for pattern in identity_patterns:
-        if re.search(pattern, prompt_lower):
-            return True
-    return False
+    return analyse_prompt(prompt).is_identity
+
+# ==========================
+# CONTROLO DE ADMISSÃO DOS HANDLERS LLM
+# ==========================
+# Cada upstream (Ollama / OpenRouter) tem um limite de pedidos simultâneos e uma fila
+# de espera limitada. Os clientes em espera recebem a sua posição na fila (evento "llm_queue");
+# pedidos rejeitados (fila cheia, tempo de espera excedido, limite por sid) falham de imediato.
+
+LLM_OLLAMA_MAX_CONCURRENCY = int(os.environ.get("LLM_OLLAMA_MAX_CONCURRENCY", "2"))
+LLM_OPENROUTER_MAX_CONCURRENCY = int(os.environ.get("LLM_OPENROUTER_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "20"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "15"))  # segundos
+LLM_RATE_LIMIT_PER_MINUTE = float(os.environ.get("LLM_RATE_LIMIT_PER_MINUTE", "10"))
+LLM_RATE_LIMIT_BURST = float(os.environ.get("LLM_RATE_LIMIT_BURST", "3"))
+
+class AdmissionError(Exception):
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+
+class UpstreamGate:
+    """Semáforo com fila FIFO limitada e notificação da posição de cada cliente"""
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()  # (sid, future)
+
+    async def _notify_positions(self):
+        for position, (sid, _) in enumerate(list(self.waiters), start=1):
+            await sio.emit("llm_queue", {
+                "upstream": self.name,
+                "position": position,
+                "queue_size": len(self.waiters)
+            }, to=sid)
+
+    async def acquire(self, sid: str):
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            raise AdmissionError("queue_full", "O assistente está ocupado de momento. Tenta novamente dentro de instantes.")
+        future = asyncio.get_running_loop().create_future()
+        entry = (sid, future)
+        self.waiters.append(entry)
+        await self._notify_positions()
+        try:
+            # Quando o future é resolvido, o lugar foi transferido por release()
+            await asyncio.wait_for(future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # O lugar foi atribuído no mesmo instante do timeout: devolve-o
+                self.release()
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+                asyncio.ensure_future(self._notify_positions())
+            raise AdmissionError("queue_timeout", "Tempo de espera na fila excedido. Tenta novamente.")
+
+    def release(self):
+        while self.waiters:
+            _, future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(True)  # Transfere o lugar sem decrementar active
+                asyncio.ensure_future(self._notify_positions())
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": len(self.waiters),
+            "max_queue": self.max_queue
+        }
+
+ollama_gate = UpstreamGate("ollama", LLM_OLLAMA_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
+openrouter_gate = UpstreamGate("openrouter", LLM_OPENROUTER_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
+
+# Token bucket por sid: LLM_RATE_LIMIT_PER_MINUTE pedidos/minuto com rajadas até LLM_RATE_LIMIT_BURST
+_llm_rate_buckets: Dict[str, list] = {}
+
+def allow_llm_request(sid: str) -> bool:
+    now = time.monotonic()
+    tokens, last = _llm_rate_buckets.get(sid, (LLM_RATE_LIMIT_BURST, now))
+    tokens = min(LLM_RATE_LIMIT_BURST, tokens + (now - last) * LLM_RATE_LIMIT_PER_MINUTE / 60.0)
+    if tokens < 1:
+        _llm_rate_buckets[sid] = [tokens, now]
+        return False
+    _llm_rate_buckets[sid] = [tokens - 1, now]
+    return True
+
+@sio.event
+async def disconnect(sid):
+    _llm_rate_buckets.pop(sid, None)
+
+@app.get("/llm/admission/stats")
+async def llm_admission_stats():
+    """Ocupação e filas de espera dos upstreams LLM"""
+    return {
+        "ollama": ollama_gate.stats(),
+        "openrouter": openrouter_gate.stats(),
+        "rate_limited_sids": len(_llm_rate_buckets)
+    }
 
 # Handler para LLM local via Ollama
 # Modelo LLM(1) após integração funcional foi substituido via OpenRouter por um LLM(2) avançado.
 @sio.event
+@instrumented_event
 async def llm_message(sid, data):
     prompt = data.get("prompt")
     ollama_url = os.environ.get("OLLAMA_URL", "http://llm_ollama:11434")
@@ -856,6 +1797,10 @@ async def llm_message(sid, data):
         await sio.emit("llm_response", {"error": "Prompt em falta."}, to=sid)
         return
 
+    if not allow_llm_request(sid):
+        await sio.emit("llm_response", {"error": "Demasiados pedidos. Aguarda um pouco antes de tentar novamente.", "code": "rate_limited"}, to=sid)
+        return
+
     try:
         # Verificar se o serviço Ollama está ativo
         async with httpx.AsyncClient(timeout=3) as client:
@@ -867,9 +1812,16 @@ async def llm_message(sid, data):
         await sio.emit("llm_response", {"error": "O serviço LLM não está disponível de momento."}, to=sid)
         return
 
+    try:
+        await ollama_gate.acquire(sid)
+    except AdmissionError as e:
+        await sio.emit("llm_response", {"error": str(e), "code": e.code}, to=sid)
+        return
+
     try:
         # Enviar prompt para o modelo local
         async with httpx.AsyncClient(timeout=30) as client:
+            upstream_start = time.perf_counter()
             response = await client.post(
                 f"{ollama_url}/api/chat",
                 json={
@@ -881,16 +1833,121 @@ async def llm_message(sid, data):
                     "stream": False
                 }
             )
+            observe_stage("llm_upstream_ollama", time.perf_counter() - upstream_start)
             response.raise_for_status()
             data = response.json()
             content = data.get("message", "")
             await sio.emit("llm_response", {"response": content}, to=sid)
     except Exception as e:
         await sio.emit("llm_response", {"error": f"Erro ao comunicar com o LLM: {str(e)}"}, to=sid)
+    finally:
+        ollama_gate.release()
 
 
 # Handler para LLM(2) externo via OpenRouter
 
+# --- Cache semântica de respostas (opt-in) ---
+# Evita repetir a chamada paga ao OpenRouter para perguntas equivalentes:
+# a chave é modelo + prompt de sistema + IDs dos documentos recuperados,
+# e dentro dessa chave uma pergunta é servida da cache se o embedding da query
+# tiver similaridade de cosseno acima do limiar com uma pergunta já respondida.
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_CACHE_SIMILARITY = float(os.environ.get("LLM_CACHE_SIMILARITY", "0.95"))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", "3600"))  # segundos
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "500"))
+
+class SemanticResponseCache:
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        # Ordem de inserção/uso (LRU): entry_id -> entrada
+        self.entries = OrderedDict()
+        # Chave exata -> ids das entradas com essa chave
+        self.buckets: Dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_latency = 0.0
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, document_ids: list) -> str:
+        raw = json.dumps([model, system_prompt, [str(d) for d in document_ids]], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        bucket = self.buckets.get(entry["key"])
+        if bucket is not None:
+            bucket.discard(entry_id)
+            if not bucket:
+                del self.buckets[entry["key"]]
+
+    def get(self, key: str, embedding: list) -> Optional[dict]:
+        """Devolve a entrada mais semelhante acima do limiar (ou None)"""
+        now = time.time()
+        query_vec = np.asarray(embedding, dtype=np.float32)
+        query_vec = query_vec / (np.linalg.norm(query_vec) or 1.0)
+        best_id, best_sim = None, self.threshold
+        for entry_id in list(self.buckets.get(key, ())):
+            entry = self.entries[entry_id]
+            if now - entry["created_at"] > self.ttl:
+                self._remove(entry_id)
+                continue
+            similarity = float(np.dot(entry["embedding"], query_vec))
+            if similarity >= best_sim:
+                best_id, best_sim = entry_id, similarity
+        if best_id is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(best_id)
+        entry = self.entries[best_id]
+        self.hits += 1
+        self.saved_latency += entry["upstream_latency"]
+        return {"response": entry["response"], "similarity": round(best_sim, 4)}
+
+    def put(self, key: str, embedding: list, response: str, upstream_latency: float):
+        vec = np.asarray(embedding, dtype=np.float32)
+        vec = vec / (np.linalg.norm(vec) or 1.0)
+        entry_id = uuid4().hex
+        self.entries[entry_id] = {
+            "key": key,
+            "embedding": vec,
+            "response": response,
+            "upstream_latency": upstream_latency,
+            "created_at": time.time(),
+        }
+        self.buckets.setdefault(key, set()).add(entry_id)
+        while len(self.entries) > self.max_entries:
+            oldest_id = next(iter(self.entries))
+            self._remove(oldest_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.buckets.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": LLM_CACHE_ENABLED,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "similarity_threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "saved_upstream_latency_seconds": round(self.saved_latency, 3),
+        }
+
+llm_response_cache = SemanticResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL, LLM_CACHE_SIMILARITY)
+
+@app.get("/llm/cache/stats")
+async def llm_cache_stats():
+    """Estatísticas da cache semântica de respostas do NaturaBot"""
+    return llm_response_cache.stats()
+
 # Modelo de dados para documentos de natureza
 class NaturaDoc(BaseModel):
     taxon_id: Optional[str] = None
@@ -899,6 +1956,7 @@ class NaturaDoc(BaseModel):
     descricao: Optional[str] = ""
 
 @sio.event
+@instrumented_event
 async def llm2_message(sid, data):
     prompt = data.get("prompt")
     model = data.get("model", "meta-llama/llama-3-8b-instruct")
@@ -909,20 +1967,27 @@ async def llm2_message(sid, data):
         await sio.emit("llm2_response", {"error": "Prompt ou API key em falta."}, to=sid)
         return
 
+    if not allow_llm_request(sid):
+        await sio.emit("llm2_response", {"error": "Demasiados pedidos. Aguarda um pouco antes de tentar novamente.", "code": "rate_limited"}, to=sid)
+        return
+
     # Verificar se é uma pergunta sobre identidade do bot
     is_identity = is_identity_question(prompt)
     
+    # Embedding da pergunta para a cache semântica (reutilizado na pesquisa vetorial)
+    query_embedding = None
+    if LLM_CACHE_ENABLED:
+        try:
+            query_embedding = await asyncio.wait_for(get_embedding(prompt), timeout=RAG_STAGE_TIMEOUT)
+        except Exception as e:
+            logger.warning("llm_cache_embedding_unavailable", extra={"error": str(e)})
+
     # 1. Pesquisa contexto relevante no Postgres (RAG) - APENAS se não for pergunta de identidade
-    context_list = []
+    # Pesquisa vetorial e por palavras-chave correm em paralelo e são fundidas (RRF)
+    context_docs = []
     if not is_identity:
-        context_list = await search_similar_documents(prompt, top_k=3)
-        
-        # Se não há contexto relevante, tenta uma procura mais ampla por termos-chave
-        if not context_list:
-            # Extrai palavras-chave do prompt para procura alternativa
-            keywords = await extract_species_keywords(prompt)
-            if keywords:
-                context_list = await search_by_keywords(keywords)
+        context_docs = await hybrid_retrieve(prompt, top_k=3, query_embedding=query_embedding)
+    context_list = [doc["content"] for doc in context_docs]
     
     context = "\n\n".join(context_list) if context_list else "Sem contexto relevante na base de dados."
 
@@ -946,6 +2011,28 @@ Responde como o NaturaBot. Se a pergunta for sobre espécies naturais, indica qu
     # 3. Usa prompt de sistema personalizado se fornecido, senão usa o padrão
     system_prompt = custom_system if custom_system else SYSTEM_PROMPT
 
+    # 4. Cache semântica: responde sem chamar o OpenRouter se houver uma pergunta equivalente
+    cache_key = None
+    if query_embedding is not None:
+        cache_key = SemanticResponseCache.make_key(model, system_prompt, [doc["id"] for doc in context_docs])
+        cached = llm_response_cache.get(cache_key, query_embedding)
+        record_cache("llm_response", cached is not None)
+        if cached:
+            await sio.emit("llm2_response", {
+                "response": cached["response"],
+                "rag_used": len(context_list) > 0,
+                "rag_documents_count": len(context_list),
+                "cached": True
+            }, to=sid)
+            return
+
+    # 5. Aguarda lugar no upstream (OpenRouter); falha de imediato se a fila estiver cheia
+    try:
+        await openrouter_gate.acquire(sid)
+    except AdmissionError as e:
+        await sio.emit("llm2_response", {"error": str(e), "code": e.code}, to=sid)
+        return
+
     try:
         # Preparar corpo da requisição com parâmetros melhorados
         request_body = {
@@ -970,14 +2057,16 @@ Responde como o NaturaBot. Se a pergunta for sobre espécies naturais, indica qu
             "X-Title": "NaturaDetec"
         }
         
-        print(f"[LLM2 DEBUG] Request body: {json.dumps(request_body, ensure_ascii=False)[:300]}...")
+        debug_sampled(logger, "llm2_request", model=model, messages=len(request_body["messages"]))
         
+        upstream_start = time.perf_counter()
         async with httpx.AsyncClient(timeout=60) as client:
             response = await client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
+                os.environ.get("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions"),
                 headers=headers,
                 json=request_body
             )
+            observe_stage("llm_upstream_openrouter", time.perf_counter() - upstream_start)
             
             response.raise_for_status()
             data = response.json()
@@ -986,6 +2075,8 @@ Responde como o NaturaBot. Se a pergunta for sobre espécies naturais, indica qu
                 raise Exception("Resposta da API não contém choices válidos")
                 
             content = data["choices"][0]["message"]["content"]
+            if cache_key is not None and content:
+                llm_response_cache.put(cache_key, query_embedding, content, time.perf_counter() - upstream_start)
             
             # Inclui informação sobre uso do RAG na resposta
             rag_info = {
@@ -994,16 +2085,17 @@ Responde como o NaturaBot. Se a pergunta for sobre espécies naturais, indica qu
                 "rag_documents_count": len(context_list)
             }
             
-            print(f"LLM2 Response: {content}")
-            print(f"[RAG] Documentos usados: {len(context_list)}")
+            logger.info("llm2_response", extra={"chars": len(content), "rag_documents": len(context_list)})
             await sio.emit("llm2_response", rag_info, to=sid)
     except httpx.HTTPStatusError as e:
         error_detail = f"HTTP {e.response.status_code}: {e.response.text}"
-        print(f"[LLM2 ERROR] {error_detail}")
+        logger.error("llm2_upstream_http_error", extra={"status": e.response.status_code, "detail": error_detail[:500]})
         await sio.emit("llm2_response", {"error": f"Erro HTTP na API: {error_detail}"}, to=sid)
     except Exception as e:
-        print(f"[LLM2 ERROR] {str(e)}")
+        logger.error("llm2_failed", extra={"error": str(e)})
         await sio.emit("llm2_response", {"error": f"Erro ao comunicar com o LLM externo: {str(e)}"}, to=sid)
+    finally:
+        openrouter_gate.release()
 
 
 
@@ -1012,59 +2104,54 @@ Responde como o NaturaBot. Se a pergunta for sobre espécies naturais, indica qu
 # Esta função obtém a representação vetorial de um texto usando o modelo nomic-embed-text
 async def get_embedding(text: str) -> list:
     ollama_url = os.environ.get("OLLAMA_URL", "http://llm_ollama:11434")
-    async with httpx.AsyncClient(timeout=30) as client:
-        response = await client.post(
-            f"{ollama_url}/api/embeddings",
-            json={"model": "nomic-embed-text", "prompt": text}
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data["embedding"]
+    with stage("embedding"):
+        async with httpx.AsyncClient(timeout=30) as client:
+            response = await client.post(
+                f"{ollama_url}/api/embeddings",
+                json={"model": "nomic-embed-text", "prompt": text}
+            )
+            response.raise_for_status()
+            data = response.json()
+            return data["embedding"]
 
 # Esta função pesquisa documentos similares na BD usando a extensão pgvector
 # Ela recebe um texto de consulta e retorna os documentos mais similares com base na distância do embedding
-async def search_similar_documents(query: str, top_k: int = 3, similarity_threshold: float = 18.5):
+# Cada documento é devolvido como {"id", "content"} para permitir a fusão com a pesquisa por palavras-chave
+async def search_similar_documents(query: str, top_k: int = 3, similarity_threshold: float = 18.5,
+                                   query_embedding: Optional[list] = None):
     # Verifica se é uma pergunta sobre identidade/apresentação do bot
-    query_lower = query.lower()
-    identity_questions = [
-        "qual o teu nome", "quem és", "como te chamas", "qual é o teu nome",
-        "who are you", "what is your name", "tell me about yourself",
-        "apresenta-te", "apresenta te", "nome do bot", "identificação"
-    ]
-    
-    for identity_q in identity_questions:
-        if identity_q in query_lower:
-            return []  # Não usar RAG para perguntas sobre identidade
+    if analyse_prompt(query).skip_vector_search:
+        return []  # Não usar RAG para perguntas sobre identidade
     
-    # Gera embedding do query
-    query_embedding = await get_embedding(query)
+    # Gera embedding do query (reutiliza o embedding se já tiver sido calculado)
+    if query_embedding is None:
+        query_embedding = await get_embedding(query)
     embedding_str = "[" + ",".join(str(float(x)) for x in query_embedding) + "]"
-    conn = await asyncpg.connect(
-        host=os.environ.get("POSTGRES_HOST"),
-        port=int(os.environ.get("POSTGRES_PORT")),
-        user=os.environ.get("POSTGRES_USER"),
-        password=os.environ.get("POSTGRES_PASSWORD"),
-        database=os.environ.get("POSTGRES_DB"),
-    )
+    conn = await db_connect()
     
     # Pesquisa por similaridade com distância (menor distância = mais similar)
     # Para pgvector <-> operator: 0 = idêntico, 2 = completamente diferente
-    rows = await conn.fetch(
-        """
-        SELECT content, (embedding <-> $1) as distance
-        FROM documents
-        ORDER BY embedding <-> $1
-        LIMIT $2
-        """,
-        embedding_str, top_k
-    )
-    await conn.close()
+    try:
+        rows = await conn.fetch(
+            """
+            SELECT id, content, (embedding <-> $1) as distance
+            FROM documents
+            ORDER BY embedding <-> $1
+            LIMIT $2
+            """,
+            embedding_str, top_k
+        )
+    finally:
+        await conn.close()  # Também quando a etapa é cancelada pelo timeout do hybrid_retrieve
     
     # Retorna apenas documentos com similaridade suficiente
-    relevant_docs = [row["content"] for row in rows if float(row["distance"]) < similarity_threshold]
+    relevant_docs = [
+        {"id": row["id"], "content": row["content"]}
+        for row in rows if float(row["distance"]) < similarity_threshold
+    ]
     
     # Log resumido
-    print(f"[RAG] Query: '{query}' | Docs: {len(rows) if rows else 0} | Relevantes: {len(relevant_docs)}")
+    debug_sampled(logger, "rag_vector_search", docs=len(rows) if rows else 0, relevant=len(relevant_docs))
     
     return relevant_docs
 
@@ -1088,13 +2175,7 @@ async def search_documents(prompt: str) -> str:
     
 # Esta função insere ou atualiza um documento na base de dados Postgres (UPSERT)
 async def upsert_document(content: str, embedding: list, taxon_id: Optional[str], nome_cientifico: Optional[str]):
-    conn = await asyncpg.connect(
-        host=os.environ.get("POSTGRES_HOST"),
-        port=int(os.environ.get("POSTGRES_PORT")),
-        user=os.environ.get("POSTGRES_USER"),
-        password=os.environ.get("POSTGRES_PASSWORD"),
-        database=os.environ.get("POSTGRES_DB"),
-    )
+    conn = await db_connect()
     
     # Converte o embedding para string para pgvector
     embedding_str = "[" + ",".join(str(float(x)) for x in embedding) + "]"
@@ -1124,7 +2205,7 @@ async def upsert_document(content: str, embedding: list, taxon_id: Optional[str]
             return "inserted"
             
     except Exception as e:
-        print(f"[RAG] Erro ao processar documento {taxon_id}: {str(e)}")
+        logger.error("rag_upsert_failed", extra={"taxon_id": taxon_id, "error": str(e)})
         return "error"
     finally:
         await conn.close() 
@@ -1152,7 +2233,10 @@ async def insert_documents_natura(docs: List[NaturaDoc]):
             errors += 1
             # Erro já logado na função upsert_document
     
-    print(f"[RAG] Processamento: {inserted} novos, {updated} atualizados, {errors} erros")
+    logger.info("rag_documents_processed", extra={"inserted": inserted, "updated": updated, "errors": errors})
+    if updated:
+        # Respostas em cache podem citar a versão antiga dos documentos (em todos os workers)
+        await cluster.invalidate("llm_response")
     
     total_processed = inserted + updated
     
@@ -1175,13 +2259,7 @@ async def insert_documents_natura(docs: List[NaturaDoc]):
 async def recommendations_health():
     """Verifica a saúde do sistema de recomendações"""
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
+        conn = await db_connect()
         
         total_users_result = await conn.fetchval("SELECT COUNT(DISTINCT user_id) FROM user_species_history")
         total_interactions_result = await conn.fetchval("SELECT COUNT(*) FROM user_species_history")
@@ -1191,14 +2269,14 @@ async def recommendations_health():
         total_users = total_users_result or 0
         total_interactions = total_interactions_result or 0
     except Exception as e:
-        print(f"Erro ao obter estatísticas: {e}")
+        logger.error("recommendation_stats_failed", extra={"error": str(e)})
         total_users = 0
         total_interactions = 0
     
-    # Verificar se os modelos estão carregados
+    # Verificar se os modelos estão carregados (sem os carregar: ver /ready)
     models_status = {
-        "species_model": model is not None,
-        "face_recognition": len(known_encodings) > 0,
+        "species_model": SUBSYSTEMS["species_model"].state == "ready",
+        "face_recognition": SUBSYSTEMS["face_index"].state == "ready" and bool(_face_index_cache["emails"]),
         "sklearn_available": True
     }
     
@@ -1214,13 +2292,7 @@ async def recommendations_health():
 async def recommendations_stats():
     """Estatísticas detalhadas do sistema de recomendações"""
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
+        conn = await db_connect()
         
         # Obter todas as interações
         all_interactions_raw = await conn.fetch("SELECT action, taxon_id FROM user_species_history")
@@ -1256,7 +2328,7 @@ async def recommendations_stats():
             "average_interactions_per_user": len(all_interactions_raw) / (unique_users_count or 1)
         }
     except Exception as e:
-        print(f"Erro ao obter estatísticas: {e}")
+        logger.error("recommendation_stats_failed", extra={"error": str(e)})
         return {"message": "Erro ao obter estatísticas", "error": str(e)}
 
 
@@ -1316,13 +2388,7 @@ class RecommendationFeedback(BaseModel):
 async def record_recommendation_feedback(feedback: RecommendationFeedback):
     """Regista feedback sobre recomendações para melhorar o sistema"""
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
+        conn = await db_connect()
         
         await conn.execute(
             """INSERT INTO recommendation_feedback (user_id, recommended_taxon_id, feedback_type, algorithm_used) 
@@ -1340,13 +2406,7 @@ async def record_recommendation_feedback(feedback: RecommendationFeedback):
 async def get_algorithm_performance():
     """Análise de performance dos diferentes algoritmos de recomendação"""
     try:
-        conn = await asyncpg.connect(
-            host=os.environ.get("POSTGRES_HOST"),
-            port=int(os.environ.get("POSTGRES_PORT")),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            database=os.environ.get("POSTGRES_DB"),
-        )
+        conn = await db_connect()
         
         # Obter dados de feedback da base de dados
         feedback_rows = await conn.fetch(
@@ -1386,6 +2446,50 @@ async def get_algorithm_performance():
         return {"error": f"Erro ao obter performance dos algoritmos: {str(e)}"}
 
 
+# ==========================
+# CACHES (INVALIDAÇÃO ENTRE WORKERS)
+# ==========================
+# Cada worker tem as suas caches em memória; POST /admin/cache/invalidate (ou cluster.invalidate no
+# código) limpa-as neste worker e, com MESSAGE_QUEUE, nos restantes. O endpoint só existe com
+# CACHE_ADMIN_TOKEN definido e exige o cabeçalho X-Admin-Token. As caches por ficheiro (modelo,
+# índices) já se recarregam quando os ficheiros mudam: a invalidação força a releitura.
+
+def _reset_cache(cache: dict):
+    def handler():
+        cache["key"] = None
+    return handler
+
+cluster.on_invalidate("llm_response", llm_response_cache.clear)
+cluster.on_invalidate("prompt_analysis", analyse_prompt.cache_clear)
+cluster.on_invalidate("species_model", _reset_cache(_species_model_cache))
+cluster.on_invalidate("species_index", _reset_cache(_species_index_cache))
+cluster.on_invalidate("face_index", _reset_cache(_face_index_cache))
+
+def require_cache_admin(request: Request):
+    if not cluster.CACHE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Invalidação de caches desligada (CACHE_ADMIN_TOKEN)")
+    if not cluster.authorized(request.headers):
+        raise HTTPException(status_code=403, detail="X-Admin-Token inválido")
+
+class CacheInvalidation(BaseModel):
+    cache: str  # nome da cache ou "all"
+
+@app.post("/admin/cache/invalidate", dependencies=[Depends(require_cache_admin)])
+async def invalidate_cache(data: CacheInvalidation):
+    try:
+        invalidated = await cluster.invalidate(data.cache)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Cache desconhecida: {data.cache}")
+    return {"invalidated": invalidated, "worker": cluster.WORKER_ID, "propagated": bool(cluster.MESSAGE_QUEUE)}
+
+@app.on_event("startup")
+async def start_cluster():
+    await cluster.start()
+
+@app.on_event("shutdown")
+async def stop_cluster():
+    await cluster.stop()
+
 # ==========================
 # SOCKET.IO APP (DEVE SER NO FINAL)
 # ==========================
@@ -1396,119 +2500,154 @@ socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
 async def extract_species_keywords(prompt: str) -> list:
     """
     Extrai palavras-chave relacionadas com espécies do prompt.
-    Procura nomes comuns e científicos possíveis.
+    Procura nomes comuns e científicos possíveis (incluindo o vocabulário de espécies do modelo).
     Só ativa para perguntas claramente sobre espécies naturais.
     """
-    import re
-    
-    # Converte para minúsculas para análise
-    prompt_lower = prompt.lower()
-    
-    # Verifica se é uma pergunta sobre espécies (não sobre identidade do bot)
-    identity_questions = [
-        "qual o teu nome", "quem és", "como te chamas", "qual é o teu nome",
-        "who are you", "what is your name", "tell me about yourself",
-        "apresenta-te", "apresenta te", "nome do bot", "identificação"
-    ]
-    
-    for identity_q in identity_questions:
-        if identity_q in prompt_lower:
-            return []  # Não usar RAG para perguntas sobre identidade
-    
-    # Lista de palavras-chave comuns relacionadas com espécies
-    species_indicators = [
-        "espécie", "especie", "animal", "planta", "ave", "peixe", "mamífero", "mamifero",
-        "réptil", "reptil", "anfíbio", "anfibio", "inseto", "insecto", "aranha", "árvore", "arvore",
-        "flor", "pássaro", "passaro", "osga", "lagarto", "serpente", "cobra", "rato",
-        "gato", "cão", "cao", "cavalo", "vaca", "ovelha", "cabra", "porco", "galinha", "pato",
-        "fauna", "flora", "biodiversidade", "ecossistema", "habitat", "taxonomia",
-        "lince", "lynx", "bobcat", "felino", "felidae", "pardo", "ibérico", "iberico",
-        "rufus", "pardinus", "predador", "carnívoro", "carnivoro"
-    ]
-    
-    # Procura por contexto específico de espécies
-    species_context_found = any(indicator in prompt_lower for indicator in species_indicators)
-    
-    keywords = []
-    
-    # Sempre procura por palavras-chave específicas de espécies conhecidas
-    specific_species_terms = [
-        "lince", "lynx", "bobcat", "felino", "pardo", "ibérico", "iberico", "rufus", "pardinus",
-        "lobo", "canis", "lupus", "águia", "aguia", "falcão", "falcao", "pardal", "tordo"
-    ]
-    
-    for term in specific_species_terms:
-        if term in prompt_lower:
-            keywords.append(term)
-    
-    # Se encontrou termos específicos ou contexto geral de espécies, procura mais palavras
-    if keywords or species_context_found:
-        for word in species_indicators:
-            if word in prompt_lower:
-                keywords.append(word)
-        
-        # Procura por possíveis nomes científicos (duas palavras capitalizadas)
-        scientific_names = re.findall(r'\b[A-Z][a-z]+ [a-z]+\b', prompt)
-        keywords.extend(scientific_names)
-        
-        # Procura por palavras que possam ser nomes de espécies (capitalizadas isoladas)
-        possible_names = re.findall(r'\b[A-Z][a-z]+\b', prompt)
-        keywords.extend(possible_names)
-        keywords.extend(possible_names)
-    
-    return list(set(keywords))  # Remove duplicados
+    analysis = analyse_prompt(prompt)
+    if analysis.is_identity:
+        return []  # Não usar RAG para perguntas sobre identidade
+    return list(analysis.keywords)
+
+# Constrói uma expressão to_tsquery segura a partir das palavras-chave:
+# cada palavra-chave é reduzida aos seus tokens alfanuméricos (sem operadores de tsquery),
+# termos compostos (ex: nomes científicos) tornam-se frases (<->) e os termos são unidos por OR (|)
+def build_tsquery(keywords: list) -> str:
+    terms = []
+    for keyword in keywords:
+        tokens = re.findall(r"\w+", keyword.lower())
+        if not tokens:
+            continue
+        term = " <-> ".join(tokens)
+        if term not in terms:
+            terms.append(term)
+    return " | ".join(f"({term})" if "<->" in term else term for term in terms)
 
 # Função para Procurar documentos por palavras-chave na base de dados
-async def search_by_keywords(keywords: list) -> list:
+async def search_by_keywords(keywords: list, top_k: int = 3, min_similarity: float = 0.3) -> list:
     """
     Procura documentos na base de dados que contenham as palavras-chave especificadas.
-    Usa procura case-insensitive com regex para palavras completas.
+    Usa full-text search em português (coluna content_tsv, índice GIN) ordenado por ts_rank,
+    e trigramas (pg_trgm) para nomes científicos escritos de forma aproximada.
+    Todas as palavras-chave são passadas como parâmetros da query.
+    Retorna uma lista de {"id", "content"}.
     """
     if not keywords:
         return []
     
-    conn = await asyncpg.connect(
-        host=os.environ.get("POSTGRES_HOST"),
-        port=int(os.environ.get("POSTGRES_PORT")),
-        user=os.environ.get("POSTGRES_USER"),
-        password=os.environ.get("POSTGRES_PASSWORD"),
-        database=os.environ.get("POSTGRES_DB"),
-    )
+    tsquery = build_tsquery(keywords)
+    if not tsquery:
+        return []
+    trigram_text = " ".join(keywords)
     
-    # Constrói query usando regex para procura de palavras completas
-    keyword_conditions = []
-    for keyword in keywords:
-        # Escape de caracteres especiais para regex e procura por palavra completa
-        escaped_keyword = keyword.replace('-', '\\-').replace('(', '\\(').replace(')', '\\)')
-        keyword_conditions.append(f"content ~* '\\y{escaped_keyword}\\y'")
-    
-    query = f"""
-        SELECT content 
-        FROM documents 
-        WHERE {' OR '.join(keyword_conditions)}
-        LIMIT 3
-    """
+    conn = await db_connect()
     
     try:
-        rows = await conn.fetch(query)
-        return [row["content"] for row in rows]
-    except Exception as e:
-        # Fallback para procura simples ILIKE se regex falhar
+        # O operador <% usa o índice de trigramas: verdadeiro se o nome científico
+        # for semelhante a algum excerto do texto das palavras-chave
+        await conn.execute(
+            "SELECT set_config('pg_trgm.word_similarity_threshold', $1, false)",
+            str(float(min_similarity))
+        )
+        rows = await conn.fetch(
+            """
+            SELECT id, content,
+                   GREATEST(
+                       ts_rank(content_tsv, query),
+                       COALESCE(word_similarity(nome_cientifico, $2), 0)
+                   ) AS rank
+            FROM documents, to_tsquery('portuguese', $1) AS query
+            WHERE content_tsv @@ query
+               OR nome_cientifico <% $2
+            ORDER BY rank DESC
+            LIMIT $3
+            """,
+            tsquery, trigram_text, top_k
+        )
+        return [{"id": row["id"], "content": row["content"]} for row in rows]
+    except asyncpg.PostgresError as e:
+        # Fallback para bases de dados sem a coluna content_tsv / pg_trgm (08-create-documents_search.sql)
+        logger.warning("rag_fulltext_unavailable", extra={"error": str(e)})
         try:
-            simple_conditions = [f"content ILIKE '%{keyword}%'" for keyword in keywords]
-            simple_query = f"""
-                SELECT content 
+            patterns = [
+                "%" + keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                for keyword in keywords
+            ]
+            rows = await conn.fetch(
+                """
+                SELECT id, content 
                 FROM documents 
-                WHERE {' OR '.join(simple_conditions)}
-                LIMIT 3
-            """
-            rows = await conn.fetch(simple_query)
-            return [row["content"] for row in rows]
+                WHERE content ILIKE ANY($1::text[])
+                LIMIT $2
+                """,
+                patterns, top_k
+            )
+            return [{"id": row["id"], "content": row["content"]} for row in rows]
         except Exception:
             return []
     finally:
         await conn.close()
 
+# ==========================
+# RECUPERAÇÃO HÍBRIDA (RAG)
+# ==========================
+
+# Tempo máximo (segundos) de cada etapa de pesquisa; uma etapa lenta é descartada sem bloquear a resposta
+RAG_STAGE_TIMEOUT = float(os.environ.get("RAG_STAGE_TIMEOUT", "5"))
+# Constante k do Reciprocal Rank Fusion (valor habitual na literatura: 60)
+RAG_RRF_K = int(os.environ.get("RAG_RRF_K", "60"))
+
+async def _run_rag_stage(name: str, coro, timeout: float) -> list:
+    """Executa uma etapa de pesquisa com timeout; em caso de falha devolve lista vazia"""
+    try:
+        return await asyncio.wait_for(coro, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning("rag_stage_timeout", extra={"stage": name, "timeout": timeout})
+        return []
+    except Exception as e:
+        logger.error("rag_stage_failed", extra={"stage": name, "error": str(e)})
+        return []
+
+async def _keyword_stage(query: str, top_k: int) -> list:
+    """Etapa lexical: extrai palavras-chave e pesquisa na base de dados"""
+    keywords = await extract_species_keywords(query)
+    if not keywords:
+        return []
+    return await search_by_keywords(keywords, top_k=top_k)
+
+def reciprocal_rank_fusion(rankings: List[list], top_k: int = 3, k: int = RAG_RRF_K) -> list:
+    """
+    Funde várias listas ordenadas de documentos com Reciprocal Rank Fusion.
+    Cada documento recebe sum(1 / (k + posição)) sobre as listas onde aparece.
+    """
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            doc_id = doc["id"]
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+            docs.setdefault(doc_id, doc)
+    ordered = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [{**docs[doc_id], "rrf_score": round(scores[doc_id], 5)} for doc_id in ordered]
+
+async def hybrid_retrieve(query: str, top_k: int = 3, timeout: Optional[float] = None,
+                          query_embedding: Optional[list] = None) -> list:
+    """
+    Pesquisa vetorial (pgvector) e por palavras-chave em simultâneo, fundidas com RRF.
+    Cada etapa tem o seu próprio timeout, pelo que uma etapa lenta não atrasa a resposta.
+    """
+    stage_timeout = RAG_STAGE_TIMEOUT if timeout is None else timeout
+    vector_docs, keyword_docs = await asyncio.gather(
+        _run_rag_stage(
+            "vector",
+            search_similar_documents(query, top_k=top_k, query_embedding=query_embedding),
+            stage_timeout
+        ),
+        _run_rag_stage("keywords", _keyword_stage(query, top_k), stage_timeout),
+    )
+    fused = reciprocal_rank_fusion([vector_docs, keyword_docs], top_k=top_k)
+    debug_sampled(logger, "rag_hybrid", vector=len(vector_docs), keyword=len(keyword_docs), fused=len(fused))
+    return fused
+
 # Endpoint de teste para debug do RAG
 @app.post("/test_rag")
 async def test_rag(data: dict):
@@ -1520,21 +2659,17 @@ async def test_rag(data: dict):
     # Verificar se é uma pergunta sobre identidade
     is_identity = is_identity_question(query)
     
-    # Pesquisar documentos similares
-    context_list = []
+    # Pesquisa híbrida (vetorial + palavras-chave em paralelo)
+    context_docs = []
     if not is_identity:
-        context_list = await search_similar_documents(query, top_k=3)
-        
-        # Se não encontrou nada, tentar procurar por palavras-chave
-        if not context_list:
-            keywords = await extract_species_keywords(query)
-            if keywords:
-                context_list = await search_by_keywords(keywords)
+        context_docs = await hybrid_retrieve(query, top_k=3)
+    context_list = [doc["content"] for doc in context_docs]
     
     return {
         "query": query,
         "is_identity": is_identity,
         "documents_found": len(context_list),
         "context": context_list[:1] if context_list else [],  # Primeiro documento apenas
+        "document_ids": [doc["id"] for doc in context_docs],
         "rag_used": len(context_list) > 0
     }
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+Métricas Prometheus do ia_service (expostas em GET /metrics).
+
+- Latência por rota HTTP (template da rota, não o URL) e por evento Socket.IO
+- Latência por etapa: decode, preprocess, forward, db, db_acquire, embedding, llm_upstream_*, ...
+- Acertos/falhas das caches (modelo, índice de embeddings, respostas LLM)
+- Ocupação do pool da base de dados, tarefas pendentes nos executores e filas dos LLM
+- Limpeza periódica das imagens temporárias (ficheiros removidos, bytes libertados)
+
+Com vários workers (WEB_CONCURRENCY > 1), PROMETHEUS_MULTIPROC_DIR tem de estar definido no ambiente antes
+de o processo arrancar (o prometheus_client lê-o ao ser importado) e ser limpo antes de cada arranque:
+cada worker escreve os valores em ficheiros nesse diretório e /metrics agrega-os, seja qual for o worker
+que responde. Os gauges de cada worker (pool, executores, filas LLM) são somados entre workers vivos.
+"""
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "").strip()
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+else:
+    # Vazio (PROMETHEUS_MULTIPROC_DIR= no docker-compose) = um só processo: o prometheus_client ativa o modo
+    # multiprocesso só por a variável existir e escreveria os ficheiros no diretório atual
+    os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HTTP_LATENCY = Histogram(
+    "ia_http_request_duration_seconds", "Latência dos pedidos HTTP por rota",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+SIO_EVENT_LATENCY = Histogram(
+    "ia_socketio_event_duration_seconds", "Latência dos handlers de eventos Socket.IO",
+    ["event"], buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    "ia_stage_duration_seconds", "Latência por etapa do processamento",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+CACHE_REQUESTS = Counter(
+    "ia_cache_requests_total", "Consultas às caches do serviço", ["cache", "result"]
+)
+LRU_CACHE_REQUESTS = Gauge(
+    "ia_lru_cache_requests", "Acertos/falhas acumulados das caches lru_cache", ["cache", "result"],
+    multiprocess_mode="livesum"
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "ia_db_pool_connections", "Ligações do pool da base de dados", ["state"], multiprocess_mode="livesum"
+)
+EXECUTOR_PENDING = Gauge(
+    "ia_executor_pending_tasks", "Tarefas submetidas e ainda não concluídas (em execução + em fila)", ["executor"],
+    multiprocess_mode="livesum"
+)
+EXECUTOR_WORKERS = Gauge(
+    "ia_executor_workers", "Número de workers de cada executor", ["executor"], multiprocess_mode="livesum"
+)
+LLM_GATE_REQUESTS = Gauge(
+    "ia_llm_gate_requests", "Pedidos LLM ativos e em fila por upstream", ["upstream", "state"], multiprocess_mode="livesum"
+)
+IMAGE_CLEANUP_FILES = Counter(
+    "ia_image_cleanup_files_removed_total", "Imagens temporárias removidas pela limpeza periódica", ["reason"]
+)
+IMAGE_CLEANUP_BYTES = Counter(
+    "ia_image_cleanup_bytes_reclaimed_total", "Bytes libertados pela limpeza de imagens temporárias", ["reason"]
+)
+IMAGE_DIR_USAGE = Gauge(
+    "ia_image_dir_usage", "Ficheiros e bytes no diretório de imagens temporárias após a limpeza", ["unit"],
+    multiprocess_mode="mostrecent"  # Diretório partilhado: vale a última limpeza, de qualquer worker
+)
+
+
+@contextmanager
+def stage(name: str):
+    """Mede a duração de um bloco: `with stage("forward"): ...`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_LATENCY.labels(name).observe(seconds)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_lru_cache(cache: str, info):
+    """Exporta functools.lru_cache.cache_info()"""
+    LRU_CACHE_REQUESTS.labels(cache, "hit").set(info.hits)
+    LRU_CACHE_REQUESTS.labels(cache, "miss").set(info.misses)
+
+
+def track_event(handler):
+    """Decorador para handlers Socket.IO (aplicar por baixo de @sio.event, mantém o nome do evento)"""
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            SIO_EVENT_LATENCY.labels(handler.__name__).observe(time.perf_counter() - start)
+    return wrapper
+
+
+def render():
+    """(conteúdo, content-type) no formato de exposição do Prometheus (agregado entre workers com MULTIPROC_DIR)"""
+    if not MULTIPROC_DIR:
+        return generate_latest(), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, MULTIPROC_DIR)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead():
+    """No fim do worker: os seus gauges "live*" deixam de contar na agregação"""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid(), MULTIPROC_DIR)
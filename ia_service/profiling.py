@@ -0,0 +1,300 @@
+"""
+Profiling opcional do ia_service: por pedido e por amostragem contínua.
+
+- Desligado por omissão (PROFILING_ENABLED). Com PROFILING_TOKEN definido, os pedidos e os endpoints
+  de administração têm de enviar o cabeçalho X-Profile-Token
+- Por pedido: cabeçalho X-Profile ou query ?profile=, com opções separadas por vírgulas:
+    cpu     (ou qualquer valor) perfil do pedido: event loop + threads de inferência (run_inference)
+    inline  devolve o relatório em texto em vez da resposta
+    torch   torch.profiler no forward do modelo de espécies (tabela no relatório + trace Chrome)
+  Usa pyinstrument se estiver instalado (PROFILING_ENGINE=auto), senão cProfile. Os ficheiros ficam em
+  PROFILING_DIR (os PROFILING_MAX_TRACES mais recentes). Um pedido perfilado de cada vez.
+  O trabalho nos processos de faces (face_worker) não é incluído.
+- Contínuo: amostragem das stacks de todas as threads (sys._current_frames) a cada N ms, ligada e
+  desligada em runtime; exporta stacks colapsadas (flamegraph.pl, speedscope)
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+try:
+    import pyinstrument
+except ImportError:  # Dependência opcional
+    pyinstrument = None
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "")
+PROFILING_DIR = os.environ.get("PROFILING_DIR", "profiles")
+PROFILING_MAX_TRACES = int(os.environ.get("PROFILING_MAX_TRACES", "200"))
+PROFILING_ENGINE = os.environ.get("PROFILING_ENGINE", "auto").lower()  # auto | pyinstrument | cprofile
+PROFILING_CONTINUOUS = os.environ.get("PROFILING_CONTINUOUS", "false").lower() in ("1", "true", "yes")
+PROFILING_INTERVAL_MS = float(os.environ.get("PROFILING_INTERVAL_MS", "10"))
+PROFILING_MAX_STACKS = int(os.environ.get("PROFILING_MAX_STACKS", "20000"))
+
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar("request_profile", default=None)
+_request_lock = threading.Lock()
+
+
+def engine() -> str:
+    if PROFILING_ENGINE == "cprofile" or pyinstrument is None:
+        return "cprofile"
+    return "pyinstrument"
+
+
+def authorized(headers) -> bool:
+    if not PROFILING_ENABLED:
+        return False
+    return not PROFILING_TOKEN or hmac.compare_digest(headers.get("x-profile-token", ""), PROFILING_TOKEN)
+
+
+# ==========================
+# PERFIL POR PEDIDO
+# ==========================
+
+class RequestProfile:
+    def __init__(self, name: str, options: set):
+        self.name = name
+        self.options = options
+        self.engine = engine()
+        self.started = time.perf_counter()
+        self.sections = []  # (etiqueta, profiler) por thread perfilada
+        self.torch_tables = []
+        self.files = []
+        self.token = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def thread_profiler(self, label: str, async_mode: bool = False):
+        """Perfila a thread atual durante o bloco (event loop ou thread de inferência)"""
+        if self.engine == "pyinstrument":
+            profiler = pyinstrument.Profiler(interval=0.001, async_mode="enabled" if async_mode else "disabled")
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # Python 3.12+: só um cProfile ativo de cada vez no processo
+                yield
+                return
+            try:
+                yield
+            finally:
+                profiler.disable()
+        with self._lock:
+            self.sections.append((label, profiler))
+
+    def add_torch(self, prof):
+        path = os.path.join(PROFILING_DIR, f"{self.name}-torch-{len(self.torch_tables) + 1}.json")
+        prof.export_chrome_trace(path)
+        with self._lock:
+            self.torch_tables.append(prof.key_averages().table(sort_by="cpu_time_total", row_limit=25))
+            self.files.append(path)
+
+    def report(self) -> str:
+        lines = [f"Perfil {self.name} ({self.engine}): {time.perf_counter() - self.started:.3f} s", ""]
+        for label, profiler in self.sections:
+            lines.append(f"===== {label} =====")
+            if self.engine == "pyinstrument":
+                lines.append(profiler.output_text(unicode=True, color=False))
+            else:
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(40)
+                lines.append(stream.getvalue())
+        for i, table in enumerate(self.torch_tables, 1):
+            lines.append(f"===== torch.profiler (forward {i}) =====")
+            lines.append(table)
+        return "\n".join(lines)
+
+    def save(self) -> str:
+        """Guarda o relatório (e o perfil completo: .prof do cProfile ou .html do pyinstrument); devolve o .txt"""
+        path = os.path.join(PROFILING_DIR, f"{self.name}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.report())
+        self.files.append(path)
+        if self.engine == "cprofile" and self.sections:
+            stats = pstats.Stats(self.sections[0][1])
+            for _, profiler in self.sections[1:]:
+                stats.add(profiler)
+            stats.dump_stats(os.path.join(PROFILING_DIR, f"{self.name}.prof"))
+            self.files.append(os.path.join(PROFILING_DIR, f"{self.name}.prof"))
+        elif self.engine == "pyinstrument":
+            for i, (label, profiler) in enumerate(self.sections):
+                html_path = os.path.join(PROFILING_DIR, f"{self.name}-{i}-{label}.html")
+                with open(html_path, "w", encoding="utf-8") as f:
+                    f.write(profiler.output_html())
+                self.files.append(html_path)
+        _prune_traces()
+        return path
+
+
+def start_request(headers, query_params, name: str) -> Optional[RequestProfile]:
+    """Perfil do pedido se pedido (X-Profile / ?profile=) e autorizado; None nos restantes casos"""
+    value = headers.get("x-profile") or query_params.get("profile")
+    if not value or not authorized(headers):
+        return None
+    if not _request_lock.acquire(blocking=False):
+        return None  # Já há um pedido a ser perfilado
+    os.makedirs(PROFILING_DIR, exist_ok=True)
+    # Prefixo comum aos ficheiros do pedido: data + request_id, só com [A-Za-z0-9_] (ver _prune_traces)
+    name = time.strftime("%Y%m%d%H%M%S") + "_" + re.sub(r"[^A-Za-z0-9_]", "_", name)[:64]
+    profile = RequestProfile(name, {option.strip().lower() for option in value.split(",")})
+    profile.token = _current.set(profile)
+    return profile
+
+
+def finish_request(profile: RequestProfile) -> str:
+    """Guarda o perfil e liberta o lugar; devolve o caminho do relatório"""
+    try:
+        _current.reset(profile.token)
+        return profile.save()
+    finally:
+        _request_lock.release()
+
+
+def call(fn, *args):
+    """Executa fn(*args) numa thread de trabalho; se o pedido estiver a ser perfilado, perfila também esta thread"""
+    profile = _current.get()
+    if profile is None:
+        return fn(*args)
+    with profile.thread_profiler(threading.current_thread().name):
+        return fn(*args)
+
+
+@contextmanager
+def torch_forward():
+    """torch.profiler à volta do forward, só em pedidos perfilados com a opção torch"""
+    profile = _current.get()
+    if profile is None or "torch" not in profile.options:
+        yield
+        return
+    from torch.profiler import ProfilerActivity
+    from torch.profiler import profile as torch_profile
+
+    with torch_profile(activities=[ProfilerActivity.CPU], record_shapes=True, profile_memory=True) as prof:
+        yield
+    profile.add_torch(prof)
+
+
+def list_traces() -> list:
+    if not os.path.isdir(PROFILING_DIR):
+        return []
+    with os.scandir(PROFILING_DIR) as entries:
+        files = [entry for entry in entries if entry.is_file()]
+    files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [{"name": entry.name, "bytes": entry.stat().st_size, "mtime": entry.stat().st_mtime} for entry in files]
+
+
+def trace_path(name: str) -> Optional[str]:
+    """Caminho de um ficheiro de PROFILING_DIR (só nomes simples, sem diretórios)"""
+    if os.path.basename(name) != name or name.startswith("."):
+        return None
+    path = os.path.join(PROFILING_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def _prune_traces():
+    # Os ficheiros de um pedido partilham o prefixo (request_id): conta-se por pedido, não por ficheiro
+    traces = list_traces()
+    requests = []
+    for trace in traces:
+        prefix = trace["name"].split("-", 1)[0].split(".", 1)[0]
+        if prefix not in requests:
+            requests.append(prefix)
+    expired = set(requests[PROFILING_MAX_TRACES:])
+    for trace in traces:
+        if trace["name"].split("-", 1)[0].split(".", 1)[0] in expired:
+            try:
+                os.remove(os.path.join(PROFILING_DIR, trace["name"]))
+            except OSError:
+                pass
+
+
+# ==========================
+# AMOSTRAGEM CONTÍNUA
+# ==========================
+
+class StackSampler:
+    """Amostra as stacks de todas as threads numa thread própria; acumula stacks colapsadas"""
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval_ms = PROFILING_INTERVAL_MS
+        self.started_at = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms: Optional[float] = None):
+        if self.running:
+            self.stop()
+        if interval_ms:
+            self.interval_ms = max(1.0, float(interval_ms))
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval_ms / 1000):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            with self._lock:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < 128:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    key = ";".join([names.get(thread_id, str(thread_id))] + stack[::-1])
+                    if key in self.stacks or len(self.stacks) < PROFILING_MAX_STACKS:
+                        self.stacks[key] += 1
+                self.samples += 1
+
+    def collapsed(self) -> str:
+        """Formato "thread;frame;frame contagem" (uma stack por linha)"""
+        with self._lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "interval_ms": self.interval_ms,
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+            "started_at": self.started_at,
+        }
+
+
+sampler = StackSampler()
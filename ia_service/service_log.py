@@ -0,0 +1,97 @@
+"""
+Logging estruturado do ia_service.
+
+- Uma linha JSON por evento: ts, level, logger, msg, request_id e campos extra (extra={...})
+- Nível configurável com LOG_LEVEL (por omissão INFO)
+- request_id por pedido HTTP (cabeçalho X-Request-ID ou gerado) e por evento Socket.IO
+- Eventos de debug do caminho crítico são amostrados por pedido (LOG_DEBUG_SAMPLE_RATE, por omissão 1%):
+  num pedido amostrado aparecem todos, nos restantes nenhum
+- O pedido só coloca o registo numa fila (QueueHandler); a escrita em stdout é feita por uma thread dedicada
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+_request_sampled: ContextVar[Optional[bool]] = ContextVar("request_sampled", default=None)
+
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """Corre na thread que regista o evento (antes da fila), onde o request_id do pedido está disponível"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+_listener = None
+
+
+def configure_logging():
+    """Configura o logger raiz uma única vez (idempotente)"""
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    configure_logging()
+    return logging.getLogger(name)
+
+
+def bind_request(request_id: Optional[str] = None) -> str:
+    """Associa um request_id (e a decisão de amostragem) ao contexto atual; devolve o id"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    _request_sampled.set(random.random() < DEBUG_SAMPLE_RATE)
+    return request_id
+
+
+def debug_sampled(logger: logging.Logger, msg: str, **fields):
+    """Debug do caminho crítico: só é registado nos pedidos amostrados (e se o nível DEBUG estiver ativo)"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    sampled = _request_sampled.get()
+    if sampled is None:  # Fora de um pedido: amostragem por evento
+        sampled = random.random() < DEBUG_SAMPLE_RATE
+    if sampled:
+        logger.debug(msg, extra=fields)
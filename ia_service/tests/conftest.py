@@ -0,0 +1,9 @@
+"""Testes do ia_service: importam os módulos do serviço diretamente, sem base de dados nem upstreams"""
+import os
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+
+os.environ.setdefault("WARMUP_ON_STARTUP", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
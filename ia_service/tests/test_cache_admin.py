@@ -0,0 +1,36 @@
+"""Endpoint de invalidação de caches (POST /admin/cache/invalidate): desligado sem CACHE_ADMIN_TOKEN e protegido por X-Admin-Token"""
+import asyncio
+
+import httpx
+import pytest
+
+import cluster
+import main
+
+
+def post(headers=None, cache="prompt_analysis"):
+    async def request():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/admin/cache/invalidate", json={"cache": cache}, headers=headers or {})
+    return asyncio.run(request())
+
+
+def test_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(cluster, "CACHE_ADMIN_TOKEN", "")
+    assert post().status_code == 404
+    assert post({"X-Admin-Token": ""}).status_code == 404
+
+
+@pytest.mark.parametrize("headers", [None, {"X-Admin-Token": ""}, {"X-Admin-Token": "errado"}])
+def test_rejects_missing_or_wrong_token(monkeypatch, headers):
+    monkeypatch.setattr(cluster, "CACHE_ADMIN_TOKEN", "segredo")
+    assert post(headers).status_code == 403
+
+
+def test_invalidates_with_token(monkeypatch):
+    monkeypatch.setattr(cluster, "CACHE_ADMIN_TOKEN", "segredo")
+    response = post({"X-Admin-Token": "segredo"})
+    assert response.status_code == 200
+    assert response.json()["invalidated"] == ["prompt_analysis"]
+    assert post({"X-Admin-Token": "segredo"}, cache="inexistente").status_code == 404
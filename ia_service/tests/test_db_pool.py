@@ -0,0 +1,94 @@
+"""
+Pool de ligações à BD (db_connect / db_scope) sob concorrência, com o pool em memória dos benchmarks
+(benchmarks/fakes.py). Um pool esgotado faz o acquire expirar (DB_ACQUIRE_TIMEOUT) em vez de bloquear,
+pelo que uma fuga de ligações ou um acquire aninhado fazem estes testes falhar.
+"""
+import asyncio
+
+import pytest
+
+import main
+from benchmarks import fakes
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    def create(max_size, latency=0.001):
+        history = fakes.synthetic_history(rows=2000, users=40, taxa=60)
+        fake = fakes.FakePool(history, fakes.synthetic_documents(10), latency=latency, max_size=max_size)
+        monkeypatch.setattr(main, "_db_pool", fake)
+        return fake
+    monkeypatch.setattr(main, "DB_ACQUIRE_TIMEOUT", 1.0)
+    return create
+
+
+def run(coro, timeout=10):
+    return asyncio.run(asyncio.wait_for(coro, timeout))
+
+
+def test_db_scope_releases_connections_left_open(pool):
+    async def scenario():
+        fake = pool(max_size=2)
+
+        async def handler():
+            async with main.db_scope():
+                conn = await main.db_connect()
+                await conn.fetch("SELECT 1")  # Nunca fechada: o âmbito devolve-a ao pool
+
+        await asyncio.gather(*(handler() for _ in range(20)))
+        return fake.in_use
+
+    assert run(scenario()) == 0
+
+
+def test_exhausted_pool_times_out_instead_of_blocking(pool, monkeypatch):
+    monkeypatch.setattr(main, "DB_ACQUIRE_TIMEOUT", 0.1)
+
+    async def scenario():
+        fake = pool(max_size=2)
+        held = [await main.db_connect() for _ in range(2)]
+        with pytest.raises(asyncio.TimeoutError):
+            await main.db_connect()
+        for conn in held:
+            await conn.close()
+        return fake.in_use
+
+    assert run(scenario()) == 0
+
+
+def test_collaborative_filtering_does_not_hold_a_connection_while_acquiring(pool):
+    # Com um pool de uma ligação, segurar uma ligação e pedir outra expira: a filtragem devolveria o erro
+    async def scenario():
+        fake = pool(max_size=1)
+        data = main.AdvancedRecommendationRequest(
+            user_id="1", user_groups=[], user_families=[], seen_taxon_ids=[],
+            candidates=fakes.synthetic_candidates(60), algorithm="collaborative",
+        )
+
+        async def handler():
+            async with main.db_scope():
+                return await main._collaborative_filtering(data)
+
+        results = await asyncio.gather(*(handler() for _ in range(8)))
+        return results, fake.in_use
+
+    results, in_use = run(scenario())
+    assert in_use == 0
+    for result in results:
+        assert result["explanation"] != "Erro ao processar dados"
+        assert result["results"]
+
+
+def test_rag_stage_timeout_returns_connections(pool, monkeypatch):
+    # Fora de db_scope: as etapas canceladas pelo timeout do hybrid_retrieve têm de fechar a ligação
+    async def embedding(text):
+        return fakes.fake_embedding(text)
+
+    monkeypatch.setattr(main, "get_embedding", embedding)
+
+    async def scenario():
+        fake = pool(max_size=4, latency=0.5)
+        docs = await main.hybrid_retrieve("Fala-me sobre o lince ibérico", top_k=3, timeout=0.05)
+        return docs, fake.in_use
+
+    assert run(scenario()) == ([], 0)
@@ -0,0 +1,213 @@
+"""
+Motor de download do dataset (dataset/downloader.py) contra um servidor HTTP local (sockets reais):
+retentativas com backoff em 429/5xx, Retry-After, respostas truncadas, limite de ligações por host,
+limite de taxa e fila retomável.
+"""
+import asyncio
+import time
+
+import pytest
+
+# Importado como dataset.downloader (sem pôr dataset/ no sys.path, onde dataset/dataset.py esconderia o pacote)
+from dataset.downloader import AsyncDownloader, ResumableWorkQueue, TokenBucket
+
+
+class StubServer:
+    """
+    Servidor HTTP/1.1 mínimo em 127.0.0.1. `routes`: caminho -> lista de respostas, servidas por ordem
+    (a última repete-se). Cada resposta é (status, headers, body) ou (status, headers, body, truncate),
+    em que truncate anuncia o Content-Length completo mas fecha a ligação a meio do corpo.
+    """
+
+    def __init__(self, routes: dict, delay: float = 0.0):
+        self.routes = routes
+        self.delay = delay
+        self.hits = {}
+        self.active = 0
+        self.max_active = 0
+        self.server = None
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            path = request_line.split()[1].decode()
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            try:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                hit = self.hits.get(path, 0)
+                self.hits[path] = hit + 1
+                responses = self.routes.get(path, [(404, {}, b"")])
+                status, headers, body, *truncate = responses[min(hit, len(responses) - 1)]
+            finally:
+                self.active -= 1
+            head = [f"HTTP/1.1 {status} X", f"Content-Length: {len(body)}", "Connection: close"]
+            head += [f"{name}: {value}" for name, value in headers.items()]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+            writer.write(body[:len(body) // 2] if truncate and truncate[0] else body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def fast_downloader(**kwargs):
+    options = {"rate_per_second": 1000, "max_retries": 3, "backoff_base": 0.01, "timeout": 5}
+    options.update(kwargs)
+    return AsyncDownloader(**options)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retries_transient_status_then_succeeds(status):
+    async def scenario():
+        routes = {"/obs": [(status, {}, b"erro"), (status, {}, b"erro"), (200, {}, b'{"results": [1, 2]}')]}
+        async with StubServer(routes) as server, fast_downloader() as downloader:
+            data = await downloader.get_json(server.url + "/obs")
+        return data, server.hits["/obs"]
+
+    data, hits = run(scenario())
+    assert data == {"results": [1, 2]}
+    assert hits == 3
+
+
+def test_gives_up_after_max_retries():
+    async def scenario():
+        async with StubServer({"/obs": [(503, {}, b"")]}) as server, fast_downloader(max_retries=2) as downloader:
+            data = await downloader.get_json(server.url + "/obs")
+        return data, server.hits["/obs"]
+
+    data, hits = run(scenario())
+    assert data is None
+    assert hits == 3  # 1 tentativa + 2 retentativas
+
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        async with StubServer({"/obs": [(404, {}, b"")]}) as server, fast_downloader() as downloader:
+            data = await downloader.get_json(server.url + "/obs")
+        return data, server.hits["/obs"]
+
+    assert run(scenario()) == (None, 1)
+
+
+def test_truncated_body_is_retried():
+    image = bytes(range(256)) * 64
+
+    async def scenario():
+        routes = {"/photo.jpg": [(200, {}, image, True), (200, {}, image)]}
+        async with StubServer(routes) as server, fast_downloader() as downloader:
+            content = await downloader.get_bytes(server.url + "/photo.jpg")
+        return content, server.hits["/photo.jpg"]
+
+    content, hits = run(scenario())
+    assert content == image
+    assert hits == 2
+
+
+def test_connection_refused_returns_none():
+    async def scenario():
+        async with StubServer({}) as server:
+            url = server.url
+        async with fast_downloader(max_retries=1) as downloader:
+            return await downloader.get_bytes(url + "/photo.jpg")
+
+    assert run(scenario()) is None
+
+
+def test_backoff_is_exponential_and_honours_retry_after():
+    downloader = fast_downloader(backoff_base=1.0)
+    try:
+        assert 1.0 <= downloader._backoff(0, None) < 2.0
+        assert 4.0 <= downloader._backoff(2, None) < 5.0
+
+        class Response:
+            headers = {"Retry-After": "7"}
+        assert downloader._backoff(0, Response()) == 7.0
+    finally:
+        run(downloader.client.aclose())
+
+
+def test_retry_after_delays_next_attempt():
+    async def scenario():
+        routes = {"/obs": [(429, {"Retry-After": "1"}, b""), (200, {}, b"{}")]}
+        async with StubServer(routes) as server, fast_downloader() as downloader:
+            start = time.monotonic()
+            data = await downloader.get_json(server.url + "/obs")
+            return data, time.monotonic() - start
+
+    data, elapsed = run(scenario())
+    assert data == {}
+    assert elapsed >= 1.0
+
+
+def test_connections_per_host_are_limited():
+    async def scenario():
+        routes = {f"/photo{i}.jpg": [(200, {}, b"x")] for i in range(12)}
+        async with StubServer(routes, delay=0.05) as server:
+            async with fast_downloader(max_concurrency=8, max_connections_per_host=3) as downloader:
+                results = await asyncio.gather(*(downloader.get_bytes(f"{server.url}/photo{i}.jpg") for i in range(12)))
+        return results, server.max_active
+
+    results, max_active = run(scenario())
+    assert results == [b"x"] * 12
+    assert 1 < max_active <= 3
+
+
+def test_rate_limit_spaces_requests():
+    async def scenario():
+        bucket = TokenBucket(rate=20, capacity=1)
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert run(scenario()) >= 0.18  # 4 esperas de 1/20 s depois do primeiro token
+
+
+def test_work_queue_resumes_only_pending_tasks(tmp_path):
+    done_path = str(tmp_path / "done.txt")
+    attempts = []
+
+    async def flaky(item):
+        attempts.append(item)
+        return item % 2 == 0  # Ímpares falham na primeira execução
+
+    async def reliable(item):
+        attempts.append(item)
+        return True
+
+    items = [(str(i), i) for i in range(6)]
+    run(ResumableWorkQueue(done_path, workers=3).run(items, flaky))
+    assert sorted(attempts) == [0, 1, 2, 3, 4, 5]
+
+    attempts.clear()
+    queue = ResumableWorkQueue(done_path, workers=3)  # Nova execução: lê as concluídas do disco
+    run(queue.run(items, reliable))
+    assert sorted(attempts) == [1, 3, 5]
+    assert queue.done == {str(i) for i in range(6)}
+
+
+def test_work_queue_survives_handler_errors(tmp_path):
+    async def handler(item):
+        if item == 1:
+            raise RuntimeError("falha")
+        return True
+
+    queue = ResumableWorkQueue(str(tmp_path / "done.txt"), workers=2)
+    run(queue.run([(str(i), i) for i in range(3)], handler))
+    assert queue.done == {"0", "2"}
@@ -0,0 +1,52 @@
+"""Métricas com vários workers (PROMETHEUS_MULTIPROC_DIR): /metrics agrega os valores de todos os processos"""
+import os
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = """
+import metrics
+metrics.record_cache("llm_response", True)
+metrics.DB_POOL_CONNECTIONS.labels("in_use").set(2)
+"""
+
+RENDER = """
+import sys
+import metrics
+sys.stdout.write(metrics.render()[0].decode())
+"""
+
+DEAD_WORKER = """
+import metrics
+metrics.DB_POOL_CONNECTIONS.labels("in_use").set(5)
+metrics.mark_process_dead()
+"""
+
+
+def run(code, multiproc_dir, cwd=SERVICE_DIR):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": multiproc_dir, "PYTHONPATH": SERVICE_DIR}
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def sample(text, prefix):
+    return [float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(prefix)]
+
+
+def test_counters_and_gauges_are_aggregated_across_workers(tmp_path):
+    multiproc_dir = str(tmp_path / "prometheus")
+    for _ in range(3):
+        run(WORKER, multiproc_dir)
+    run(DEAD_WORKER, multiproc_dir)
+    text = run(RENDER, multiproc_dir)
+    assert sample(text, 'ia_cache_requests_total{cache="llm_response",result="hit"}') == [3.0]
+    # livesum: os processos de teste já terminaram mas só o que chamou mark_process_dead sai da soma
+    assert sample(text, 'ia_db_pool_connections{state="in_use"}') == [6.0]
+
+
+def test_empty_multiproc_dir_means_single_process(tmp_path):
+    text = run(WORKER + RENDER, "", cwd=str(tmp_path))
+    assert sample(text, 'ia_cache_requests_total{cache="llm_response",result="hit"}') == [1.0]
+    assert list(tmp_path.iterdir()) == []  # Nenhum ficheiro .db no diretório atual
@@ -0,0 +1,68 @@
+"""Classificação dos prompts do chatbot e extração de palavras-chave de espécies (analyse_prompt)"""
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("prompt, keyword", [
+    ("Fala-me sobre espécies de peixes", "peixe"),
+    ("Fala-me sobre espécies de peixes", "espécie"),
+    ("Que aves existem em Portugal?", "ave"),
+    ("Quais os animais do Alentejo?", "animal"),
+    ("Há répteis na serra?", "réptil"),
+    ("Onde vivem os falcões?", "falcão"),
+    ("Os cães e os gatos são mamíferos", "cão"),
+    ("Os cães e os gatos são mamíferos", "mamífero"),
+])
+def test_plurals_match_singular_terms(prompt, keyword):
+    analysis = main.analyse_prompt(prompt)
+    assert not analysis.is_identity
+    assert keyword in analysis.keywords
+
+
+def test_singular_terms_still_match():
+    assert "lince" in main.analyse_prompt("Qual o habitat do lince ibérico?").keywords
+
+
+def test_terms_match_whole_words_only():
+    # "ave" em "chave" e "cobra" em "cobrar" não são contexto de espécies
+    assert main.analyse_prompt("Perdi a chave, podes cobrar depois?").keywords == ()
+
+
+def test_capitalised_word_does_not_consume_a_term():
+    keywords = main.analyse_prompt("Que aves existem em Portugal?").keywords
+    assert "ave" in keywords and "Portugal" in keywords
+
+
+@pytest.mark.parametrize("prompt", ["Quem és tu?", "Como te chamas?", "Qual é o teu nome?", "Apresenta-te"])
+def test_identity_questions(prompt):
+    assert main.is_identity_question(prompt)
+
+
+@pytest.mark.parametrize("prompt", [
+    "Ajuda na identificação de espécies de aves",
+    "Qual é o nome do bot?",
+    "who are you",
+])
+def test_keyword_exclusions_skip_keywords_and_vector_search(prompt):
+    # Não são perguntas de identidade, mas (como no original) não têm palavras-chave nem pesquisa vetorial
+    analysis = main.analyse_prompt(prompt)
+    assert not analysis.is_identity
+    assert analysis.keywords == ()
+    assert analysis.skip_vector_search
+
+
+@pytest.mark.parametrize("prompt", ["Quem és tu?", "who are you", "Qual é o nome do bot?"])
+def test_vector_search_skipped_for_bot_questions(monkeypatch, prompt):
+    async def unexpected(*args, **kwargs):
+        raise AssertionError("pesquisa vetorial não devia correr")
+
+    monkeypatch.setattr(main, "get_embedding", unexpected)
+    monkeypatch.setattr(main, "db_connect", unexpected)
+    assert asyncio.run(main.search_similar_documents(prompt)) == []
+
+
+def test_species_question_runs_vector_search():
+    assert not main.analyse_prompt("Fala-me sobre espécies de peixes").skip_vector_search
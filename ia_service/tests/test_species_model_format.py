@@ -0,0 +1,38 @@
+"""Formato do modelo de espécies: o serviço só carrega pesos (weights_only=True); modelos antigos são convertidos offline"""
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+torchvision = pytest.importorskip("torchvision")
+
+from dataset import convert_model
+from dataset.embedding_index import load_resnet18
+
+
+def legacy_model(tmp_path, classes=3):
+    model = torchvision.models.resnet18(weights=None)
+    model.fc = torch.nn.Linear(model.fc.in_features, classes)
+    path = str(tmp_path / "species_model.pt")
+    torch.save(model, path)  # Formato antigo: o módulo inteiro em pickle
+    return path
+
+
+def test_service_refuses_pickled_module(tmp_path):
+    path = legacy_model(tmp_path)
+    with open(path, "rb") as f:
+        original = f.read()
+    with pytest.raises(ValueError, match="dataset.convert_model"):
+        load_resnet18(path, mmap=True)
+    with open(path, "rb") as f:
+        assert f.read() == original  # O serviço não altera o ficheiro
+    assert not os.path.exists(path + ".module")
+
+
+def test_offline_conversion_makes_model_loadable(tmp_path):
+    path = legacy_model(tmp_path)
+    convert_model.main([path])
+    assert os.path.exists(path + ".module")
+    model = load_resnet18(path, mmap=True)
+    assert model.fc.out_features == 3
+    convert_model.main([path])  # Já convertido: não volta a ser tocado